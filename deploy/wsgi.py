@@ -4,3 +4,6 @@ Sample wsgi file for running the app in production
 import fivex
 
 app = fivex.create_app("fivex.settings.prod")
+
+# Load lookup tables now, rather than while serving the first requests of each worker
+fivex.warm_up(app)
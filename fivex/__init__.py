@@ -1,8 +1,12 @@
 """
 Defines the FIVEx web application
 """
+import time
+import typing as ty
+
 import flask
 
+from fivex import model
 from fivex.api import api_blueprint
 from fivex.frontend import views_blueprint
 
@@ -27,3 +31,33 @@ def create_app(settings_module="fivex.settings.dev"):
             app.config["SENTRY_DSN"], integrations=[FlaskIntegration()]
         )
     return app
+
+
+def warm_up(app: flask.Flask) -> ty.Dict[str, float]:
+    """
+    Load the large, read-only lookup tables that are otherwise built on first use, so that the first requests served
+    by a new worker are not slow
+
+    Call this once the app is created: in each worker before it serves requests, or in the parent process before
+    workers are forked (eg with gunicorn's --preload), so that all workers share the same memory pages.
+
+    :return: The time (in seconds) taken to load each table. Tables whose data files are missing are skipped (they
+        are reported by the requests that need them).
+    """
+    loaders: ty.Dict[str, ty.Callable[[], ty.Any]] = {
+        "gene_locator": model.get_gene_locator,
+        "gene_names": model.get_gene_names_conversion,
+        "tss_index": model.get_tss_index,
+        "gene_intervals": model.get_gene_intervals,
+        "transcript_intervals": model.get_transcript_intervals,
+    }
+    timings = {}
+    with app.app_context():
+        for name, load in loaders.items():
+            start = time.perf_counter()
+            try:
+                load()
+            except FileNotFoundError:
+                continue
+            timings[name] = time.perf_counter() - start
+    return timings
@@ -0,0 +1,263 @@
+"""
+In-memory indexes over gene annotations. These are built once per process and shared (read-only) by all requests.
+"""
+import gzip
+import sys
+import typing as ty
+
+import numpy as np
+
+
+class TSSIndex:
+    """
+    Transcription start sites (TSS) of every gene, sorted by position within each chromosome
+
+    Each TSS has a sign that encodes the strand of the gene: a positive TSS is on the + strand, and a negative TSS is
+    on the - strand. (this is the same convention as `tss.json.gz`)
+    """
+
+    def __init__(self, genes: ty.Iterable[ty.Tuple[str, str, int]]):
+        """
+        :param genes: (chrom, gene_id, signed_tss) for every gene. If a gene appears more than once (eg genes in the
+            pseudo-autosomal region of chrX and chrY), the last TSS seen will be used for lookups by gene_id.
+        """
+        by_chrom: ty.Dict[str, list] = {}
+        # gene_id -> (strand, unsigned TSS), precomputed so that TSS distances need no per-row sign arithmetic
+        self._by_gene: ty.Dict[str, ty.Tuple[int, int]] = {}
+        for chrom, gene_id, signed_tss in genes:
+            gene_id = sys.intern(gene_id)
+            by_chrom.setdefault(chrom, []).append(
+                (abs(signed_tss), gene_id, signed_tss)
+            )
+            self._by_gene[gene_id] = (
+                1 if signed_tss >= 0 else -1,
+                abs(signed_tss),
+            )
+
+        self._positions: ty.Dict[str, np.ndarray] = {}
+        self._signed: ty.Dict[str, np.ndarray] = {}
+        self._gene_ids: ty.Dict[str, np.ndarray] = {}
+        for chrom, entries in by_chrom.items():
+            entries.sort()
+            self._positions[chrom] = np.array(
+                [tss for tss, _, _ in entries], dtype=np.int64
+            )
+            self._signed[chrom] = np.array(
+                [signed for _, _, signed in entries], dtype=np.int64
+            )
+            self._gene_ids[chrom] = np.array(
+                [gene_id for _, gene_id, _ in entries], dtype=object
+            )
+
+    @classmethod
+    def from_gencode(cls, path: str) -> "TSSIndex":
+        """Build the index from the (bgzipped) GENCODE genes BED file"""
+
+        def genes():
+            with gzip.open(path, "rt") as f:
+                for line in f:
+                    # chrom, data_source, information_category, start, end, strand, gene_id, gene_type, gene_name
+                    fields = line.rstrip("\n").split("\t")
+                    if len(fields) < 7:
+                        continue
+                    chrom = fields[0].replace("chr", "")
+                    if fields[5] == "+":
+                        tss = int(fields[3])
+                    elif fields[5] == "-":
+                        tss = -int(fields[4])
+                    else:
+                        tss = -1
+                    yield chrom, fields[6].split(".")[0], tss
+
+        return cls(genes())
+
+    def get(self, gene_id: str, default=None) -> ty.Optional[int]:
+        """Get the signed TSS for a gene (ENSG, no version number)"""
+        try:
+            strand, tss = self._by_gene[gene_id]
+        except KeyError:
+            return default
+        return strand * tss
+
+    def lookup(self, gene_id: str) -> ty.Tuple[float, float]:
+        """Get (strand, unsigned TSS) for a single gene, or (nan, nan) if the gene is not known"""
+        return self._by_gene.get(gene_id, (np.nan, np.nan))
+
+    def genes_near(
+        self, chrom: str, position: int, window: int
+    ) -> ty.List[ty.Tuple[str, int]]:
+        """
+        Find all genes whose TSS is within `window` bp of a position, in order of TSS position
+
+        :return: A list of (gene_id, signed TSS) tuples
+        """
+        positions = self._positions.get(chrom)
+        if positions is None:
+            return []
+        start = np.searchsorted(positions, position - window, side="left")
+        end = np.searchsorted(positions, position + window, side="right")
+        return list(
+            zip(
+                self._gene_ids[chrom][start:end].tolist(),
+                self._signed[chrom][start:end].tolist(),
+            )
+        )
+
+    def distances(
+        self, positions: np.ndarray, gene_ids: ty.Sequence[str]
+    ) -> ty.Tuple[np.ndarray, np.ndarray]:
+        """
+        Calculate the TSS distance for a batch of (position, gene) pairs at once
+
+        Distances are measured in the direction of transcription, so that negative values are upstream of the gene.
+        Genes that are not in the index receive `nan`.
+
+        :return: (tss_distance, tss_position) arrays. `tss_position` is the negative unsigned TSS, as used by the
+            PheWAS plot to sort genes.
+        """
+        missing = (np.nan, np.nan)
+        strand_tss = np.array(
+            [self._by_gene.get(gene_id, missing) for gene_id in gene_ids],
+            dtype=np.float64,
+        ).reshape(-1, 2)
+        strands = strand_tss[:, 0]
+        tss = strand_tss[:, 1]
+        return strands * (np.asarray(positions) - tss), -tss
+
+
+class GeneFeature(ty.NamedTuple):
+    chrom: str
+    start: int
+    end: int
+    gene_id: str
+    symbol: str
+
+
+class TranscriptFeature(ty.NamedTuple):
+    chrom: str
+    start: int
+    end: int
+    gene_id: str
+    transcript_id: str
+    symbol: str
+
+
+# A gene or transcript (each index holds only one kind of feature)
+Feature = ty.TypeVar("Feature", GeneFeature, TranscriptFeature)
+
+
+class IntervalIndex(ty.Generic[Feature]):
+    """
+    Genes or transcripts, for overlap queries and lookups by gene
+
+    Within each chromosome, features are sorted by start position (keeping the order of the GENCODE file, which is
+    sorted the same way). No feature can overlap a query unless it starts at most one feature length (of the longest
+    feature on that chromosome) before it: a query finds that slice of the sorted starts, then checks the ends of
+    only those features.
+    """
+
+    def __init__(self, features: ty.Iterable[Feature]):
+        by_chrom: ty.Dict[str, ty.List[Feature]] = {}
+        self._by_gene: ty.Dict[str, ty.List[Feature]] = {}
+        for feature in features:
+            by_chrom.setdefault(feature.chrom, []).append(feature)
+            self._by_gene.setdefault(feature.gene_id, []).append(feature)
+
+        self._starts: ty.Dict[str, np.ndarray] = {}
+        self._ends: ty.Dict[str, np.ndarray] = {}
+        self._features: ty.Dict[str, ty.List[Feature]] = {}
+        self._max_length: ty.Dict[str, int] = {}
+        for chrom, entries in by_chrom.items():
+            # A stable sort, so that features with the same start stay in file order
+            entries.sort(key=lambda feature: feature.start)
+            starts = np.array([f.start for f in entries], dtype=np.int64)
+            ends = np.array([f.end for f in entries], dtype=np.int64)
+            self._starts[chrom] = starts
+            self._ends[chrom] = ends
+            self._features[chrom] = entries
+            self._max_length[chrom] = int((ends - starts).max())
+
+    @staticmethod
+    def _read_gencode(path: str) -> ty.Iterator[ty.List[str]]:
+        with gzip.open(path, "rt") as f:
+            for line in f:
+                yield line.rstrip("\n").split("\t")
+
+    @staticmethod
+    def genes_from_gencode(path: str) -> "IntervalIndex[GeneFeature]":
+        """Build the index from the (bgzipped) GENCODE genes BED file"""
+
+        def genes() -> ty.Iterator[GeneFeature]:
+            # chrom, data_source, information_category, start, end, strand, gene_id, gene_type, gene_name
+            for fields in IntervalIndex._read_gencode(path):
+                if len(fields) < 9:
+                    continue
+                yield GeneFeature(
+                    sys.intern(fields[0].replace("chr", "")),
+                    int(fields[3]),
+                    int(fields[4]),
+                    sys.intern(fields[6].split(".")[0]),
+                    sys.intern(fields[8]),
+                )
+
+        return IntervalIndex(genes())
+
+    @staticmethod
+    def transcripts_from_gencode(
+        path: str,
+    ) -> "IntervalIndex[TranscriptFeature]":
+        """Build the index from the (bgzipped) GENCODE transcripts BED file"""
+
+        def transcripts() -> ty.Iterator[TranscriptFeature]:
+            # chrom, data_source, information_category, start, end, strand, gene_id, transcript_id, gene_type,
+            #   gene_name, transcript_type, transcript_name
+            for fields in IntervalIndex._read_gencode(path):
+                if len(fields) < 10:
+                    continue
+                yield TranscriptFeature(
+                    sys.intern(fields[0].replace("chr", "")),
+                    int(fields[3]),
+                    int(fields[4]),
+                    sys.intern(fields[6].split(".")[0]),
+                    sys.intern(fields[7].split(".")[0]),
+                    sys.intern(fields[9]),
+                )
+
+        return IntervalIndex(transcripts())
+
+    def fetch(
+        self,
+        chrom: str,
+        start: int,
+        end: int,
+        gene_id: ty.Optional[str] = None,
+    ) -> ty.List[Feature]:
+        """
+        Find the features in a region, in file order. Coordinates are interpreted as by `pysam.TabixFile.fetch` on
+        the GENCODE files (a 0-based, half-open query of 1-based, closed intervals), so that results are identical.
+
+        :param gene_id: Only return features of this gene (ENSG, no version number)
+        """
+        chrom = chrom.replace("chr", "")
+        if gene_id is not None:
+            return [
+                feature
+                for feature in self._by_gene.get(gene_id, [])
+                if feature.chrom == chrom
+                and feature.start <= end
+                and feature.end > start
+            ]
+        starts = self._starts.get(chrom)
+        if starts is None:
+            return []
+        first = np.searchsorted(
+            starts, start - self._max_length[chrom], side="left"
+        )
+        last = np.searchsorted(starts, end, side="right")
+        overlaps = np.flatnonzero(self._ends[chrom][first:last] > start)
+        features = self._features[chrom]
+        return [features[first + i] for i in overlaps.tolist()]
+
+    def for_gene(self, gene_id: str) -> ty.List[Feature]:
+        """Get all features of a gene (ENSG, no version number), eg its transcripts, in file order"""
+        return list(self._by_gene.get(gene_id, []))
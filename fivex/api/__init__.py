@@ -1,61 +1,258 @@
 """
 API endpoints (return JSON, not HTML)
 """
-from flask import Blueprint, jsonify, request
-from zorp import readers  # type: ignore
+import operator
+import re
+import typing as ty
+
+from flask import Blueprint, abort, current_app, jsonify, request
 
 from .. import model
-from .format import CIParser, query_variants
+from ..conditional import conditional
+from ..response_cache import cached
+from ..tabix import PooledTabixReader
+from . import serialize
+from .format import (
+    CIParser,
+    VariantContainer,
+    query_positions,
+    query_tracks,
+    query_variants,
+)
 
 api_blueprint = Blueprint("api", __name__)
 
 
+def _variants_response(data: ty.Iterable[VariantContainer]):
+    """Serialize the results of a variant query, in the format requested by the `format` query parameter"""
+    response_format = request.args.get("format")
+    if response_format == "columnar":
+        return serialize.columnar_response(VariantContainer.to_columns(data))
+    return serialize.stream_rows_response(
+        data, ndjson=response_format == "ndjson"
+    )
+
+
+def _strip_chr(chrom: str) -> str:
+    return chrom[3:] if chrom.startswith("chr") else chrom
+
+
+def _region_files(chrom, start, end, study, tissue):
+    """Data files read by a region query"""
+    datatype = request.args.get("datatype", "ge")
+    return [
+        model.locate_study_tissue_data(study, tissue, datatype=datatype),
+        model.get_credible_interval_path(_strip_chr(chrom), study, tissue),
+    ]
+
+
+def _variant_files(chrom: str, pos: int):
+    """Data files read by a variant query"""
+    chrom = _strip_chr(chrom)
+    datatype = request.args.get("datatype", "ge")
+    study = request.args.get("study", None)
+    tissue = request.args.get("tissue", None)
+    if study and tissue:
+        source = model.locate_study_tissue_data(
+            study, tissue, datatype=datatype
+        )
+    else:
+        source = model.locate_data(chrom, pos, datatype=datatype)
+    return [source, model.get_credible_interval_path(chrom, study, tissue)]
+
+
+def _region_options() -> dict:
+    """Parse the options of a region query (shared by single and batch region queries) from the query parameters"""
+    gene_id = request.args.get("gene_id", None)
+    # Optionally, downsample dense regions to (about) this many points
+    max_points = request.args.get("max_points", None, type=int)
+    if max_points is not None and max_points < 1:
+        abort(400)
+    if gene_id is not None:
+        gene_id = gene_id.split(".")[0]
+    return dict(
+        gene_id=gene_id,
+        transcript=request.args.get("transcript", None),
+        piponly=request.args.get("piponly", None),
+        datatype=request.args.get("datatype", "ge"),
+        max_points=max_points,
+    )
+
+
+def _batch_tracks() -> ty.List[ty.Tuple[str, str]]:
+    """Parse the (study, tissue) tracks of a batch region query, as `track=<study>:<tissue>` query parameters"""
+    tracks = []
+    for track in request.args.getlist("track"):
+        study, _, tissue = track.partition(":")
+        if not study or not tissue:
+            abort(400)
+        tracks.append((study, tissue))
+    if (
+        not tracks
+        or len(tracks) > current_app.config["FIVEX_BATCH_MAX_TRACKS"]
+    ):
+        abort(400)
+    return tracks
+
+
+def _batch_region_files(chrom: str, start: int, end: int):
+    """Data files read by a batch region query"""
+    return [
+        path
+        for study, tissue in _batch_tracks()
+        for path in _region_files(chrom, start, end, study, tissue)
+    ]
+
+
+# A variant as `chrom:pos` or `chrom_pos` (optionally followed by alleles, eg `chr1:12345_A/G`)
+_VARIANT_PATTERN = re.compile(r"^(?:chr)?([0-9]+|X|Y|M|MT)[:_]([0-9]+)")
+_RSID_PATTERN = re.compile(r"^rs[0-9]+$")
+
+
+def _parse_variant(query) -> ty.Union[str, ty.Tuple[str, int]]:
+    """Parse a variant of a batch query, as an rsid (str) or a (chrom, pos) pair"""
+    if isinstance(query, str):
+        query = query.strip()
+        if _RSID_PATTERN.match(query):
+            return query
+        match = _VARIANT_PATTERN.match(query)
+        if match:
+            return match.group(1), int(match.group(2))
+    return abort(400)
+
+
+def _resolve_variants(
+    queries: ty.Sequence,
+) -> ty.List[
+    ty.Tuple[ty.Union[str, ty.Tuple[str, int]], ty.List[model.RsidRecord]]
+]:
+    """
+    Parse the variants of a batch query, and look up the known variants (and rsids) for each, in a few queries
+
+    :return: Each parsed query (an rsid or a (chrom, pos) pair), and the rsid database records that match it
+    """
+    parsed = [_parse_variant(query) for query in queries]
+    rsids = model.find_rsids(
+        query for query in parsed if isinstance(query, str)
+    )
+    positions = model.find_positions(
+        query for query in parsed if not isinstance(query, str)
+    )
+    return [
+        (
+            query,
+            rsids.get(query, [])
+            if isinstance(query, str)
+            else positions.get(query, []),
+        )
+        for query in parsed
+    ]
+
+
+def _batch_body(max_setting: str) -> ty.Tuple[dict, list]:
+    """Validate the body of a batch request (`{"variants": [...], ...}`), and the number of variants that it holds"""
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict) or not isinstance(
+        body.get("variants"), list
+    ):
+        abort(400)
+    queries = body["variants"]
+    if len(queries) > current_app.config[max_setting]:
+        abort(400)
+    return body, queries
+
+
+def _rsid_dict(record: model.RsidRecord) -> dict:
+    return dict(
+        zip(
+            ("chromosome", "position", "ref_allele", "alt_allele", "rsid"),
+            record,
+        )
+    )
+
+
+def _credible_set_files(chrom: str, start: int, end: int):
+    """Data files read by a credible set table query"""
+    datatype = request.args.get("datatype", "ge")
+    return [model.get_credible_data_table(_strip_chr(chrom), datatype)]
+
+
 @api_blueprint.route(
     "/region/<string:chrom>/<int:start>-<int:end>/<string:study>/<string:tissue>/",
     methods=["GET"],
 )
+@conditional(_region_files)
+@cached(_region_files)
 def region_query(chrom, start, end, study, tissue):
     """
     Fetch the eQTL data for a given region, optionally filtering by tissue and gene_id
 
     In its current form, this allows fetching ALL points across any gene and tissue. We may wish to revisit this
     due to performance considerations. (FIXME)
+
+    The response is streamed as rows are read. Use `?format=ndjson` to receive newline-delimited JSON (one row per
+    line), or `?format=columnar` to receive one (possibly dictionary-encoded) array per field, instead of a single
+    `{"data": [...]}` document.
+
+    Use `?max_points=N` to downsample wide regions: the region is divided into N bins, and only the most significant
+    point in each bin is returned (along with any points in a credible set).
     """
     # Study and tissue are now both required parameters
-    gene_id = request.args.get("gene_id", None)
-    transcript = request.args.get("transcript", None)
-    piponly = request.args.get("piponly", None)
-    datatype = request.args.get("datatype", "ge")
-    if gene_id is not None:
-        gene_id = gene_id.split(".")[0]
+    data = query_variants(
+        chrom=chrom,
+        start=start,
+        end=end,
+        study=study,
+        tissue=tissue,
+        **_region_options(),
+    )
+    # Each item also receives a synthetic "id" field
+    return _variants_response(data)
 
-    data = [
-        res.to_dict()
-        for res in query_variants(
-            chrom=chrom,
-            start=start,
-            rowstoskip=1,  # Region query uses the original EBI data files, which all have a header row
-            end=end,
-            study=study,
-            tissue=tissue,
-            gene_id=gene_id,
-            transcript=transcript,
-            piponly=piponly,
-            datatype=datatype,
-        )
-    ]
 
-    for i, item in enumerate(data):
-        # TODO: This may be unnecessary when we have a proper marker or variant field
-        item["id"] = i
+@api_blueprint.route(
+    "/region/<string:chrom>/<int:start>-<int:end>/", methods=["GET"],
+)
+@conditional(_batch_region_files)
+@cached(_batch_region_files)
+def region_query_batch(chrom: str, start: int, end: int):
+    """
+    Fetch the eQTL data for one region in several tissues at once, eg to compare tracks in the region view
 
-    results = {"data": data}
-    return jsonify(results)
+    Each track is given as a `track=<study>:<tissue>` query parameter (repeated once per track). All other options
+    (gene_id, transcript, piponly, datatype, max_points) are the same as for a single region query, and apply to every
+    track. The response holds one item per track, in the order requested:
+    `{"data": [{"study": ..., "tissue": ..., "data": [rows...]}, ...]}`. Use `?format=columnar` to receive the data of
+    each track as columns.
+    """
+    tracks = _batch_tracks()
+    options = _region_options()
+    response_format = request.args.get("format")
+    if response_format not in (None, "json", "columnar"):
+        # Grouped results can not be streamed as newline-delimited JSON
+        return abort(400)
+
+    results = query_tracks(
+        tracks, chrom=chrom, start=start, end=end, **options
+    )
+    columnar = response_format == "columnar"
+    return serialize.grouped_response(
+        (
+            (
+                {"study": study, "tissue": tissue},
+                VariantContainer.to_columns(data) if columnar else data,
+            )
+            for (study, tissue), data in zip(tracks, results)
+        ),
+        columnar=columnar,
+    )
 
 
 @api_blueprint.route(
     "/best/region/<string:chrom>/<int:start>-<int:end>/", methods=["GET"]
 )
+@conditional()
+@cached()
 def region_query_bestvar(chrom: str, start: int, end: int):
     """
     Given a region, returns the tissue with the strongest single eQTL signal, along with gene symbol and gene_id.
@@ -97,11 +294,14 @@ def region_query_bestvar(chrom: str, start: int, end: int):
 
 
 @api_blueprint.route("/variant/<string:chrom>_<int:pos>/", methods=["GET"])
+@conditional(_variant_files)
+@cached(_variant_files)
 def variant_query(chrom: str, pos: int):
     """
     Fetch the data for a single variant (for a PheWAS plot)
 
-    This can optionally filter by gene or tissue, but by default it returns all data.
+    This can optionally filter by gene or tissue, but by default it returns all data. As with region queries, the
+    response is streamed, and `?format=ndjson` or `?format=columnar` select alternative response formats.
     """
     tissue = request.args.get("tissue", None)
     gene_id = request.args.get("gene_id", None)
@@ -111,41 +311,127 @@ def variant_query(chrom: str, pos: int):
         "study", None
     )  # We now have data from multiple studies from EBI
 
-    data = [
-        res.to_dict()
-        for res in query_variants(
-            chrom=chrom,
-            start=pos,
-            rowstoskip=0,
-            end=None,
-            tissue=tissue,
-            study=study,
-            gene_id=gene_id,
-            transcript=transcript,
-            datatype=datatype,
-        )
+    data = query_variants(
+        chrom=chrom,
+        start=pos,
+        end=None,
+        tissue=tissue,
+        study=study,
+        gene_id=gene_id,
+        transcript=transcript,
+        datatype=datatype,
+    )
+    # FIXME: replace the synthetic "id" field with some other unique identifier (like a marker)
+    return _variants_response(data)
+
+
+@api_blueprint.route("/variants/", methods=["POST"])
+def variant_query_batch():
+    """
+    Fetch the data for many variants at once, with the same results as one single-variant query per variant
+
+    The request body is a JSON object: `{"variants": [...], ...}`. Each variant is given as `chrom:pos` (or `chrom_pos`,
+    as in variant URLs), or as an rsid. The optional fields study, tissue, gene_id, transcript, and datatype are the
+    same as the query parameters of a single-variant query, and apply to every variant.
+
+    The response holds one item per variant (and per position, for an rsid that matches several), in the order
+    requested: `{"data": [{"variant": ..., "chromosome": ..., "position": ..., "data": [rows...]}, ...]}`. Variants
+    that can not be found have a null chromosome and position, and no rows. Use `?format=columnar` to receive the data of
+    each variant as columns.
+    """
+    body, queries = _batch_body("FIVEX_BATCH_MAX_VARIANTS")
+    response_format = request.args.get("format")
+    if response_format not in (None, "json", "columnar"):
+        return abort(400)
+    options = {
+        name: body.get(name)
+        for name in ("study", "tissue", "gene_id", "transcript")
+    }
+    datatype = body.get("datatype") or "ge"
+    if datatype not in ("ge", "txrev") or not all(
+        value is None or isinstance(value, str) for value in options.values()
+    ):
+        return abort(400)
+
+    # Each query resolves to zero or more (chrom, pos) pairs. A position is queried even if it is not in the rsid
+    #   database, as a single-variant query would be.
+    resolved = [
+        list(dict.fromkeys(record[:2] for record in records))
+        if isinstance(query, str)
+        else [query]
+        for query, records in _resolve_variants(queries)
     ]
+    results = query_positions(
+        (variant for variants in resolved for variant in variants),
+        datatype=datatype,
+        **options,
+    )
 
-    for i, item in enumerate(data):
-        # FIXME: replace this synthetic field with some other unique identifier (like a marker)
-        item["id"] = i
+    columnar = response_format == "columnar"
+    groups = []
+    for query, variants in zip(queries, resolved):
+        for chrom, pos in variants or [(None, None)]:
+            data = results.get((chrom, pos), [])
+            groups.append(
+                (
+                    {"variant": query, "chromosome": chrom, "position": pos},
+                    VariantContainer.to_columns(data) if columnar else data,
+                )
+            )
+    return serialize.grouped_response(groups, columnar=columnar)
 
-    results = {"data": data}
-    return jsonify(results)
+
+@api_blueprint.route("/rsid/<string:query>/", methods=["GET"])
+@conditional()
+@cached()
+def rsid_query(query: str):
+    """
+    Look up a variant by rsid (eg `rs12740374`), or the rsids of a position (eg `1:109274968`)
+
+    Returns every matching variant (there may be several, or none): `{"data": [{"chromosome": ..., "position": ...,
+    "ref_allele": ..., "alt_allele": ..., "rsid": ...}, ...]}`
+    """
+    ((_, records),) = _resolve_variants([query])
+    return serialize.json_response(
+        serialize.dumps({"data": [_rsid_dict(record) for record in records]})
+    )
+
+
+@api_blueprint.route("/rsid/", methods=["POST"])
+def rsid_query_batch():
+    """
+    Look up many rsids and/or positions at once, eg to resolve a pasted list of rsids
+
+    The request body is a JSON object: `{"variants": [...]}`, where each variant is an rsid, or a position as
+    `chrom:pos` (or `chrom_pos`). The response holds one item per variant, in the order requested, with every matching
+    record: `{"data": [{"variant": ..., "data": [{"chromosome": ..., "rsid": ..., ...}, ...]}, ...]}`
+    """
+    _, queries = _batch_body("FIVEX_BATCH_MAX_LOOKUPS")
+    data = [
+        {"variant": query, "data": [_rsid_dict(record) for record in records]}
+        for query, (_, records) in zip(queries, _resolve_variants(queries))
+    ]
+    return serialize.json_response(serialize.dumps({"data": data}))
 
 
 @api_blueprint.route(
     "/cs/<string:chrom>/<int:start>-<int:end>/", methods=["GET"]
 )
+@conditional(_credible_set_files)
+@cached(_credible_set_files)
 def region_data_for_region_table(chrom: str, start: int, end: int):
     """
     Fetch the data for a region to populate the table in region view
     Retrieves all data from the chromosome-specific merged credible_sets file
     """
+    chrom = _strip_chr(chrom)
     datatype = request.args.get("datatype", "ge")
     gene_id = request.args.get("gene_id", None)
+    # The internal data storage does not include gene versions
+    if gene_id:
+        gene_id = gene_id.split(".")[0]
     source = model.get_credible_data_table(chrom, datatype)
-    reader = readers.TabixReader(
+    reader = PooledTabixReader(
         source=source, parser=CIParser(study=None, tissue=None), skip_rows=0,
     )
     if gene_id is not None:
@@ -175,7 +461,7 @@ def region_data_for_region_table(chrom: str, start: int, end: int):
     # cs_log10bf: float
 
     # The CI file contains a variety of information that is not used by the table; limit what gets sent to the frontend
-    subset_fields = {
+    subset_fields = (
         "study",
         "tissue",
         "gene_id",
@@ -191,7 +477,8 @@ def region_data_for_region_table(chrom: str, start: int, end: int):
         "beta",
         "stderr_beta",
         "symbol",
-    }
-    data = [{k: getattr(row, k) for k in subset_fields} for row in ciRows]
+    )
+    get_fields = operator.attrgetter(*subset_fields)
+    data = [dict(zip(subset_fields, get_fields(row))) for row in ciRows]
     results = {"data": data}
-    return jsonify(results)
+    return serialize.json_response(serialize.dumps(results))
@@ -1,12 +1,18 @@
-import dataclasses as dc
-import gzip
-import json
+import itertools
 import math
+import operator
+import os
+import sys
 import typing as ty
 
-from zorp import parser_utils, readers  # type: ignore
+import numpy as np
+from flask import current_app
+from zorp import parser_utils  # type: ignore
 
-from .. import model
+from .. import columnar, credible_sets, model
+from ..cache import LRUCache
+from ..columnar import ColumnarTable, ColumnBlock
+from ..tabix import get_tabix_pool
 
 try:
     # Optional speedup features
@@ -208,6 +214,10 @@ TISSUES_PER_STUDY = {
 }
 
 
+# Number of lines parsed at once when reading data from tabix files
+BATCH_SIZE = 10000
+
+
 def position_to_variant_id(
     chromosome: str, position: int, ref_allele: str, alt_allele: str
 ) -> str:
@@ -215,10 +225,12 @@ def position_to_variant_id(
     return f"{chromosome}:{position:,}_{ref_allele}/{alt_allele}"
 
 
-@dc.dataclass
 class CIContainer:
     """
     Represents the data for credible intervals
+
+    Queries can return many rows, so this is a compact `__slots__` class rather than a dataclass. `variant_id` is
+    derived from the other fields when it is needed.
     """
 
     # Study and tissue are not present in study- and tissue-specific files -- these two fields are only present in merged files
@@ -249,29 +261,78 @@ class CIContainer:
     cs_log10bf: float
 
     # Extra fields after data joining
-    ma_samples: ty.Optional[int] = None
-    maf: ty.Optional[float] = None
-    log_pvalue: ty.Optional[float] = None
-    beta: ty.Optional[float] = None
-    stderr_beta: ty.Optional[float] = None
-
-    type: ty.Optional[str] = None
-    ac: ty.Optional[int] = None
-    an: ty.Optional[int] = None
+    ma_samples: ty.Optional[int]
+    maf: ty.Optional[float]
+    log_pvalue: ty.Optional[float]
+    beta: ty.Optional[float]
+    stderr_beta: ty.Optional[float]
+
+    type: ty.Optional[str]
+    ac: ty.Optional[int]
+    an: ty.Optional[int]
     # The r2 field may contain 'NA's -- see note in VariantContainers
-    r2: ty.Optional[float] = None
-    mol_trait_obj_id: ty.Optional[str] = None
-
-    gid: ty.Optional[str] = None
-    median_tpm: ty.Optional[float] = None
-    rsid: ty.Optional[str] = None
-    symbol: ty.Optional[str] = None
-
-    variant_id: str = dc.field(init=False)
+    r2: ty.Optional[float]
+    mol_trait_obj_id: ty.Optional[str]
+
+    gid: ty.Optional[str]
+    median_tpm: ty.Optional[float]
+    rsid: ty.Optional[str]
+    symbol: ty.Optional[str]
+
+    __slots__ = (
+        "study",
+        "tissue",
+        "gene_id",
+        "var_id",
+        "chromosome",
+        "position",
+        "ref_allele",
+        "alt_allele",
+        "cs_id",
+        "cs_index",
+        "finemapped_region",
+        "pip",
+        "z",
+        "cs_min_r2",
+        "cs_avg_r2",
+        "cs_size",
+        "posterior_mean",
+        "posterior_sd",
+        "cs_log10bf",
+        "ma_samples",
+        "maf",
+        "log_pvalue",
+        "beta",
+        "stderr_beta",
+        "type",
+        "ac",
+        "an",
+        "r2",
+        "mol_trait_obj_id",
+        "gid",
+        "median_tpm",
+        "rsid",
+        "symbol",
+    )
+    # Calculated fields, which are included in `to_dict` but not stored
+    _derived = ("variant_id",)
+
+    def __init__(self, *args, **kwargs):
+        # Fields from ma_samples onward are optional: they are only present in the joined (merged) files
+        if len(args) > len(self.__slots__):
+            raise TypeError(
+                f"CIContainer takes at most {len(self.__slots__)} fields"
+            )
+        for name, value in zip(self.__slots__, args):
+            setattr(self, name, value)
+        for name in self.__slots__[len(args) :]:
+            setattr(self, name, kwargs.pop(name, None))
+        if kwargs:
+            raise TypeError(f"Unexpected fields: {', '.join(kwargs)}")
 
-    def __post_init__(self):
-        # Add calculated fields
-        self.variant_id = position_to_variant_id(
+    @property
+    def variant_id(self) -> str:
+        return position_to_variant_id(
             self.chromosome, self.position, self.ref_allele, self.alt_allele
         )
 
@@ -286,13 +347,27 @@ class CIContainer:
             return 10 ** -self.log_pvalue
 
     def to_dict(self):
-        return dc.asdict(self)
+        return dict(
+            zip(
+                self.__slots__ + self._derived,
+                _CI_DICT_VALUES(self),  # type: ignore
+            )
+        )
+
+
+# Read every field of a container at once (this is much faster than calling getattr for each field)
+_CI_DICT_VALUES = operator.attrgetter(
+    *(CIContainer.__slots__ + CIContainer._derived)
+)
 
 
-@dc.dataclass
 class VariantContainer:
     """
     Represent the data for a single variant
+
+    Region queries can return tens of thousands of rows, so this is a compact `__slots__` class rather than a
+    dataclass. Fields that are derived from other fields (variant_id, samples, studytissue) are computed when needed,
+    rather than when each row is parsed.
     """
 
     # The fields from here to rsid are read from tabix-indexed files
@@ -319,13 +394,11 @@ class VariantContainer:
     ac: int
     an: int
 
+    # r2, molecular_trait_object_id, and median_tpm are passed to the constructor, but not stored
     # r2: This field may contain 'NA's - we are not using this field at the moment;
     # if we do we will need to parse those NAs
-    r2: dc.InitVar[float]
-    molecular_trait_object_id: dc.InitVar[str]
 
     gene_id: str
-    median_tpm: dc.InitVar[float]
     rsid: str
     # end fields that are read from tabix index
 
@@ -338,25 +411,119 @@ class VariantContainer:
     transcript: str
 
     # Additional optional args with updated fields from SuSiE
-    cs_index: ty.Optional[str] = None
-    cs_size: ty.Optional[int] = None
-    pip: ty.Optional[float] = None
-
-    # Computed properties, not passed as param to init
-    variant_id: str = dc.field(init=False)  # chrom:pos_ref/alt
-    samples: int = dc.field(init=False)
-    studytissue: str = dc.field(init=False)
-
-    def __post_init__(self, a, b, c):
-        # Add calculated fields
-        self.variant_id = position_to_variant_id(
-            self.chromosome, self.position, self.ref_allele, self.alt_allele
-        )
-        self.samples = self.an / 2
+    cs_index: ty.Optional[str]
+    cs_size: ty.Optional[int]
+    pip: ty.Optional[float]
+
+    __slots__ = (
+        "study",
+        "tissue",
+        "txrevise_event",
+        "chromosome",
+        "position",
+        "ref_allele",
+        "alt_allele",
+        "variant",
+        "ma_samples",
+        "maf",
+        "log_pvalue",
+        "beta",
+        "stderr_beta",
+        "vartype",
+        "ac",
+        "an",
+        "gene_id",
+        "rsid",
+        "build",
+        "tss_distance",
+        "tss_position",
+        "symbol",
+        "system",
+        "transcript",
+        "cs_index",
+        "cs_size",
+        "pip",
+    )
+    # Calculated fields, which are included in `to_dict` but not stored
+    _derived = ("variant_id", "samples", "studytissue")
+
+    def __init__(
+        self,
+        study,
+        tissue,
+        txrevise_event,
+        chromosome,
+        position,
+        ref_allele,
+        alt_allele,
+        variant,
+        ma_samples,
+        maf,
+        log_pvalue,
+        beta,
+        stderr_beta,
+        vartype,
+        ac,
+        an,
+        r2,
+        molecular_trait_object_id,
+        gene_id,
+        median_tpm,
+        rsid,
+        build,
+        tss_distance,
+        tss_position,
+        symbol,
+        system,
+        transcript,
+        cs_index=None,
+        cs_size=None,
+        pip=None,
+    ):
+        self.study = study
+        self.tissue = tissue
+        self.txrevise_event = txrevise_event
+        self.chromosome = chromosome
+        self.position = position
+        self.ref_allele = ref_allele
+        self.alt_allele = alt_allele
+        self.variant = variant
+        self.ma_samples = ma_samples
+        self.maf = maf
+        self.log_pvalue = log_pvalue
+        self.beta = beta
+        self.stderr_beta = stderr_beta
+        self.vartype = vartype
+        self.ac = ac
+        self.an = an
+        self.gene_id = gene_id
+        self.rsid = rsid
         # FIXME: why do we accept constructor arg if never used?
         self.build = "GRCh38"
+        self.tss_distance = tss_distance
+        self.tss_position = tss_position
+        self.symbol = symbol
+        self.system = system
+        self.transcript = transcript
+        self.cs_index = cs_index
+        self.cs_size = cs_size
+        self.pip = pip
+
+    @property
+    def variant_id(self) -> str:
+        """chrom:pos_ref/alt"""
+        return position_to_variant_id(
+            self.chromosome, self.position, self.ref_allele, self.alt_allele
+        )
+
+    @property
+    def samples(self) -> float:
+        return self.an / 2
+
+    @property
+    def studytissue(self) -> str:
         # A synthetic field used on the front-end to group together points based on both study and tissue TODO Move to frontend only; this doesn't need to be in the API
-        self.studytissue = f"{self.study}-{self.tissue}"
+        return f"{self.study}-{self.tissue}"
 
     @property
     def pvalue(self):
@@ -369,12 +536,145 @@ class VariantContainer:
             return 10 ** -self.log_pvalue
 
     def to_dict(self):
-        return dc.asdict(self)
+        return dict(
+            zip(
+                self.__slots__ + self._derived,
+                _VARIANT_DICT_VALUES(self),  # type: ignore
+            )
+        )
+
+    @classmethod
+    def to_columns(
+        cls, rows: ty.Iterable["VariantContainer"]
+    ) -> ty.Dict[str, list]:
+        """Convert a sequence of rows to one list per field (the same fields as `to_dict`)"""
+        fields = cls.__slots__ + cls._derived
+        columns = list(zip(*map(_VARIANT_DICT_VALUES, rows)))
+        if not columns:
+            return {field: [] for field in fields}
+        return dict(zip(fields, map(list, columns)))
+
+
+_VARIANT_DICT_VALUES = operator.attrgetter(
+    *(VariantContainer.__slots__ + VariantContainer._derived)
+)
+
+
+# Columns of the credible set files that are used by CIAdder
+_CI_COLUMNS = (
+    "chromosome",
+    "position",
+    "ref_allele",
+    "alt_allele",
+    "study",
+    "tissue",
+    "gene_id",
+    "cs_index",
+    "cs_size",
+    "pip",
+)
+
+
+# Key of a row in the credible set lookup: (chromosome, position, ref, alt, study, tissue, gene_id)
+CIKey = ty.Tuple[str, int, str, str, str, str, str]
+CIValue = ty.Tuple[str, int, float]
+
+# Approximate memory used by one entry of a credible set lookup (the key and value tuples, plus the dict slot)
+_CI_ENTRY_BYTES = 320
+
+_CI_CACHE: ty.Optional[LRUCache] = None
+
+
+def get_credible_set_cache() -> ty.Optional[LRUCache]:
+    """
+    Get the cache of parsed credible set lookups for this worker process, or None if caching is disabled
+
+    The same cache serves both single-variant and region queries.
+    """
+    global _CI_CACHE
+    max_bytes = current_app.config["FIVEX_CREDIBLE_SET_CACHE_BYTES"]
+    if not max_bytes:
+        return None
+    if _CI_CACHE is None or _CI_CACHE.max_bytes != max_bytes:
+        _CI_CACHE = LRUCache(max_bytes)
+    return _CI_CACHE
+
+
+def _load_credible_sets(
+    credible_set_file: str,
+    chrom: str,
+    start: int,
+    end: ty.Optional[int],
+    prefix: ty.Sequence[str],
+    gene_id: ty.Optional[str],
+    positions: ty.Optional[ty.Tuple[int, ...]] = None,
+) -> ty.Dict[CIKey, CIValue]:
+    """
+    Parse the credible set rows for a single variant (if end is None), for several variants (at the given positions
+    within a region), or for one gene in a region
+
+    Only the columns needed to find matching rows are parsed for every row, and the statistics are only parsed for
+    rows that match.
+    """
+    # If the query is single variant, set end to (start + 1)
+    # and use the trick from query_variants to get a single position
+    try:
+        lines = get_tabix_pool().fetch(
+            credible_set_file,
+            chrom,
+            start - 1,
+            start + 1 if end is None else end + 1,
+        )
+    except ValueError:
+        lines = iter([])
+
+    ci_data: ty.Dict[CIKey, CIValue] = {}
+    while True:
+        batch = [line for line in itertools.islice(lines, BATCH_SIZE) if line]
+        if not batch:
+            break
+        raw = columnar.split_lines(
+            batch, columnar.CREDIBLE_SET_COLUMNS, prefix
+        )
+        if end is None:
+            block = columnar.parse_columns(
+                raw, ["position"], columnar.CREDIBLE_SET_COLUMNS
+            )
+            mask = block.values("position") == start
+        elif positions is not None:
+            block = columnar.parse_columns(
+                raw, ["position"], columnar.CREDIBLE_SET_COLUMNS
+            )
+            mask = np.isin(block.values("position"), positions)
+        # If the query is regional, then filter for the gene of interest
+        # and get the study-, tissue-, and gene-specific data from the entire region
+        else:
+            block = columnar.parse_columns(
+                raw, ["gene_id"], columnar.CREDIBLE_SET_COLUMNS
+            )
+            mask = block.equals("gene_id", gene_id)
+        selection = np.flatnonzero(mask)
+        if not len(selection):
+            continue
+
+        block = columnar.parse_columns(
+            raw,
+            _CI_COLUMNS,
+            columnar.CREDIBLE_SET_COLUMNS,
+            selection=selection,
+        )
+        values = [block.values(name).tolist() for name in _CI_COLUMNS]
+        # Dictionary Format: ci_data[(chrom, pos, ref, alt, study, tissue, gene_id)] = (cs_index, cs_size, pip)
+        ci_data.update(zip(zip(*values[:7]), zip(*values[7:])))
+    return ci_data
 
 
 class CIAdder:
     """
     Add credible set statistics (SuSie PIPs) to a parsed variant container object
+
+    Parsed credible sets are cached per (file, region, gene), in a cache bounded by the estimated memory use of its
+    entries. The cache is keyed on the size and modification time of the file, so that updated data is read again.
     """
 
     def __init__(
@@ -387,71 +687,97 @@ class CIAdder:
         study=None,
         tissue=None,
         gene_id=None,
+        positions: ty.Optional[ty.Sequence[int]] = None,
     ):
-        ci_data = {}
-        if study is None:
-            rowstoskip = 0
+        if study and tissue:
+            # Tissue-and-study-specific files have two fewer columns (study and tissue)
+            prefix = [study, tissue]
         else:
-            rowstoskip = 1
-        reader = readers.TabixReader(
-            source=credible_set_file,
-            parser=CIParser(study=study, tissue=tissue),
-            skip_rows=rowstoskip,
+            prefix = []
+        # Variant queries match on position alone, so the gene is not part of their key
+        position_key = tuple(positions) if positions is not None else None
+        gene_key = None if end is None or positions is not None else gene_id
+        arguments = (
+            credible_set_file,
+            chrom,
+            start,
+            end,
+            prefix,
+            gene_key,
+            position_key,
         )
 
-        # If the query is single variant, set end to (start + 1)
-        # and use the trick from query_variants to get a single position
-        readFlag = True
-        if end is None:
-            reader.add_filter("position", start)
-            try:
-                ciRows = reader.fetch(chrom, start - 1, start + 1)
-            except ValueError:
-                readFlag = False
-        # If the query is regional, then filter for the gene of interest
-        # and get the study-, tissue-, and gene-specific data from the entire region
-        else:
-            reader.add_filter("gene_id", gene_id)
-            try:
-                ciRows = reader.fetch(chrom, start - 1, end + 1)
-            except ValueError:
-                readFlag = False
-        if readFlag:
-            for row in ciRows:
-                key = ":".join(
-                    [
-                        row.chromosome,
-                        str(row.position),
-                        row.ref_allele,
-                        row.alt_allele,
-                        row.study,
-                        row.tissue,
-                        row.gene_id,
-                    ]
+        cache = get_credible_set_cache()
+        if cache is None:
+            self.ci_data = _load_credible_sets(*arguments)
+            return
+        try:
+            stat = os.stat(credible_set_file)
+            identity: ty.Tuple = (stat.st_size, stat.st_mtime_ns)
+        except FileNotFoundError:
+            identity = ()
+        key = (
+            credible_set_file,
+            identity,
+            chrom,
+            start,
+            end,
+            gene_key,
+            position_key,
+        )
+        ci_data = cache.get(key)
+        if ci_data is None:
+            ci_data = _load_credible_sets(*arguments)
+            cache.put(key, ci_data, size=_CI_ENTRY_BYTES * (len(ci_data) + 1))
+        self.ci_data = ci_data
+
+    def members(self, block: ColumnBlock) -> np.ndarray:
+        """A boolean mask of the rows in a block of association data that are in a credible set (pip > 0)"""
+        mask = np.zeros(len(block), dtype=bool)
+        keys = {key for key, (_, _, pip) in self.ci_data.items() if pip > 0}
+        if not keys:
+            return mask
+        # Only build keys for rows at one of the credible set positions
+        positions = [key[1] for key in keys]
+        candidates = np.flatnonzero(
+            np.isin(block.values("position"), positions)
+        )
+        subset = block.take(candidates)
+        for index, key in zip(
+            candidates.tolist(),
+            zip(
+                *(
+                    subset.values(name).tolist()
+                    for name in (
+                        "chromosome",
+                        "position",
+                        "ref_allele",
+                        "alt_allele",
+                        "study",
+                        "tissue",
+                        "gene_id",
+                    )
                 )
-                # Dictionary Format: ci_Dict[chrom:pos:ref:alt:study:tissue:gene_id] = (cs_index, cs_size, pip)
-                ci_data[key] = (row.cs_index, row.cs_size, row.pip)
-            self.ci_data = ci_data
-        else:
-            self.ci_data = {}
+            ),
+        ):
+            mask[index] = key in keys
+        return mask
 
     def __call__(self, variant: VariantContainer) -> VariantContainer:
         default = ("-", 0, 0.0)
-        if self.ci_data == {}:
+        if not self.ci_data:
             # cs_index is our new cluster (L1 or L2); we will repurpose spip with cs_size for the size of the cluster
             (cs_index, cs_size, pip) = default
         else:
             (cs_index, cs_size, pip) = self.ci_data.get(
-                ":".join(
-                    [
-                        variant.chromosome,
-                        str(variant.position),
-                        variant.ref_allele,
-                        variant.alt_allele,
-                        variant.study,
-                        variant.tissue,
-                        variant.gene_id,
-                    ]
+                (
+                    variant.chromosome,
+                    variant.position,
+                    variant.ref_allele,
+                    variant.alt_allele,
+                    variant.study,
+                    variant.tissue,
+                    variant.gene_id,
                 ),
                 default,  # Some variants may lack information
             )
@@ -532,14 +858,13 @@ class CIParser:
 
 class VariantParser:
     def __init__(self, tissue=None, study=None, pipDict=None, datatype=None):
-        # We only need to load the gene locator once per usage, not on every line parsed
+        # The gene name lookup is shared by all requests, and only loaded from disk once per process
         self.gene_json = model.get_gene_names_conversion()
         self.tissue = tissue
         self.study = study
         self.pipDict = pipDict
         self.datatype = datatype
-        with gzip.open(model.locate_tss_data(), "rb") as f:
-            self.tss_dict = json.load(f)
+        self.tss_index = model.get_tss_index()
 
     def __call__(self, row: str) -> VariantContainer:
 
@@ -609,9 +934,9 @@ class VariantParser:
         build = "GRCh38"
 
         # Append tss_distance
-        gene_tss = self.tss_dict.get(fields[18].split(".")[0], float("nan"))
-        tss_distance = math.copysign(1, gene_tss) * (fields[4] - abs(gene_tss))
-        tss_position = -abs(gene_tss)
+        strand, gene_tss = self.tss_index.lookup(fields[18].split(".")[0])
+        tss_distance = strand * (fields[4] - gene_tss)
+        tss_position = -gene_tss
 
         # Append gene symbol
         geneSymbol = self.gene_json.get(
@@ -642,20 +967,295 @@ class VariantParser:
         return VariantContainer(*fields)
 
 
+def _integers(values: np.ndarray) -> list:
+    """Convert an array of floats to a list of ints, leaving any nan values as they are"""
+    if np.isnan(values).any():
+        return [
+            value if math.isnan(value) else int(value)
+            for value in values.tolist()
+        ]
+    return values.astype(np.int64).tolist()
+
+
+def _none_if_nan(values: np.ndarray) -> list:
+    return [None if math.isnan(value) else value for value in values.tolist()]
+
+
+def _map_distinct(
+    values: ty.Iterable[ty.Hashable], func: ty.Callable
+) -> ty.List[ty.Any]:
+    """Apply a function to a sequence that has few distinct values, calling the function once per distinct value"""
+    results: dict = {}
+    return [
+        results[value]
+        if value in results
+        else results.setdefault(value, func(value))
+        for value in values
+    ]
+
+
+# Fields of `VariantContainer` that are not used after parsing. These do not need to be read in batch mode.
+_UNUSED_COLUMNS = ("r2", "molecular_trait_object_id", "median_tpm")
+
+
+def variants_from_block(
+    block: ColumnBlock, datatype: str = "ge"
+) -> ty.List[VariantContainer]:
+    """
+    Build variant containers for every row in a block of association data (see `fivex.columnar`)
+
+    This produces the same results as `VariantParser`, but the derived fields (TSS distance, gene symbol, tissue
+    system, and transcript) are computed once per block, or once per distinct value, rather than once per row.
+    """
+    gene_json = model.get_gene_names_conversion()
+    count = len(block)
+
+    # Rows share a single (interned) copy of each distinct study, tissue, and gene
+    gene_ids = _map_distinct(block.values("gene_id").tolist(), sys.intern)
+    unversioned_genes = _map_distinct(
+        gene_ids, lambda gene_id: gene_id.split(".")[0]
+    )
+    tss_distance, tss_position = model.get_tss_index().distances(
+        block.values("position"), unversioned_genes
+    )
+    symbols = _map_distinct(
+        unversioned_genes,
+        lambda gene_id: gene_json.get(gene_id, "Unknown_gene"),
+    )
+
+    tissues = _map_distinct(block.values("tissue").tolist(), sys.intern)
+    systems = _map_distinct(
+        tissues, lambda tissue: TISSUES_TO_SYSTEMS.get(tissue, "Unknown")
+    )
+
+    if datatype == "ge":
+        trait_ids = transcripts = [None] * count
+    else:
+        trait_ids = block.values("molecular_trait_id").tolist()
+        transcripts = [trait_id.split(".")[3] for trait_id in trait_ids]
+
+    unused = [
+        block.values(name).tolist()
+        if name in block.columns
+        else [None] * count
+        for name in _UNUSED_COLUMNS
+    ]
+    # Credible set statistics are only present if they were joined onto the file at ingest time
+    credible_set_values = [
+        block.values(name).tolist()
+        if name in block.columns
+        else [None] * count
+        for name, _ in columnar.JOINED_CREDIBLE_SET_COLUMNS
+    ]
+    return [
+        VariantContainer(*fields)
+        for fields in zip(
+            _map_distinct(block.values("study").tolist(), sys.intern),
+            tissues,
+            trait_ids,
+            block.values("chromosome").tolist(),
+            block.values("position").tolist(),
+            block.values("ref_allele").tolist(),
+            block.values("alt_allele").tolist(),
+            block.values("variant").tolist(),
+            block.values("ma_samples").tolist(),
+            block.values("maf").tolist(),
+            _none_if_nan(block.values("log_pvalue")),
+            block.values("beta").tolist(),
+            block.values("stderr_beta").tolist(),
+            block.values("vartype").tolist(),
+            block.values("ac").tolist(),
+            block.values("an").tolist(),
+            unused[0],
+            unused[1],
+            gene_ids,
+            unused[2],
+            block.values("rsid").tolist(),
+            ["GRCh38"] * count,
+            _integers(tss_distance),
+            _integers(tss_position),
+            symbols,
+            systems,
+            transcripts,
+            *credible_set_values,
+        )
+    ]
+
+
+# Columns that are needed to decide whether a row of association data will be returned
+_FILTER_COLUMNS = (
+    "position",
+    "maf",
+    "gene_id",
+    "molecular_trait_id",
+    "log_pvalue",
+)
+
+
+def _filter_mask(
+    block: ColumnBlock,
+    start: int,
+    *,
+    end: ty.Optional[int] = None,
+    gene_id: ty.Optional[str] = None,
+    transcript: ty.Optional[str] = None,
+    piponly: bool = False,
+    datatype: str = "ge",
+    positions: ty.Optional[ty.Sequence[int]] = None,
+) -> np.ndarray:
+    """Apply the query filters to whole columns at once, and return a boolean mask of the rows to keep"""
+    mask = block.values("maf") > 0.0
+    if end is None:
+        # Small hack: when asking for a single point, Pysam sometimes returns more data than expected for half-open
+        # intervals. Filter out extraneous information
+        mask &= block.values("position") == start
+    elif positions is not None:
+        mask &= np.isin(block.values("position"), positions)
+    if gene_id:
+        mask &= block.equals("gene_id", gene_id)
+    if transcript:
+        if datatype == "ge":
+            # Gene expression data has no transcripts
+            mask[:] = False
+        else:
+            trait_ids = block.values("molecular_trait_id")
+            mask &= np.array(
+                [
+                    trait_id.split(".")[3] == transcript
+                    for trait_id in trait_ids.tolist()
+                ],
+                dtype=bool,
+            ).reshape(-1)
+    # Only points which are genomewide significant (p-value < 5e-8); the PIP filter is applied after CIAdder
+    if piponly:
+        mask &= block.values("log_pvalue") > 7.30103
+    return mask
+
+
+def _tabix_blocks(
+    lines: ty.Iterator[str],
+    prefix: ty.Sequence[str],
+    columns: ty.List[ty.Tuple[str, str]],
+    **filters,
+) -> ty.Iterator[ColumnBlock]:
+    """
+    Parse lines of association data from a tabix file in batches. The filter columns are parsed first, and the rest
+    of each row is only parsed if the row passes the filters.
+    """
+    while True:
+        batch = [line for line in itertools.islice(lines, BATCH_SIZE) if line]
+        if not batch:
+            return
+        raw = columnar.split_lines(batch, columns, prefix)
+        block = columnar.parse_columns(raw, _FILTER_COLUMNS, columns)
+        selection = np.flatnonzero(_filter_mask(block, **filters))
+        if len(selection):
+            yield columnar.parse_columns(
+                raw,
+                [name for name, _ in columns if name not in _UNUSED_COLUMNS],
+                columns,
+                # When every row passes the filters, there is no need to select rows
+                selection=selection if len(selection) < len(batch) else None,
+            )
+
+
+def thin_mask(
+    positions: np.ndarray,
+    log_pvalues: np.ndarray,
+    start: int,
+    end: int,
+    max_points: int,
+) -> np.ndarray:
+    """
+    Downsample points for display: divide [start, end] into `max_points` bins of equal width, and select the most
+    significant point in each bin. Returns a boolean mask of the selected points.
+    """
+    mask = np.zeros(len(positions), dtype=bool)
+    if not len(positions):
+        return mask
+    width = max(end - start + 1, 1)
+    bins = np.clip(
+        (positions - start) * max_points // width, 0, max_points - 1
+    )
+    # Sort by bin, then by descending significance (missing p-values last), and take the first point in each bin
+    order = np.lexsort((-log_pvalues, bins))
+    sorted_bins = bins[order]
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = sorted_bins[1:] != sorted_bins[:-1]
+    mask[order[first]] = True
+    return mask
+
+
+def _thin_blocks(
+    blocks: ty.Iterable[ColumnBlock],
+    start: int,
+    end: int,
+    max_points: int,
+    members: ty.Callable[[ColumnBlock], np.ndarray],
+) -> ty.Iterator[ColumnBlock]:
+    """
+    Downsample blocks of rows (see `thin_mask`), always keeping credible set members (as found by `members`)
+
+    Each block is thinned as it is read, so that at most `max_points` rows (plus credible set members) per block are
+    held at once; the combined result is then thinned again.
+    """
+
+    def thin(block: ColumnBlock) -> ColumnBlock:
+        if not len(block):
+            return block
+        mask = thin_mask(
+            block.values("position"),
+            block.values("log_pvalue"),
+            start,
+            end,
+            max_points,
+        )
+        return block.take(mask | members(block))
+
+    block = thin(columnar.concatenate([thin(block) for block in blocks]))
+    for offset in range(0, len(block), BATCH_SIZE):
+        yield block.take(slice(offset, offset + BATCH_SIZE))
+
+
+def _has_joined_credible_sets(
+    source: str, table: ty.Optional[ColumnarTable], prefix: ty.Sequence[str]
+) -> bool:
+    """Whether an association file has credible set statistics joined on at ingest time (see `fivex.credible_sets`)"""
+    if table is not None:
+        return "pip" in table.meta["columns"]
+    return model.count_columns(source) + len(prefix) == len(
+        columnar.JOINED_ASSOCIATION_COLUMNS
+    )
+
+
 def query_variants(
     chrom: str,
     start: int,
-    rowstoskip: int,
-    end: int = None,
-    study: str = None,
-    tissue: str = None,
-    gene_id: str = None,
-    transcript: str = None,
+    end: ty.Optional[int] = None,
+    study: ty.Optional[str] = None,
+    tissue: ty.Optional[str] = None,
+    gene_id: ty.Optional[str] = None,
+    transcript: ty.Optional[str] = None,
     piponly: bool = False,
     datatype: str = "ge",
-) -> ty.Iterable[VariantContainer]:
+    max_points: ty.Optional[int] = None,
+    positions: ty.Optional[ty.Sequence[int]] = None,
+    ci_adder: ty.Optional["CIAdder"] = None,
+) -> ty.Iterator[VariantContainer]:
     """
     Fetch expression data for one or more variants, and apply optional filters
+
+    For region queries, `max_points` limits the number of rows returned: see `thin_mask`. Rows that are in a credible
+    set are always returned.
+
+    To fetch several variants at once, give a region that covers them all and their `positions`. Rows are returned as
+    if each variant was queried alone (credible sets are matched by position, not by gene), in one scan of the region.
+    The credible sets of these variants can be given as `ci_adder` (loaded for a larger set of positions), so that
+    several queries in the same file share them.
+
+    Rows are read and parsed lazily, one batch at a time, so that a large region can be streamed without holding
+    every row in memory. The file lookup happens immediately; the returned iterator must be consumed within the
+    same application context.
     """
     # Our previous tabix file happens to use `chr1` format, but the full EBI dataset does not
     # We will need to uncomment the next two lines if a dataset uses the 'chr' prefix
@@ -675,71 +1275,244 @@ def query_variants(
     else:
         source = model.locate_data(chrom, start, datatype=datatype)
 
-    # Directly pass this PIP dictionary to VariantParser to add cluster, SPIP, and PIP values to data points
-    reader = readers.TabixReader(
-        # The new EBI data format has no header row for the merged files, but a header row for the original data
-        source,
-        parser=VariantParser(tissue=tissue, study=study, datatype=datatype),
-        skip_rows=rowstoskip,
-    )
-
-    # If querying a single variant, then end, tissue, and gene_id should all be None
-    # if querying a range, then end, tissue, and gene_id must all be defined
-    # get_credible_interval_path will determine the correct file and feed it to CIAdder
-    ci_adder = CIAdder(
-        model.get_credible_interval_path(chrom, study, tissue),
-        chrom,
-        start,
-        end=end,
-        study=study,
-        tissue=tissue,
-        gene_id=gene_id,
-    )
-    reader.add_transform(ci_adder)
+    if study and tissue:
+        # Tissue-and-study-specific files have two fewer columns (study and tissue)
+        prefix = [study, tissue]
+    else:
+        prefix = []
+    table = model.get_columnar_table(source)
+    try:
+        joined = _has_joined_credible_sets(source, table, prefix)
+    except FileNotFoundError:
+        return iter([])
+
+    if joined:
+        ci_adder = None
+    elif ci_adder is None:
+        # If querying a single variant, then end, tissue, and gene_id should all be None
+        # if querying a range, then end, tissue, and gene_id must all be defined
+        # get_credible_interval_path will determine the correct file and feed it to CIAdder
+        ci_adder = CIAdder(
+            model.get_credible_interval_path(
+                chrom,
+                study,
+                tissue,
+                datatype=credible_sets.CREDIBLE_SET_DATATYPE,
+            ),
+            chrom,
+            start,
+            end=end,
+            study=study,
+            tissue=tissue,
+            gene_id=gene_id,
+            positions=positions,
+        )
 
+    # The internal data storage no longer includes gene or transcript version (id.version)
+    # We will modify the input query accordingly to remove any version numbers
     if gene_id:
-        # The internal data storage no longer includes gene version (id.version)
-        # We will modify the input query accordingly to remove any version numbers
-        if "." in gene_id:
-            reader.add_filter("gene_id", gene_id.split(".")[0])
-        else:
-            reader.add_filter("gene_id", gene_id)
-            # reader.add_filter(
-            #     lambda result: result.gene_id.split(".")[0] == gene_id
-            # )
-
+        gene_id = gene_id.split(".")[0]
     if transcript:
-        if "." in transcript:
-            reader.add_filter("transcript", transcript.split(".")[0])
-        else:
-            reader.add_filter("transcript", transcript)
-
-    if end is None:
-        # Small hack: when asking for a single point, Pysam sometimes returns more data than expected for half-open
-        # intervals. Filter out extraneous information
-        reader.add_filter("position", start)
+        transcript = transcript.split(".")[0]
 
-    reader.add_filter("maf")
-    reader.add_filter(lambda result: result.maf > 0.0)
+    filters: ty.Dict[str, ty.Any] = dict(
+        end=end,
+        gene_id=gene_id,
+        transcript=transcript,
+        piponly=piponly,
+        datatype=datatype,
+        positions=positions,
+    )
+    if table is not None:
+        # Match the rows returned by the tabix query for [start - 1, end + 1)
+        region = (chrom, start, start if end is None else end + 1)
+        # Filter on the (compact) filter columns first, and only read the other columns for rows that pass
+        selection = np.flatnonzero(
+            _filter_mask(
+                table.fetch(*region, columns=_FILTER_COLUMNS), start, **filters
+            )
+        )
+        block = table.fetch(*region, selection=selection)
+        # Split the result so that only one batch of row objects exists at a time
+        blocks: ty.Iterable[ColumnBlock] = (
+            block.take(slice(offset, offset + BATCH_SIZE))
+            for offset in range(0, len(block), BATCH_SIZE)
+        )
+    else:
+        gene_index = (
+            model.get_gene_index(source)
+            if gene_id and end is not None
+            else None
+        )
+        try:
+            if gene_index is not None and gene_id and end is not None:
+                # Only read the rows for the requested gene, from [start, end + 1] (as in the tabix query below)
+                lines = get_tabix_pool().read_lines_at(
+                    source,
+                    gene_index.offsets(
+                        gene_id, chrom, start, end + 1
+                    ).tolist(),
+                )
+            else:
+                lines = get_tabix_pool().fetch(
+                    source,
+                    chrom,
+                    start - 1,
+                    start + 1 if end is None else end + 1,
+                )
+        except (ValueError, FileNotFoundError):
+            return iter([])
+        columns = (
+            columnar.JOINED_ASSOCIATION_COLUMNS
+            if joined
+            else columnar.ASSOCIATION_COLUMNS
+        )
+        blocks = _tabix_blocks(lines, prefix, columns, start=start, **filters)
+
+    if max_points and end is not None:
+        blocks = _thin_blocks(
+            blocks,
+            start,
+            end,
+            max_points,
+            ci_adder.members
+            if ci_adder is not None
+            else lambda block: block.values("pip") > 0.0,
+        )
 
+    variants: ty.Iterator[VariantContainer] = (
+        variant
+        for block in blocks
+        for variant in variants_from_block(block, datatype)
+    )
+    if ci_adder is not None:
+        # Add cluster, SPIP, and PIP values to data points
+        variants = map(ci_adder, variants)
     # PIP === 0.0 only if the data point is missing in the DAP-G database.
     # Using this filter returns only points which are found in the DAP-G database,
     # and only for points which are genomewide significant (p-value < 5e-8)
     if piponly:
-        reader.add_filter("pip")
-        reader.add_filter(lambda result: result.pip > 0.0)
-        reader.add_filter("log_pvalue")
-        reader.add_filter(lambda result: result.log_pvalue > 7.30103)
+        variants = (
+            variant
+            for variant in variants
+            if variant.pip is not None and variant.pip > 0.0
+        )
+    return variants
 
-    if end is None:
-        # Single variant query
-        try:
-            return reader.fetch(chrom, start - 1, start + 1)
-        except (ValueError, FileNotFoundError):
-            return []
-    else:
-        # Region query
+
+def query_tracks(
+    tracks: ty.Sequence[ty.Tuple[str, str]], **kwargs
+) -> ty.List[ty.List[VariantContainer]]:
+    """
+    Run the same region query for several (study, tissue) tracks, and return the results in the same order as the
+    tracks
+
+    The tracks are read one after another, in the request's own thread (or greenlet). Production workers use gevent,
+    where file reads and decompression block the whole worker process, so a thread pool would not read the files in
+    parallel.
+
+    :param kwargs: The options of `query_variants` (except study and tissue)
+    """
+    return [
+        list(query_variants(study=study, tissue=tissue, **kwargs))
+        for study, tissue in tracks
+    ]
+
+
+# Variants of a batch query that are at most this far apart (in bp) are read in a single scan of their file. Variants
+#   that are further apart are read with separate seeks: a merged 1Mb chunk holds every study, tissue and gene, so a
+#   single scan from the first to the last variant would read (and decompress) millions of rows that are not needed.
+SCAN_MERGE_DISTANCE = 1000
+
+
+def _scan_spans(positions: ty.Sequence[int]) -> ty.Iterator[ty.List[int]]:
+    """Group sorted positions into spans, splitting wherever consecutive positions are far apart"""
+    span: ty.List[int] = []
+    for position in positions:
+        if span and position - span[-1] > SCAN_MERGE_DISTANCE:
+            yield span
+            span = []
+        span.append(position)
+    if span:
+        yield span
+
+
+def query_positions(
+    variants: ty.Iterable[ty.Tuple[str, int]],
+    study: ty.Optional[str] = None,
+    tissue: ty.Optional[str] = None,
+    datatype: str = "ge",
+    **kwargs,
+) -> ty.Dict[ty.Tuple[str, int], ty.List[VariantContainer]]:
+    """
+    Fetch the data for many single variants (as for a PheWAS plot), each with the same result as a single-variant
+    query
+
+    Variants are grouped by the file that holds them (for the merged dataset, the 1Mb chunk chosen by
+    `model.locate_data`), so that each file is opened once, and nearby variants are read in a single scan. The
+    credible sets of all the variants in a file are parsed once, in a single scan of the credible set file. Files are
+    read one after another (see `query_tracks`).
+
+    :param variants: (chrom, position) pairs. The "chr" prefix is optional.
+    :param kwargs: Other options of `query_variants` (gene_id and transcript)
+    :return: The rows for each distinct variant (with the "chr" prefix removed), in file order
+    """
+    sources: ty.Dict[ty.Tuple[str, str], ty.Set[int]] = {}
+    for chrom, position in variants:
+        if chrom.startswith("chr"):
+            chrom = chrom[3:]
+        if study and tissue:
+            source = model.locate_study_tissue_data(study, tissue, datatype)
+        else:
+            source = model.locate_data(chrom, position, datatype=datatype)
+        sources.setdefault((source, chrom), set()).add(position)
+
+    results: ty.Dict[ty.Tuple[str, int], ty.List[VariantContainer]] = {}
+    for (source, chrom), positions in sources.items():
+        found: ty.Dict[int, ty.List[VariantContainer]] = {
+            position: [] for position in positions
+        }
+        results.update(
+            ((chrom, position), rows) for position, rows in found.items()
+        )
+        ordered = sorted(positions)
         try:
-            return reader.fetch(chrom, start - 1, end + 1)
-        except (ValueError, FileNotFoundError):
-            return []
+            joined = _has_joined_credible_sets(
+                source,
+                model.get_columnar_table(source),
+                [study, tissue] if study and tissue else [],
+            )
+        except FileNotFoundError:
+            continue
+        ci_adder: ty.Optional[CIAdder] = (
+            None
+            if joined
+            else CIAdder(
+                model.get_credible_interval_path(
+                    chrom,
+                    study,
+                    tissue,
+                    datatype=credible_sets.CREDIBLE_SET_DATATYPE,
+                ),
+                chrom,
+                ordered[0],
+                end=ordered[-1],
+                study=study,
+                tissue=tissue,
+                positions=ordered,
+            )
+        )
+        for span in _scan_spans(ordered):
+            for variant in query_variants(
+                chrom=chrom,
+                start=span[0],
+                end=span[-1],
+                study=study,
+                tissue=tissue,
+                datatype=datatype,
+                positions=span,
+                ci_adder=ci_adder,
+                **kwargs,
+            ):
+                found[variant.position].append(variant)
+    return results
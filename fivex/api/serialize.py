@@ -0,0 +1,205 @@
+"""
+Fast JSON serialization of query results
+
+API responses can hold tens of thousands of rows. Rather than building a list of dicts for every row and passing it
+to `flask.jsonify`, rows are converted and serialized a chunk at a time, so that only one chunk of intermediate dicts
+exists at once. Output has sorted keys and compact separators, like `flask.jsonify`.
+
+Responses can also be streamed: each chunk is sent as soon as it is serialized, so memory use stays flat no matter
+how many rows a query returns. Streamed results can be sent either as the usual `{"data": [...]}` envelope, or as
+newline-delimited JSON (one row per line).
+
+Finally, a columnar response holds one array per field, rather than one object per row. String fields with only a
+few distinct values (like study, tissue, or build) are dictionary-encoded as `{"values": [...], "codes": [...]}`,
+where each code is an index into `values`. This is much smaller than repeating the field names and values for every
+row.
+"""
+import itertools
+import json
+import typing as ty
+
+from flask import current_app, stream_with_context
+
+try:
+    # Optional speedup features
+    import orjson  # type: ignore
+except ImportError:
+    orjson = None  # type: ignore
+
+# Number of rows converted to dicts (and serialized) at once
+CHUNK_SIZE = 2000
+
+NDJSON_MIMETYPE = "application/x-ndjson"
+
+# A string field is dictionary-encoded when there are at least this many rows per distinct value
+DICTIONARY_MIN_REPEATS = 2
+
+
+def dumps(obj: ty.Any) -> bytes:
+    """
+    Serialize an object to JSON
+
+    Note: when orjson is installed, nan and infinity are written as null (as in JavaScript's JSON.stringify), rather
+    than as the non-standard NaN and Infinity tokens.
+    """
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_SORT_KEYS)
+    return json.dumps(obj, sort_keys=True, separators=(",", ":")).encode()
+
+
+def _iter_dicts(
+    rows: ty.Iterable, add_ids: bool
+) -> ty.Iterator[ty.List[dict]]:
+    """Convert rows (objects with a `to_dict` method) to dicts, one chunk at a time"""
+    iterator = iter(rows)
+    index = 0
+    while True:
+        chunk = [
+            row.to_dict() for row in itertools.islice(iterator, CHUNK_SIZE)
+        ]
+        if not chunk:
+            return
+        if add_ids:
+            # TODO: This may be unnecessary when we have a proper marker or variant field
+            for item in chunk:
+                item["id"] = index
+                index += 1
+        yield chunk
+
+
+def iter_rows(rows: ty.Iterable, add_ids: bool = True) -> ty.Iterator[bytes]:
+    """
+    Serialize rows (objects with a `to_dict` method) as the pieces of a JSON array
+
+    :param add_ids: Add a synthetic, sequential "id" field to each row
+    """
+    separator = b"["
+    for chunk in _iter_dicts(rows, add_ids):
+        yield separator + dumps(chunk)[1:-1]
+        separator = b","
+    yield b"[]" if separator == b"[" else b"]"
+
+
+def iter_envelope(
+    rows: ty.Iterable, add_ids: bool = True
+) -> ty.Iterator[bytes]:
+    """Serialize rows as the pieces of the document `{"data": [rows...]}`"""
+    yield b'{"data":'
+    yield from iter_rows(rows, add_ids=add_ids)
+    yield b"}\n"
+
+
+def iter_ndjson(rows: ty.Iterable, add_ids: bool = True) -> ty.Iterator[bytes]:
+    """Serialize rows as newline-delimited JSON, one chunk of lines at a time"""
+    for chunk in _iter_dicts(rows, add_ids):
+        yield b"".join(dumps(item) + b"\n" for item in chunk)
+
+
+def rows_response(rows: ty.Iterable, add_ids: bool = True):
+    """
+    Create a response with the content `{"data": [rows...]}`
+
+    This is equivalent to `jsonify({"data": [row.to_dict() for row in rows]})`, but faster.
+    """
+    return json_response(b"".join(iter_envelope(rows, add_ids=add_ids)))
+
+
+def stream_rows_response(
+    rows: ty.Iterable, add_ids: bool = True, ndjson: bool = False
+):
+    """
+    Create a streaming response from an iterable of rows, which may be a lazy generator
+
+    The rows are consumed while the response is sent, within the request context; a generator that reads from files
+    will hold them open until the response is complete. Once streaming begins, errors can no longer change the
+    response status, so anything that could fail on lookup (eg a missing file) should be checked beforehand.
+
+    :param ndjson: Send newline-delimited JSON (one row per line) instead of a `{"data": [rows...]}` document
+    """
+    if ndjson:
+        pieces = iter_ndjson(rows, add_ids=add_ids)
+        mimetype = NDJSON_MIMETYPE
+    else:
+        pieces = iter_envelope(rows, add_ids=add_ids)
+        mimetype = current_app.config["JSONIFY_MIMETYPE"]
+    return current_app.response_class(
+        stream_with_context(pieces), mimetype=mimetype
+    )
+
+
+def encode_column(values: list) -> ty.Union[list, dict]:
+    """
+    Dictionary-encode a column of strings, if this makes it smaller
+
+    Returns the original list, or `{"values": [distinct values...], "codes": [index of each value...]}`. Missing
+    values (None) are encoded like any other value.
+    """
+    distinct: ty.Dict[ty.Any, int] = {}
+    for value in values:
+        if value not in distinct:
+            if not (value is None or isinstance(value, str)):
+                return values
+            distinct[value] = len(distinct)
+    if not values or len(distinct) * DICTIONARY_MIN_REPEATS > len(values):
+        return values
+    return {
+        "values": list(distinct),
+        "codes": [distinct[value] for value in values],
+    }
+
+
+def columnar_response(columns: ty.Dict[str, list], add_ids: bool = True):
+    """
+    Create a response with the content `{"data": {field: [values...]}}`, dictionary-encoding low-cardinality fields
+
+    Unlike rows, columns cannot be streamed, so the whole result is held in memory; in exchange, it is several times
+    smaller.
+    """
+    return json_response(
+        b'{"data":' + _dump_columns(columns, add_ids=add_ids) + b"}\n"
+    )
+
+
+def _dump_columns(columns: ty.Dict[str, list], add_ids: bool) -> bytes:
+    data = {field: encode_column(values) for field, values in columns.items()}
+    if add_ids:
+        # Match the synthetic "id" field of the row formats
+        data["id"] = list(range(len(next(iter(columns.values()), []))))
+    return dumps(data)
+
+
+def grouped_response(
+    groups: ty.Iterable[ty.Tuple[dict, ty.Any]],
+    columnar: bool = False,
+    add_ids: bool = True,
+):
+    """
+    Create a response with the content `{"data": [{...labels, "data": rows}...]}`, with one item per group of rows
+    (eg one per track of a batch request). Synthetic ids are numbered separately within each group.
+
+    :param groups: Pairs of (labels, rows). Each group's labels are added to its item.
+    :param columnar: The "rows" of each group are columns (`{field: [values...]}`), and are dictionary-encoded like
+        `columnar_response`
+    """
+    pieces = [b'{"data":[']
+    for i, (labels, rows) in enumerate(groups):
+        if i:
+            pieces.append(b",")
+        # Open the labels object, and add the data field to it
+        pieces.append(
+            dumps(labels)[:-1] + (b',"data":' if labels else b'"data":')
+        )
+        if columnar:
+            pieces.append(_dump_columns(rows, add_ids=add_ids))
+        else:
+            pieces.extend(iter_rows(rows, add_ids=add_ids))
+        pieces.append(b"}")
+    pieces.append(b"]}\n")
+    return json_response(b"".join(pieces))
+
+
+def json_response(body: ty.Union[bytes, ty.Iterable[bytes]]):
+    """Wrap serialized JSON in a response object, with the same mimetype as `flask.jsonify`"""
+    return current_app.response_class(
+        body, mimetype=current_app.config["JSONIFY_MIMETYPE"]
+    )
@@ -0,0 +1,212 @@
+"""
+Caching helpers shared by the data access layer
+"""
+import collections
+import hashlib
+import os
+import tempfile
+import threading
+import time
+import typing as ty
+
+
+class LRUCache:
+    """
+    A thread-safe, least-recently-used cache, bounded by the total size (in bytes) of the values it holds
+
+    Sizes are measured with `len()` unless an explicit size is provided when the value is stored.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._items: ty.MutableMapping[
+            ty.Hashable, ty.Tuple[ty.Any, int]
+        ] = collections.OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+        # Counters for monitoring how well the cache is working
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def get(self, key: ty.Hashable, default=None) -> ty.Any:
+        with self._lock:
+            try:
+                value, _ = self._items[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._items.move_to_end(key)  # type: ignore
+            self.hits += 1
+            return value
+
+    def put(
+        self, key: ty.Hashable, value: ty.Any, size: ty.Optional[int] = None
+    ):
+        """Store a value. Values larger than the entire cache are silently skipped."""
+        if size is None:
+            size = len(value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._items:
+                self._bytes -= self._items.pop(key)[1]
+            self._items[key] = (value, size)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, (_, old_size) = self._items.popitem(last=False)  # type: ignore
+                self._bytes -= old_size
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self._bytes = 0
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": len(self._items),
+            "bytes": self._bytes,
+        }
+
+
+class DirectoryCache:
+    """
+    A cache of byte strings stored as files in a directory, which can be shared by several processes
+
+    Each value is written once, atomically, so readers never see a partial file. The directory is bounded by the total
+    size of its files: once it grows past the budget, the oldest files are removed. Errors (eg a full disk) are
+    ignored, and treated as cache misses.
+    """
+
+    # Check the size of the directory after this many writes
+    PRUNE_INTERVAL = 256
+
+    def __init__(self, path: str, max_bytes: int):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._writes = 0
+        os.makedirs(path, exist_ok=True)
+
+    def _file_path(self, key: ty.Hashable) -> str:
+        name = hashlib.sha1(repr(key).encode()).hexdigest()
+        return os.path.join(self.path, name)
+
+    def get(self, key: ty.Hashable) -> ty.Optional[bytes]:
+        try:
+            with open(self._file_path(key), "rb") as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def put(self, key: ty.Hashable, value: bytes):
+        try:
+            fd, temp_path = tempfile.mkstemp(dir=self.path)
+            with os.fdopen(fd, "wb") as f:
+                f.write(value)
+            os.replace(temp_path, self._file_path(key))
+        except OSError:
+            return
+        self._writes += 1
+        if self._writes % self.PRUNE_INTERVAL == 0:
+            self.prune()
+
+    def prune(self):
+        """Remove the oldest files once the directory exceeds its size budget"""
+        try:
+            entries = [
+                entry for entry in os.scandir(self.path) if entry.is_file()
+            ]
+            sizes = {entry.path: entry.stat() for entry in entries}
+        except OSError:
+            return
+        total = sum(stat.st_size for stat in sizes.values())
+        for path in sorted(sizes, key=lambda path: sizes[path].st_mtime):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= sizes[path].st_size
+
+
+class Flight:
+    __slots__ = ("done", "result", "deadline")
+
+    def __init__(self, deadline: float):
+        self.done = threading.Event()
+        self.result: ty.Any = None
+        self.deadline = deadline
+
+
+class SingleFlight:
+    """
+    Deduplicate concurrent computations of the same key: the first caller (the leader) computes the result, and
+    callers that arrive while it is still working wait for it, and share that result instead of computing it again.
+
+    A leader must always call `finish`, with None if it failed. Waiting is bounded by a timeout, after which followers
+    (and new callers) give up on the leader and compute the result themselves.
+    """
+
+    def __init__(self, timeout: float):
+        self.timeout = timeout
+        self._flights: ty.Dict[ty.Hashable, Flight] = {}
+        self._lock = threading.Lock()
+
+        # Counters for monitoring how many computations were saved
+        self.leaders = 0
+        self.collapsed = 0
+        self.timeouts = 0
+
+    def begin(self, key: ty.Hashable) -> ty.Tuple[bool, Flight]:
+        """Join the computation of a key, and find out whether this caller should compute the result (as leader)"""
+        now = time.monotonic()
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None and flight.deadline > now:
+                return False, flight
+            flight = self._flights[key] = Flight(now + self.timeout)
+            self.leaders += 1
+            return True, flight
+
+    def wait(self, flight: Flight) -> ty.Any:
+        """Wait for the leader of a computation, and return its result (or None if it failed or timed out)"""
+        if not flight.done.wait(max(flight.deadline - time.monotonic(), 0)):
+            self.timeouts += 1
+            return None
+        if flight.result is not None:
+            self.collapsed += 1
+        return flight.result
+
+    def finish(self, key: ty.Hashable, flight: Flight, result: ty.Any):
+        """
+        Publish the result of a computation (or None if it failed) to every caller waiting for it
+
+        Only the first call has any effect, so a leader can safely finish again (eg with None, during cleanup).
+        """
+        with self._lock:
+            if flight.done.is_set():
+                return
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+            flight.result = result
+            flight.done.set()
+
+    def stats(self) -> dict:
+        return {
+            "leaders": self.leaders,
+            "collapsed": self.collapsed,
+            "timeouts": self.timeouts,
+            "in_flight": len(self._flights),
+        }
@@ -0,0 +1,460 @@
+"""
+Columnar, memory-mappable storage for association summary statistics
+
+Each tabix-indexed association file can be converted (at ingest time) into a directory of typed columns: numbers are
+stored as NumPy arrays, and strings are dictionary-encoded as integer codes into a table of distinct values. Rows
+keep the sort order of the original file, and the metadata records where each chromosome begins and ends, so that a
+region query becomes a binary search over the position column followed by slicing every column.
+
+Layout of a converted file:
+    meta.json                         Number of rows, column types, and the row range of each chromosome
+    {column}.npy                      Numeric columns
+    {column}.codes.npy                Dictionary-encoded string columns: one code per row...
+    {column}.values.json              ...and the list of distinct values that the codes refer to
+"""
+import array
+import gzip
+import json
+import math
+import os
+import typing as ty
+
+import numpy as np
+from zorp import parser_utils  # type: ignore
+
+try:
+    # Optional speedup features. Numbers must be parsed the same way as in `fivex.api.format`.
+    from fastnumbers import int, float  # type: ignore
+except ImportError:
+    pass
+
+FORMAT_VERSION = 1
+
+# Columns of an association file, in the order used by the merged (all studies and tissues) files. Study- and
+#   tissue-specific files omit the first two columns. See `VariantParser` for a description of each field.
+ASSOCIATION_COLUMNS = [
+    ("study", "str"),
+    ("tissue", "str"),
+    ("molecular_trait_id", "str"),
+    ("chromosome", "str"),
+    ("position", "int"),
+    ("ref_allele", "str"),
+    ("alt_allele", "str"),
+    ("variant", "str"),
+    ("ma_samples", "int"),
+    ("maf", "float"),
+    ("log_pvalue", "float"),
+    ("beta", "float"),
+    ("stderr_beta", "float"),
+    ("vartype", "str"),
+    ("ac", "int"),
+    ("an", "int"),
+    ("r2", "float"),
+    ("molecular_trait_object_id", "str"),
+    ("gene_id", "str"),
+    ("median_tpm", "float"),
+    ("rsid", "str"),
+]
+
+# Credible set statistics that can be joined onto each row of an association file at ingest time (see
+#   `fivex.credible_sets`), as extra columns at the end of each row
+JOINED_CREDIBLE_SET_COLUMNS = [
+    ("cs_index", "str"),
+    ("cs_size", "int"),
+    ("pip", "float"),
+]
+JOINED_ASSOCIATION_COLUMNS = ASSOCIATION_COLUMNS + JOINED_CREDIBLE_SET_COLUMNS
+
+
+def association_columns(width: int) -> ty.List[ty.Tuple[str, str]]:
+    """Get the columns of association data rows with the given number of fields (including study and tissue)"""
+    if width == len(JOINED_ASSOCIATION_COLUMNS):
+        return JOINED_ASSOCIATION_COLUMNS
+    return ASSOCIATION_COLUMNS
+
+
+# Leading columns of a credible set file, in the order used by the merged files (see `CIParser`). Merged files have
+#   extra columns joined from the association data, which are not listed here.
+CREDIBLE_SET_COLUMNS = [
+    ("study", "str"),
+    ("tissue", "str"),
+    ("gene_id", "str"),
+    ("var_id", "str"),
+    ("chromosome", "str"),
+    ("position", "int"),
+    ("ref_allele", "str"),
+    ("alt_allele", "str"),
+    ("cs_id", "str"),
+    ("cs_index", "str"),
+    ("finemapped_region", "str"),
+    ("pip", "float"),
+    ("z", "float"),
+    ("cs_min_r2", "float"),
+    ("cs_avg_r2", "float"),
+    ("cs_size", "int"),
+    ("posterior_mean", "float"),
+    ("posterior_sd", "float"),
+    ("cs_log10bf", "float"),
+]
+
+
+def _to_float(value: str) -> float:
+    """Parse a float, storing missing values (eg "NA") as nan"""
+    try:
+        return float(value)
+    except ValueError:
+        return np.nan
+
+
+def _to_log_pvalue(value: str) -> float:
+    log_pvalue = parser_utils.parse_pval_to_log(value, is_neg_log=False)
+    return np.nan if log_pvalue is None else log_pvalue
+
+
+_CONVERTERS = {"int": int, "float": _to_float}
+
+
+def _parse_log_pvalues(values: ty.Sequence[str]) -> np.ndarray:
+    """
+    Convert a batch of p-values to -log10(p), with the same results as `parser_utils.parse_pval_to_log`
+
+    The common case (every value is a number in (0, 1]) is handled in bulk; anything else (missing values, zeros
+    caused by underflow, invalid values) falls back to parsing each value separately.
+    """
+    count = len(values)
+    try:
+        # Use the same float parser and log function as zorp, so that results do not differ in the last digit
+        pvalues = np.fromiter(map(float, values), np.float64, count)
+    except ValueError:
+        pvalues = None
+    if pvalues is None or not ((pvalues > 0) & (pvalues <= 1)).all():
+        return np.fromiter(map(_to_log_pvalue, values), np.float64, count)
+    return -np.fromiter(map(math.log10, pvalues.tolist()), np.float64, count)
+
+
+def _parse_column(
+    name: str, kind: str, values: ty.Sequence[str]
+) -> np.ndarray:
+    count = len(values)
+    if name == "log_pvalue":
+        return _parse_log_pvalues(values)
+    elif kind == "int":
+        return np.fromiter(map(int, values), np.int64, count)
+    elif kind == "float":
+        try:
+            return np.fromiter(map(float, values), np.float64, count)
+        except ValueError:
+            # Only some columns have missing values, so only check for them when needed
+            return np.fromiter(map(_to_float, values), np.float64, count)
+    else:
+        column = np.empty(count, dtype=object)
+        column[:] = values
+        return column
+
+
+class ColumnBlock:
+    """
+    A batch of rows, stored as one array per column
+
+    String columns are either plain object arrays, or dictionary-encoded (an array of integer codes, plus a
+    vocabulary of distinct values). Either way, `values()` returns the decoded strings.
+    """
+
+    def __init__(
+        self,
+        columns: ty.Dict[str, np.ndarray],
+        vocabularies: ty.Optional[ty.Dict[str, np.ndarray]] = None,
+    ):
+        self.columns = columns
+        self.vocabularies = vocabularies or {}
+
+    def __len__(self):
+        if not self.columns:
+            return 0
+        return len(next(iter(self.columns.values())))
+
+    def values(self, name: str) -> np.ndarray:
+        """Get the values of one column (decoded, if the column is dictionary-encoded)"""
+        column = self.columns[name]
+        vocabulary = self.vocabularies.get(name)
+        if vocabulary is None:
+            return column
+        return vocabulary[column]
+
+    def equals(self, name: str, value: ty.Any) -> np.ndarray:
+        """A boolean mask of rows where a column has exactly the specified value"""
+        vocabulary = self.vocabularies.get(name)
+        if vocabulary is None:
+            return self.columns[name] == value
+        codes = np.flatnonzero(vocabulary == value)
+        if not len(codes):
+            return np.zeros(len(self), dtype=bool)
+        return self.columns[name] == codes[0]
+
+    def take(self, selection: ty.Union[np.ndarray, slice]) -> "ColumnBlock":
+        """Select a subset of rows, by boolean mask, by row number, or by slice"""
+        return ColumnBlock(
+            {name: column[selection] for name, column in self.columns.items()},
+            self.vocabularies,
+        )
+
+
+def concatenate(blocks: ty.Sequence[ColumnBlock]) -> ColumnBlock:
+    """Join blocks with the same columns (and vocabularies, if dictionary-encoded) into one block"""
+    if not blocks:
+        return ColumnBlock({})
+    if len(blocks) == 1:
+        return blocks[0]
+    return ColumnBlock(
+        {
+            name: np.concatenate([block.columns[name] for block in blocks])
+            for name in blocks[0].columns
+        },
+        blocks[0].vocabularies,
+    )
+
+
+def split_lines(
+    lines: ty.Sequence[str],
+    columns: ty.List[ty.Tuple[str, str]],
+    prefix: ty.Sequence[str] = (),
+) -> ty.Dict[str, ty.Sequence[str]]:
+    """
+    Split a batch of tab-delimited lines into columns of (unparsed) text
+
+    :param prefix: Values for the leading columns that are not present in the file (eg the study and tissue, for
+        study- and tissue-specific files). These are the same for every line.
+    """
+    fields: ty.List[ty.Sequence[str]] = [
+        [value] * len(lines) for value in prefix
+    ]
+    if not lines:
+        fields.extend([] for _ in range(len(columns) - len(prefix)))
+        return {name: values for (name, _), values in zip(columns, fields)}
+
+    # Split all lines at once, then take every n-th value for each column. This creates far fewer objects (and
+    #   garbage collector work) than splitting each line separately.
+    width = lines[0].count("\t") + 1
+    values = "\t".join(lines).split("\t")
+    needed = min(width, len(columns) - len(prefix))
+    if len(values) == width * len(lines):
+        fields.extend(values[i::width] for i in range(needed))
+    else:
+        # Lines have different numbers of fields
+        fields.extend(
+            list(zip(*(line.split("\t") for line in lines)))[:needed]
+        )
+    return {name: values for (name, _), values in zip(columns, fields)}
+
+
+def parse_columns(
+    raw: ty.Dict[str, ty.Sequence[str]],
+    names: ty.Iterable[str],
+    columns: ty.List[ty.Tuple[str, str]],
+    selection: ty.Optional[np.ndarray] = None,
+) -> ColumnBlock:
+    """
+    Parse some columns of a batch of split lines (see `split_lines`) into a block of arrays
+
+    :param selection: Row numbers to parse. Filters can be applied to a few parsed columns first, so that the other
+        columns are only parsed for rows that will be used.
+    """
+    kinds = dict(columns)
+    parsed = {}
+    for name in names:
+        values = raw[name]
+        if selection is not None:
+            values = [values[i] for i in selection.tolist()]
+        parsed[name] = _parse_column(name, kinds[name], values)
+    return ColumnBlock(parsed)
+
+
+class ColumnarTable:
+    """Read access to an association file that has been converted to columnar format"""
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(os.path.join(path, "meta.json")) as f:
+            self.meta = json.load(f)
+        if self.meta["version"] != FORMAT_VERSION:
+            raise ValueError(f"Unsupported columnar format version: {path}")
+        self._columns: ty.Dict[str, np.ndarray] = {}
+        self._vocabularies: ty.Dict[str, np.ndarray] = {}
+
+    def _column(self, name: str) -> np.ndarray:
+        column = self._columns.get(name)
+        if column is None:
+            if self.meta["columns"][name] == "str":
+                filename = f"{name}.codes.npy"
+            else:
+                filename = f"{name}.npy"
+            column = np.load(os.path.join(self.path, filename), mmap_mode="r")
+            self._columns[name] = column
+        return column
+
+    def _vocabulary(self, name: str) -> np.ndarray:
+        vocabulary = self._vocabularies.get(name)
+        if vocabulary is None:
+            with open(os.path.join(self.path, f"{name}.values.json")) as f:
+                values = json.load(f)
+            vocabulary = np.empty(len(values), dtype=object)
+            vocabulary[:] = values
+            self._vocabularies[name] = vocabulary
+        return vocabulary
+
+    def rows(self, chrom: str, start: int, end: int) -> ty.Tuple[int, int]:
+        """Find the range of row numbers with positions in [start, end] (inclusive, 1-based)"""
+        row_range = self.meta["chromosomes"].get(chrom)
+        if row_range is None:
+            return 0, 0
+        first, last = row_range
+        positions = self._column("position")[first:last]
+        return (
+            first + int(np.searchsorted(positions, start, side="left")),
+            first + int(np.searchsorted(positions, end, side="right")),
+        )
+
+    def fetch(
+        self,
+        chrom: str,
+        start: int,
+        end: int,
+        columns: ty.Optional[ty.Iterable[str]] = None,
+        selection: ty.Optional[np.ndarray] = None,
+    ) -> ColumnBlock:
+        """
+        Get all rows with positions in [start, end] (inclusive, 1-based) as a block of columns
+
+        :param selection: Only read these rows (numbered from the first row in the region)
+        """
+        first, last = self.rows(chrom, start, end)
+        if columns is None:
+            columns = self.meta["columns"]
+        if selection is None:
+            rows: ty.Union[slice, np.ndarray] = slice(first, last)
+        else:
+            rows = first + selection
+        return ColumnBlock(
+            {name: self._column(name)[rows] for name in columns},
+            {
+                name: self._vocabulary(name)
+                for name in columns
+                if self.meta["columns"][name] == "str"
+            },
+        )
+
+
+class ColumnarWriter:
+    """Write rows (already split into fields) to a new columnar table. Rows must be sorted by chromosome and position."""
+
+    def __init__(self, path: str, columns: ty.List[ty.Tuple[str, str]]):
+        self.path = path
+        self.columns = columns
+        self._data: ty.List[array.array] = []
+        self._vocabularies: ty.List[ty.Dict[str, int]] = []
+        for _, kind in columns:
+            self._data.append(
+                array.array({"int": "q", "float": "d", "str": "I"}[kind])
+            )
+            self._vocabularies.append({})
+        self._chromosomes: ty.Dict[str, ty.List[int]] = {}
+        self._chrom_index = [name for name, _ in columns].index("chromosome")
+        self._rows = 0
+
+    def append(self, fields: ty.Sequence[ty.Any]):
+        chrom = fields[self._chrom_index]
+        row_range = self._chromosomes.get(chrom)
+        if row_range is None:
+            self._chromosomes[chrom] = [self._rows, self._rows + 1]
+        elif row_range[1] != self._rows:
+            raise ValueError(
+                f"Rows must be sorted by chromosome: {chrom} is not contiguous"
+            )
+        else:
+            row_range[1] += 1
+
+        for (_, kind), data, vocabulary, value in zip(
+            self.columns, self._data, self._vocabularies, fields
+        ):
+            if kind == "str":
+                data.append(vocabulary.setdefault(value, len(vocabulary)))
+            else:
+                data.append(value)
+        self._rows += 1
+
+    def close(self):
+        os.makedirs(self.path, exist_ok=True)
+        for (name, kind), data, vocabulary in zip(
+            self.columns, self._data, self._vocabularies
+        ):
+            if kind == "str":
+                # Use the smallest integer type that can hold every code
+                dtype = np.min_scalar_type(max(len(vocabulary) - 1, 0))
+                np.save(
+                    os.path.join(self.path, f"{name}.codes.npy"),
+                    np.frombuffer(data, dtype=np.uint32).astype(dtype),
+                )
+                with open(
+                    os.path.join(self.path, f"{name}.values.json"), "w"
+                ) as f:
+                    json.dump(list(vocabulary), f)
+            else:
+                np.save(
+                    os.path.join(self.path, f"{name}.npy"),
+                    np.frombuffer(
+                        data, dtype=np.int64 if kind == "int" else np.float64
+                    ),
+                )
+        # The metadata is written last, so that a partially converted file is never used
+        with open(os.path.join(self.path, "meta.json"), "w") as f:
+            json.dump(
+                {
+                    "version": FORMAT_VERSION,
+                    "rows": self._rows,
+                    "columns": dict(self.columns),
+                    "chromosomes": self._chromosomes,
+                },
+                f,
+            )
+
+
+def convert_association_file(
+    source: str,
+    destination: str,
+    study: ty.Optional[str] = None,
+    tissue: ty.Optional[str] = None,
+) -> int:
+    """
+    Convert a (bgzipped) association file to columnar format
+
+    Study- and tissue-specific files have a header row and no study or tissue columns: the study and tissue must be
+    provided for these files. Merged files have no header row, and contain all columns. Credible set columns that
+    were joined onto the file at ingest time are converted too.
+
+    :return: The number of rows written
+    """
+    writer = None
+    with gzip.open(source, "rt") as f:
+        for line in f:
+            fields: ty.List[ty.Any] = line.rstrip("\n").split("\t")
+            if fields[0] == "molecular_trait_id":
+                # Header row of the study- and tissue-specific files
+                continue
+            if study is not None and tissue is not None:
+                fields = [study, tissue] + fields
+            if writer is None:
+                columns = association_columns(len(fields))
+                writer = ColumnarWriter(destination, columns)
+                converters = []
+                for name, kind in columns:
+                    if name == "log_pvalue":
+                        converters.append(_to_log_pvalue)
+                    else:
+                        converters.append(_CONVERTERS.get(kind, str))
+            writer.append(
+                [convert(value) for convert, value in zip(converters, fields)]
+            )
+    if writer is None:
+        writer = ColumnarWriter(destination, ASSOCIATION_COLUMNS)
+    writer.close()
+    return writer._rows
@@ -0,0 +1,142 @@
+"""
+Conditional GET support: ETags and Cache-Control headers for API and view responses
+
+Data files only change when the site is redeployed, so a response is fully determined by the URL, the query
+parameters, the version of the app, and the exact versions (path, size, and modification time) of the data files it
+reads. The ETag of a response is a hash of these, and can be computed without reading any data: when the client (or a caching proxy)
+already has the current version, the view is skipped entirely and an empty 304 response is sent instead.
+"""
+import functools
+import hashlib
+import os
+import typing as ty
+
+from flask import current_app, request
+
+from . import model
+
+# A function that lists the data files read by a view, given the same arguments as the view
+FileLister = ty.Callable[..., ty.Iterable[str]]
+
+
+def file_identity(path: str) -> str:
+    """Identify the exact version of a file (or directory): its path, size, and modification time"""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return f"{path}:missing"
+    return f"{path}:{stat.st_size}:{stat.st_mtime_ns}"
+
+
+def support_files() -> ty.List[str]:
+    """Data files that are used to annotate or look up the results of almost every request"""
+    return [
+        model.get_gene_names_path(),
+        model.locate_gencode_data(),
+        model.locate_gencode_transcript_data(),
+        model.get_rsid_path(),
+        model.get_best_per_variant_lookup("ge"),
+        model.get_best_per_variant_lookup("txrev"),
+    ]
+
+
+def derived_files(files: ty.Iterable[str]) -> ty.List[str]:
+    """
+    List the files built from data files at ingest time that are read in their place (if enabled): the metadata of
+    columnar copies and of gene indexes, which is rewritten whenever a copy or an index is rebuilt
+    """
+    columnar = current_app.config["FIVEX_STORAGE_BACKEND"] == "columnar"
+    gene_index = bool(current_app.config["FIVEX_BLOCK_CACHE_BYTES"])
+    derived = []
+    for path in files:
+        if columnar:
+            derived.append(
+                os.path.join(model.locate_columnar_table(path), "meta.json")
+            )
+        if gene_index:
+            derived.append(
+                os.path.join(model.locate_gene_index(path), "meta.json")
+            )
+    return derived
+
+
+@functools.lru_cache(maxsize=None)
+def _source_version() -> str:
+    # The code only changes when the site is redeployed (and the workers restarted), so it is hashed once per process
+    package = os.path.dirname(os.path.realpath(__file__))
+    digest = hashlib.sha1()
+    for dirpath, dirnames, filenames in os.walk(package):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            if filename.endswith(".py"):
+                path = os.path.join(dirpath, filename)
+                digest.update(os.path.relpath(path, package).encode())
+                with open(path, "rb") as f:
+                    digest.update(f.read())
+    return digest.hexdigest()
+
+
+def app_version() -> str:
+    """Identify the deployed version of the app: a hash of its source code, and the deploy ID (if configured)"""
+    return f"app:{_source_version()}:{current_app.config['FIVEX_DEPLOY_ID']}"
+
+
+def data_version(files: ty.Iterable[str] = ()) -> ty.List[str]:
+    """
+    Identify the exact versions of the app and of the data files read by a request (including the support files, and
+    the columnar copies and gene indexes that are read in place of the listed files)
+    """
+    files = list(files)
+    paths = support_files() + files + derived_files(files)
+    return [app_version()] + [file_identity(path) for path in paths]
+
+
+def compute_etag(files: ty.Iterable[str] = ()) -> str:
+    """Compute the ETag of a response to the current request, given the data files that it reads"""
+    digest = hashlib.sha1(request.path.encode())
+    # Query parameters are sorted, so that equivalent URLs share a single ETag
+    for key, value in sorted(request.args.items(multi=True)):
+        digest.update(f"\0{key}={value}".encode())
+    for identity in data_version(files):
+        digest.update(f"\0{identity}".encode())
+    return digest.hexdigest()
+
+
+def _set_cache_headers(response, etag: str):
+    response.set_etag(etag)
+    max_age = current_app.config["FIVEX_HTTP_CACHE_MAX_AGE"]
+    response.cache_control.public = True
+    if max_age:
+        response.cache_control.max_age = max_age
+    else:
+        # Responses may be stored, but must be revalidated (with a cheap conditional request) before each use
+        response.cache_control.no_cache = True
+    return response
+
+
+def conditional(files: ty.Optional[FileLister] = None):
+    """
+    Decorate a view to support conditional GET requests
+
+    :param files: A function that lists the data files read by the view, called with the same arguments as the view.
+        Files used by all views (see `support_files`) do not need to be listed.
+    """
+
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            etag = compute_etag(
+                files(*args, **kwargs) if files is not None else ()
+            )
+            if request.if_none_match.contains(etag):
+                return _set_cache_headers(
+                    current_app.response_class(status=304), etag
+                )
+            response = current_app.make_response(view(*args, **kwargs))
+            if response.status_code == 200:
+                _set_cache_headers(response, etag)
+            return response
+
+        return wrapper
+
+    return decorator
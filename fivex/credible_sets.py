@@ -0,0 +1,157 @@
+"""
+Ingest-time join of credible set statistics (SuSiE PIPs) onto association files
+
+Normally, every query reads the matching credible set file as well as the association file, and joins the two (see
+`fivex.api.format.CIAdder`). Instead, the credible set statistics (cs_index, cs_size, and pip) can be joined onto each
+row of an association file once, at ingest time, as three extra columns. Queries against a joined file read these
+columns directly, and do not open the credible set file at all.
+
+Rows that are not in a credible set receive the same values that the query-time join uses for missing data:
+cs_index "-", cs_size 0, and pip 0.0.
+
+The join uses the same credible set files, and the same key, as the query-time join: association files of every
+datatype are joined with the gene expression credible sets, by variant, study, tissue, and gene.
+
+Joined files can differ from the query-time join in one way: a region query without a gene_id does not read any
+credible sets at query time (every row has pip 0), but reads the joined PIPs from a joined file. As rows in a credible
+set are always kept by `max_points` thinning, such queries can also return a different selection of rows.
+"""
+import os
+import typing as ty
+
+import pysam  # type: ignore
+
+from .columnar import (
+    ASSOCIATION_COLUMNS,
+    CREDIBLE_SET_COLUMNS,
+    JOINED_CREDIBLE_SET_COLUMNS,
+)
+from .tabix import TabixIndex
+
+# The datatype of the credible sets that are joined onto association files of any datatype. Txrevise credible sets
+#   are keyed on the full molecular trait id (gene, group, and transcript), which does not match the gene_id of an
+#   association row; queries match every datatype against the gene expression credible sets instead.
+CREDIBLE_SET_DATATYPE = "ge"
+
+# Credible set rows are loaded one window of positions at a time
+WINDOW_SIZE = 1000000
+
+# Values of the joined columns for rows that are not in a credible set (the raw text, as written to the file)
+MISSING_VALUES = ("-", "0", "0.0")
+
+# Fields that identify a row, in both the association and credible set files
+_KEY_COLUMNS = (
+    "chromosome",
+    "position",
+    "ref_allele",
+    "alt_allele",
+    "study",
+    "tissue",
+    "gene_id",
+)
+
+
+def _key_indices(columns: ty.List[ty.Tuple[str, str]]) -> ty.List[int]:
+    names = [name for name, _ in columns]
+    return [names.index(name) for name in _KEY_COLUMNS]
+
+
+class _CredibleSetWindow:
+    """Look up the credible set statistics of a row, loading credible sets for one window of positions at a time"""
+
+    def __init__(self, path: str, prefix: ty.List[str]):
+        self._file = pysam.TabixFile(path) if os.path.isfile(path) else None
+        self._prefix = prefix
+        self._key_indices = _key_indices(CREDIBLE_SET_COLUMNS)
+        names = [name for name, _ in CREDIBLE_SET_COLUMNS]
+        self._value_indices = [
+            names.index(name) for name, _ in JOINED_CREDIBLE_SET_COLUMNS
+        ]
+        self._chrom: ty.Optional[str] = None
+        self._end = 0
+        self._rows: ty.Dict[ty.Tuple, ty.Tuple[str, ...]] = {}
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+
+    def _load(self, chrom: str, start: int):
+        self._chrom = chrom
+        self._end = start + WINDOW_SIZE
+        self._rows = {}
+        if self._file is None or chrom not in self._file.contigs:
+            return
+        for line in self._file.fetch(chrom, start - 1, self._end - 1):
+            fields = self._prefix + line.split("\t")
+            key = tuple(fields[i] for i in self._key_indices)
+            self._rows[key] = tuple(fields[i] for i in self._value_indices)
+
+    def get(self, key: ty.Tuple[str, ...]) -> ty.Tuple[str, ...]:
+        chrom, position = key[0], int(key[1])
+        if chrom != self._chrom or position >= self._end:
+            self._load(chrom, position)
+        return self._rows.get(key, MISSING_VALUES)
+
+
+def join_credible_sets(
+    source: str,
+    credible_set_file: str,
+    destination: str,
+    study: ty.Optional[str] = None,
+    tissue: ty.Optional[str] = None,
+) -> ty.Tuple[int, int]:
+    """
+    Write a copy of a (bgzipped, tabix-indexed) association file, with the credible set statistics of each row
+    appended as extra columns. The copy is indexed with the same settings as the original.
+
+    Study- and tissue-specific files have no study or tissue columns: the study and tissue must be provided for these
+    files (and their credible set files). A missing credible set file is treated as empty.
+
+    :return: The number of rows written, and the number of those rows that are in a credible set
+    """
+    prefix: ty.List[str] = [study, tissue] if study and tissue else []
+    key_indices = _key_indices(ASSOCIATION_COLUMNS)
+    index = TabixIndex(f"{source}.tbi")
+    credible_sets = _CredibleSetWindow(credible_set_file, prefix)
+
+    rows = members = 0
+    try:
+        with pysam.BGZFile(source, "rb") as f, pysam.BGZFile(  # type: ignore
+            destination, "wb"
+        ) as out:
+            for raw_line in f:
+                line = raw_line.decode().rstrip("\n")
+                fields = line.split("\t")
+                if fields[0] == "molecular_trait_id" or line.startswith(
+                    index.meta
+                ):
+                    # Header row
+                    names = [name for name, _ in JOINED_CREDIBLE_SET_COLUMNS]
+                    out.write("\t".join([line] + names).encode() + b"\n")
+                    continue
+                fields = prefix + fields
+                if len(fields) != len(ASSOCIATION_COLUMNS):
+                    raise ValueError(
+                        f"Unexpected number of columns in {source}: {len(fields)} (is it already joined?)"
+                    )
+                values = credible_sets.get(
+                    tuple(fields[i] for i in key_indices)
+                )
+                rows += 1
+                if values is not MISSING_VALUES:
+                    members += 1
+                out.write("\t".join([line, *values]).encode() + b"\n")
+    finally:
+        credible_sets.close()
+
+    pysam.tabix_index(
+        destination,
+        force=True,
+        seq_col=index.col_seq,
+        start_col=index.col_beg,
+        end_col=index.col_end,
+        meta_char=index.meta,
+        line_skip=index.skip,
+        zerobased=bool(index.format & 0x10000),
+    )
+    return rows, members
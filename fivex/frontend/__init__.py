@@ -1,13 +1,9 @@
 """
 Front end views: provide the data needed by pages that are visited in the web browser
 """
-import gzip
-import json
-import sqlite3
-
+import numpy as np
 from flask import Blueprint, abort, jsonify, redirect, request, url_for
-from genelocator import exception as gene_exc, get_genelocator  # type: ignore
-from zorp import readers  # type: ignore
+from genelocator import exception as gene_exc  # type: ignore
 
 from .. import model
 from ..api.format import (
@@ -15,14 +11,18 @@ from ..api.format import (
     TISSUES_TO_SYSTEMS,
     position_to_variant_id,
 )
-from .format import gencodeParser, gencodeTranscriptParser
+from ..conditional import conditional
+from ..response_cache import cached
 
-gl = get_genelocator("GRCh38", gencode_version=32, coding_only=True)
+# Genes are considered "nearby" a variant if their TSS is within this many bp
+CIS_WINDOW_SIZE = 1000000
 
 views_blueprint = Blueprint("frontend", __name__, template_folder="templates")
 
 
 @views_blueprint.route("/region/", methods=["GET"])
+@conditional()
+@cached()
 def region_view():
     """Region view"""
     # The canonical form of this view uses start and end query params
@@ -74,11 +74,9 @@ def region_view():
     # If the request does not include a start or end position, then find the TSS and strand information,
     # then generate a window based on this information
     if start is None and end is None:
-        with gzip.open(model.locate_tss_data(), "rb") as f:
-            tss_dict = json.load(f)
-            # tss contains two pieces of information: the genomic position of the TSS, and the strand
-            # if it is the + strand, then the tss is positive; if it is the - strand, then the tss is negative
-        tss = tss_dict.get(gene_id, None)
+        # tss contains two pieces of information: the genomic position of the TSS, and the strand
+        # if it is the + strand, then the tss is positive; if it is the - strand, then the tss is negative
+        tss = model.get_tss_index().get(gene_id, None)
         if tss is None:
             return abort(400)
         else:
@@ -133,14 +131,10 @@ def region_view():
         # After looking up best gene, fill in missing symbol. TODO: In future, this should be sourced from the SQL query, once the database file / credsets file contains both gene name and ID in one place
         symbol = gene_json.get(gene_id.split(".")[0], None)
 
-    source = model.locate_gencode_data()
-    reader = readers.TabixReader(source, parser=gencodeParser(), skip_rows=0)
-    gencodeRows = reader.fetch(f"chr{chrom}", start - 1, end + 1)
-    gene_list = []
-    for row in gencodeRows:
-        gene_list.append(row.gene_id)
+    gencodeRows = model.get_gene_intervals().fetch(chrom, start - 1, end + 1)
     gene_dict = {
-        str(geneid): str(gene_json.get(geneid, geneid)) for geneid in gene_list
+        row.gene_id: gene_json.get(row.gene_id, row.gene_id)
+        for row in gencodeRows
     }
 
     return jsonify(
@@ -161,10 +155,15 @@ def region_view():
 
 
 @views_blueprint.route("/variant/<string:chrom>_<int:pos>/")
+@conditional()
+@cached()
 def variant_view(chrom: str, pos: int):
     """Single variant (PheWAS) view"""
+    # Our data files do not use the 'chr' prefix (requests for "chr1" and "1" share a response cache entry)
+    if chrom.startswith("chr"):
+        chrom = chrom[3:]
     try:
-        nearest_genes = gl.at(chrom, pos)
+        nearest_genes = model.get_gene_locator().at(chrom, pos)
     except (gene_exc.NoResultsFoundException, gene_exc.BadCoordinateException):
         nearest_genes = []
 
@@ -175,39 +174,34 @@ def variant_view(chrom: str, pos: int):
 
     # Query the best variant SQLite3 database to retrieve the top gene by PIP
     pipIndexErrorFlag = False
-    conn = sqlite3.connect(
-        model.get_best_per_variant_lookup(data_type=data_type)
-    )
-    with conn:
-        try:
-            (
-                _,
-                top_study,
-                top_tissue,
-                top_gene,
-                chrom,
-                pos,
-                ref,
-                alt,
-                _,
-                _,
-                _,
-            ) = list(
-                conn.execute(
-                    "SELECT * FROM sig WHERE chrom=? and pos=? ORDER BY pip DESC LIMIT 1;",
-                    (chrom, pos),
-                )
-            )[
-                0
-            ]
-        # Sometimes the variant is not present at all in the best variant database
-        # This is expected behavior, in this case we store valid empty responses
-        except IndexError:
-            top_study = "No_study"
-            top_tissue = "No_tissue"
-            top_gene = "No_gene"
-            pipIndexErrorFlag = True
-            # return abort(400)
+    try:
+        (
+            _,
+            top_study,
+            top_tissue,
+            top_gene,
+            chrom,
+            pos,
+            ref,
+            alt,
+            _,
+            _,
+            _,
+        ) = model.query_sqlite(
+            model.get_best_per_variant_lookup(data_type=data_type),
+            "SELECT * FROM sig WHERE chrom=? and pos=? ORDER BY pip DESC LIMIT 1;",
+            (chrom, pos),
+        )[
+            0
+        ]
+    # Sometimes the variant is not present at all in the best variant database
+    # This is expected behavior, in this case we store valid empty responses
+    except IndexError:
+        top_study = "No_study"
+        top_tissue = "No_tissue"
+        top_gene = "No_gene"
+        pipIndexErrorFlag = True
+        # return abort(400)
 
     # Are the "nearest genes" nearby, or is the variant actually inside the gene?
     # These rules are based on the defined behavior of the genes locator
@@ -220,6 +214,24 @@ def variant_view(chrom: str, pos: int):
     gene_json = model.get_gene_names_conversion()
     gene_symbol = gene_json.get(top_gene, "Unknown_gene")
 
+    # Genes whose TSS lies within the 1Mb cis window around the variant, in the same units as the PheWAS tss_distance
+    tss_index = model.get_tss_index()
+    cis_gene_ids = [
+        cis_gene
+        for cis_gene, _ in tss_index.genes_near(chrom, pos, CIS_WINDOW_SIZE)
+    ]
+    cis_distances, _ = tss_index.distances(
+        np.full(len(cis_gene_ids), pos), cis_gene_ids
+    )
+    cis_genes = [
+        {
+            "gene_id": cis_gene,
+            "symbol": gene_json.get(cis_gene, cis_gene),
+            "tss_distance": int(distance),
+        }
+        for cis_gene, distance in zip(cis_gene_ids, cis_distances.tolist())
+    ]
+
     # Query rsid database for chrom, pos, ref, alt, rsid (we only keep the last 3)
     (_, _, rref, ralt, rsid) = model.return_rsid(chrom, pos)
 
@@ -243,6 +255,7 @@ def variant_view(chrom: str, pos: int):
             top_tissue=top_tissue,
             study_names=list(TISSUES_PER_STUDY.keys()),
             nearest_genes=nearest_genes,
+            cis_genes=cis_genes,
             is_inside_gene=is_inside_gene,
             rsid=rsid,
             variant_id=variant_id,
@@ -254,20 +267,18 @@ def variant_view(chrom: str, pos: int):
 @views_blueprint.route(
     "/gencode/genes/<string:chrom>/<int:start>-<int:end>/", methods=["GET"]
 )
+@conditional()
+@cached()
 def get_genes_in_region(chrom: str, start: int, end: int):
     """
     Fetch the genes data for a region, and returns a dictionary of ENSG: Gene Symbols
-    Retrieves data from our gencode genes file
+    Retrieves data from our (in-memory index of the) gencode genes file
     """
-    source = model.locate_gencode_data()
-    reader = readers.TabixReader(source, parser=gencodeParser(), skip_rows=0)
-    gencodeRows = reader.fetch(f"chr{chrom}", start - 1, end + 1)
-    gene_list = []
+    gencodeRows = model.get_gene_intervals().fetch(chrom, start - 1, end + 1)
     gene_json = model.get_gene_names_conversion()
-    for row in gencodeRows:
-        gene_list.append(row.gene_id)
     gene_dict = {
-        str(geneid): str(gene_json.get(geneid, geneid)) for geneid in gene_list
+        row.gene_id: gene_json.get(row.gene_id, row.gene_id)
+        for row in gencodeRows
     }
     return jsonify({"data": gene_dict})
 
@@ -277,35 +288,35 @@ def get_genes_in_region(chrom: str, start: int, end: int):
     "/gencode/transcripts/<string:chrom>/<int:start>-<int:end>/",
     methods=["GET"],
 )
+@conditional()
+@cached()
 def get_transcripts_in_region(chrom: str, start: int, end: int):
     """
     Fetch the transcript data for a region
-    Retrieves data from our gencode transcripts file
+    Retrieves data from our (in-memory index of the) gencode transcripts file
     """
+    if chrom.startswith("chr"):
+        chrom = chrom[3:]
     gene_id = request.args.get("gene_id", None)
-    source = model.locate_gencode_transcript_data()
-    reader = readers.TabixReader(
-        source, parser=gencodeTranscriptParser(), skip_rows=0
+    # Gencode IDs are stored without their version number
+    if gene_id:
+        gene_id = gene_id.split(".")[0]
+    # With a gene_id, only the transcripts of that gene are checked
+    gencodeRows = model.get_transcript_intervals().fetch(
+        chrom, start - 1, end + 1, gene_id=gene_id
     )
-    gencodeRows = reader.fetch(f"chr{chrom}", start - 1, end + 1)
     transcriptDict = dict()  # type: ignore
     # If we decide that we want both ENSG:ENST and gene_symbol:transcript_symbol dictionaries
     # Then we can return the extra information below (double dictionary)
     # symbolDict = {}
 
-    # Variables in gencodeTranscriptContainer:
+    # Variables in TranscriptFeature:
     # chrom: str
-    # source: str
-    # element: str
     # start: int
     # end: int
-    # strand: str
     # gene_id: str
     # transcript_id: str
-    # datatype: str
     # symbol: str
-    # transcript_type: str
-    # transcript_symbol: str
 
     for row in gencodeRows:
         if gene_id is None or gene_id == row.gene_id:
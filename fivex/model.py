@@ -1,13 +1,38 @@
 """
 Models/ datastores
 """
+import functools
 import gzip
 import json
 import math
 import os
+import pathlib
 import sqlite3
+import sys
+import threading
+import types
+import typing as ty
 
 from flask import abort, current_app
+from genelocator import get_genelocator  # type: ignore
+
+from . import pip_summary
+from .annotations import (
+    GeneFeature,
+    IntervalIndex,
+    TranscriptFeature,
+    TSSIndex,
+)
+from .columnar import ColumnarTable
+from .geneindex import GeneIndex
+
+# Read-only SQLite databases are opened once per worker process, and the connection is reused by every request.
+#   The sqlite3 module keeps a cache of prepared statements on each connection, so repeated queries are not re-parsed.
+#   The lock guards against concurrent use of one connection from several threads; gevent workers never contend for it,
+#   because a query runs to completion without yielding to other greenlets.
+_SQLITE_CONNECTIONS: ty.Dict[str, sqlite3.Connection] = {}
+_SQLITE_LOCK = threading.Lock()
+_SQLITE_PID = None
 
 
 # Merged data split into 1Mbps chunks - only query this for single variant data
@@ -40,13 +65,91 @@ def locate_study_tissue_data(study, tissue, datatype="ge"):
     )
 
 
-# Signed tss data: positive TSS = Plus strand, negative TSS = Minus strand
-def locate_tss_data():
+# Open columnar tables keep their decoded string vocabularies in memory, so only the most recently used are kept
+COLUMNAR_TABLE_CACHE_SIZE = 128
+
+
+@functools.lru_cache(maxsize=COLUMNAR_TABLE_CACHE_SIZE)
+def _open_columnar_table(
+    path: str, version: ty.Tuple[int, int]
+) -> ColumnarTable:
+    # The version (size and modification time of the metadata) is part of the cache key, so that a reconverted
+    #   file is loaded again
+    return ColumnarTable(path)
+
+
+def locate_columnar_table(source: str) -> str:
+    """Get the directory of the columnar copy of an association file (which exists only if the file was converted)"""
+    relative_path = os.path.relpath(
+        source, current_app.config["FIVEX_DATA_DIR"]
+    )
     return os.path.join(
-        current_app.config["FIVEX_DATA_DIR"], "gencode", "tss.json.gz",
+        current_app.config["FIVEX_COLUMNAR_DIR"], f"{relative_path}.columns"
     )
 
 
+def get_columnar_table(source: str) -> ty.Optional[ColumnarTable]:
+    """
+    Get the columnar copy of a tabix-indexed association file, if the columnar storage backend is enabled and the
+    file has been converted. Otherwise, return None (and the caller should read the tabix file).
+    """
+    if current_app.config["FIVEX_STORAGE_BACKEND"] != "columnar":
+        return None
+    path = locate_columnar_table(source)
+    try:
+        stat = os.stat(os.path.join(path, "meta.json"))
+    except FileNotFoundError:
+        return None
+    return _open_columnar_table(path, (stat.st_size, stat.st_mtime_ns))
+
+
+@functools.lru_cache(maxsize=None)
+def _count_columns(path: str, version: ty.Tuple[int, int]) -> int:
+    with gzip.open(path, "rt") as f:
+        return len(f.readline().rstrip("\n").split("\t"))
+
+
+def count_columns(source: str) -> int:
+    """Count the columns of a (bgzipped) data file, from its first line"""
+    stat = os.stat(source)
+    # The size and modification time are part of the cache key, so that a replaced file is checked again
+    return _count_columns(source, (stat.st_size, stat.st_mtime_ns))
+
+
+@functools.lru_cache(maxsize=None)
+def _open_gene_index(path: str, version: int) -> GeneIndex:
+    # The version (modification time) is part of the cache key, so that a rebuilt index is loaded again
+    return GeneIndex(path)
+
+
+def locate_gene_index(source: str) -> str:
+    """Get the directory of the gene index of an association file (which exists only if an index was built)"""
+    relative_path = os.path.relpath(
+        source, current_app.config["FIVEX_DATA_DIR"]
+    )
+    return os.path.join(
+        current_app.config["FIVEX_GENE_INDEX_DIR"], f"{relative_path}.genes"
+    )
+
+
+def get_gene_index(source: str) -> ty.Optional[GeneIndex]:
+    """
+    Get the gene index of a study- and tissue-specific association file, if one has been built from the current
+    version of the file (and the built-in tabix reader, which can read rows by offset, is enabled)
+    """
+    if not current_app.config["FIVEX_BLOCK_CACHE_BYTES"]:
+        return None
+    path = locate_gene_index(source)
+    try:
+        version = os.stat(os.path.join(path, "meta.json")).st_mtime_ns
+    except FileNotFoundError:
+        return None
+    index = _open_gene_index(path, version)
+    if not index.matches(source):
+        return None
+    return index
+
+
 # Sorted and filtered gencode data
 def locate_gencode_data():
     return os.path.join(
@@ -65,6 +168,60 @@ def locate_gencode_transcript_data():
     )
 
 
+@functools.lru_cache(maxsize=None)
+def _load_tss_index(path: str) -> TSSIndex:
+    return TSSIndex.from_gencode(path)
+
+
+def get_tss_index() -> TSSIndex:
+    """
+    Get the sorted index of signed TSS positions (positive TSS = Plus strand, negative TSS = Minus strand)
+
+    The index is derived from the GENCODE genes file, and is built once per process on first use.
+    """
+    return _load_tss_index(locate_gencode_data())
+
+
+@functools.lru_cache(maxsize=None)
+def _load_gene_intervals(path: str) -> IntervalIndex[GeneFeature]:
+    return IntervalIndex.genes_from_gencode(path)
+
+
+def get_gene_intervals() -> IntervalIndex[GeneFeature]:
+    """
+    Get the in-memory index of GENCODE genes, used to find the genes in a region without reading the file
+
+    The index is built once per process on first use (or by `fivex.warm_up`).
+    """
+    return _load_gene_intervals(locate_gencode_data())
+
+
+@functools.lru_cache(maxsize=None)
+def _load_transcript_intervals(path: str,) -> IntervalIndex[TranscriptFeature]:
+    return IntervalIndex.transcripts_from_gencode(path)
+
+
+def get_transcript_intervals() -> IntervalIndex[TranscriptFeature]:
+    """
+    Get the in-memory index of GENCODE transcripts, used to find the transcripts in a region (or of a gene) without
+    reading the file
+
+    The index is built once per process on first use (or by `fivex.warm_up`).
+    """
+    return _load_transcript_intervals(locate_gencode_transcript_data())
+
+
+@functools.lru_cache(maxsize=None)
+def get_gene_locator():
+    """
+    Get the interval tree of (coding) genes, used to find the genes that overlap a variant
+
+    The tree is loaded from the genelocator package's prebuilt index once per process, on first use (or by
+    `fivex.warm_up`), rather than when the app is imported.
+    """
+    return get_genelocator("GRCh38", gencode_version=32, coding_only=True)
+
+
 # A database that stores the point with the highest PIP at each variant
 def get_best_per_variant_lookup(data_type: str = "ge",):
     # TODO: dedup datatype value usage. make enum with ge or txrev for e and sqtls
@@ -78,14 +235,110 @@ def get_best_per_variant_lookup(data_type: str = "ge",):
     )
 
 
+def get_sqlite_connection(path: str) -> sqlite3.Connection:
+    """
+    Get a shared, read-only connection to an SQLite3 database file
+
+    The database is opened in immutable mode (no locking or change detection), with memory-mapped I/O enabled.
+    Connections are cached per worker process, and re-created after a fork.
+    """
+    global _SQLITE_PID
+    pid = os.getpid()
+    with _SQLITE_LOCK:
+        if _SQLITE_PID != pid:
+            # Connections must not be carried across a fork: the child process opens its own
+            _SQLITE_CONNECTIONS.clear()
+            _SQLITE_PID = pid
+        conn = _SQLITE_CONNECTIONS.get(path)
+        if conn is None:
+            # Fail loudly if the file is missing, instead of letting SQLite create an empty database
+            if not os.path.isfile(path):
+                raise sqlite3.OperationalError(
+                    f"Database file not found: {path}"
+                )
+            # Percent-encode the path, so that characters like "?", "#" and "%" are not read as part of the URI
+            conn = sqlite3.connect(
+                f"{pathlib.Path(path).resolve().as_uri()}?mode=ro&immutable=1",
+                uri=True,
+                check_same_thread=False,
+            )
+            conn.execute(
+                f"PRAGMA mmap_size={int(current_app.config['FIVEX_SQLITE_MMAP_SIZE'])}"
+            )
+            _SQLITE_CONNECTIONS[path] = conn
+        return conn
+
+
+def query_sqlite(path: str, sql: str, args: ty.Sequence = ()) -> list:
+    """Run a read-only query against a shared database connection, and return all matching rows"""
+    conn = get_sqlite_connection(path)
+    with _SQLITE_LOCK:
+        return conn.execute(sql, tuple(args)).fetchall()
+
+
+@functools.lru_cache(maxsize=None)
+def _has_pip_summary(path: str) -> bool:
+    # Like the connection itself, this is checked once per process: databases are replaced only on redeploy
+    conn = get_sqlite_connection(path)
+    with _SQLITE_LOCK:
+        return pip_summary.has_summary_tables(conn)
+
+
+def _best_pip_rowid(
+    path: str,
+    chrom: str,
+    start: int,
+    end: int,
+    table: str,
+    filters: ty.Dict[str, str],
+) -> ty.Optional[int]:
+    """Find the best row in a region from the summary tables, reading one summary row per whole bin"""
+    bins, edges = pip_summary.cover_region(start, end)
+    conditions = "".join(f" AND {name}=?" for name in filters)
+    candidates = []
+    for size, first, last in bins:
+        candidates.extend(
+            query_sqlite(
+                path,
+                f"SELECT pip, sig_rowid FROM {table} WHERE bin_size=? AND chrom=?{conditions} AND bin BETWEEN ? AND ?",
+                [size, chrom, *filters.values(), first, last],
+            )
+        )
+    for edge_start, edge_end in edges:
+        candidates.extend(
+            query_sqlite(
+                path,
+                f"SELECT pip, rowid FROM sig WHERE chrom=?{conditions} AND pos BETWEEN ? AND ? "
+                "ORDER BY pip DESC, rowid LIMIT 1",
+                [chrom, *filters.values(), edge_start, edge_end],
+            )
+        )
+    if not candidates:
+        return None
+    return min(candidates, key=lambda row: (-row[0], row[1]))[1]
+
+
 # Uses the database above to find the data point with highest PIP value
 def get_best_study_tissue_gene(
     chrom, start=None, end=None, study=None, tissue=None, gene_id=None
 ):
-    conn = sqlite3.connect(get_best_per_variant_lookup())
-    with conn:
-        try:
-            cursor = conn.cursor()
+    path = get_best_per_variant_lookup()
+    summary = pip_summary.find_summary_table(study, tissue, gene_id)
+    try:
+        if (
+            start is not None
+            and end is not None
+            and summary is not None
+            and _has_pip_summary(path)
+        ):
+            # Region queries can be answered from the per-bin summary tables (see fivex.pip_summary)
+            rowid = _best_pip_rowid(path, chrom, start, end, *summary)
+            rows = (
+                query_sqlite(path, "SELECT * FROM sig WHERE rowid=?", [rowid])
+                if rowid is not None
+                else []
+            )
+        else:
             sqlCommand = "SELECT * FROM sig WHERE chrom=?"
             argsList = [chrom]
             if start is not None:
@@ -104,35 +357,40 @@ def get_best_study_tissue_gene(
             if gene_id is not None:
                 sqlCommand += " AND gene_id=?"
                 argsList.append(gene_id)
-            sqlCommand += " ORDER BY pip DESC LIMIT 1"
-            (
-                pip,
-                study,
-                tissue,
-                gene_id,
-                chrom,
-                pos,
-                ref,
-                alt,
-                _,
-                _,
-                _,
-            ) = list(cursor.execute(sqlCommand, tuple(argsList),))[0]
-            bestVar = (gene_id, chrom, pos, ref, alt, pip, study, tissue)
-            return bestVar
-        except IndexError:
-            return abort(400)
-
-
-def get_gene_names_conversion():
-    """Get the compressed file containing two-way mappings of gene_id to gene_symbol"""
-    with gzip.open(
-        os.path.join(
-            current_app.config["FIVEX_DATA_DIR"], "gene.id.symbol.map.json.gz",
-        ),
-        "rt",
-    ) as f:
-        return json.loads(f.read())
+            # Ties are broken by rowid, as in the summary tables
+            sqlCommand += " ORDER BY pip DESC, rowid LIMIT 1"
+            rows = query_sqlite(path, sqlCommand, argsList)
+        (pip, study, tissue, gene_id, chrom, pos, ref, alt, _, _, _,) = rows[0]
+        bestVar = (gene_id, chrom, pos, ref, alt, pip, study, tissue)
+        return bestVar
+    except IndexError:
+        return abort(400)
+
+
+@functools.lru_cache(maxsize=None)
+def _load_gene_names_conversion(path: str) -> ty.Mapping[str, str]:
+    with gzip.open(path, "rt") as f:
+        names = json.load(f)
+    # Identifiers are interned so that parsed rows share the same string objects as the lookup table
+    return types.MappingProxyType(
+        {sys.intern(k): sys.intern(v) for k, v in names.items()}
+    )
+
+
+def get_gene_names_conversion() -> ty.Mapping[str, str]:
+    """
+    Get the two-way mappings of gene_id to gene_symbol (from a compressed JSON file)
+
+    The table is built once per process on first use and shared (read-only) by every request. If it is loaded
+    before the server forks worker processes, the workers share the same memory pages copy-on-write.
+    """
+    return _load_gene_names_conversion(get_gene_names_path())
+
+
+def get_gene_names_path() -> str:
+    return os.path.join(
+        current_app.config["FIVEX_DATA_DIR"], "gene.id.symbol.map.json.gz",
+    )
 
 
 # If requesting a single variant, then return the merged credible_sets file for a single chromosome
@@ -176,22 +434,83 @@ def get_credible_data_table(chrom, datatype="ge"):
     )
 
 
-# Takes in chromosome and position, and returns (chrom, pos, ref, alt, rsid)
 # rsid.sqlite3.db is created by util/create.rsid.sqlite3.py
-def return_rsid(chrom, pos):
-    rsid_db = os.path.join(
+def get_rsid_path() -> str:
+    return os.path.join(
         current_app.config["FIVEX_DATA_DIR"], "rsid.sqlite3.db"
     )
-    conn = sqlite3.connect(rsid_db)
-    with conn:
-        try:
-            cursor = conn.cursor()
-            return list(
-                cursor.execute(
-                    "SELECT * FROM rsidTable WHERE chrom=? AND pos=?",
-                    (chrom, pos),
-                )
-            )[0]
-        except ValueError:
-            # TODO: Document schema of the database table and what these placeholder values mean
-            return [chrom, pos, "N", "N", "Unknown"]
+
+
+# Lookups of many values are split into queries with at most this many parameters (SQLite allows 999 by default)
+SQLITE_MAX_PARAMETERS = 500
+
+
+# A row of the rsid database: (chrom, pos, ref, alt, rsid)
+RsidRecord = ty.Tuple[str, int, str, str, str]
+
+
+def _batches(values: ty.Sequence, size: int = SQLITE_MAX_PARAMETERS):
+    for i in range(0, len(values), size):
+        yield values[i : i + size]
+
+
+def find_rsids(rsids: ty.Iterable[str]) -> ty.Dict[str, ty.List[RsidRecord]]:
+    """
+    Look up the variants with each of several rsids, with one query per batch of rsids (using the rsid index)
+
+    An rsid may match more than one variant; rsids that are not found are omitted.
+    """
+    records: ty.Dict[str, ty.List[RsidRecord]] = {}
+    for batch in _batches(sorted(set(rsids))):
+        for record in query_sqlite(
+            get_rsid_path(),
+            "SELECT chrom, pos, ref, alt, rsid FROM rsidTable WHERE rsid IN ({}) ORDER BY chrom, pos, ref, alt".format(
+                ",".join("?" * len(batch))
+            ),
+            batch,
+        ):
+            records.setdefault(record[4], []).append(record)
+    return records
+
+
+def find_positions(
+    positions: ty.Iterable[ty.Tuple[str, int]],
+) -> ty.Dict[ty.Tuple[str, int], ty.List[RsidRecord]]:
+    """
+    Look up the variants at each of several (chrom, pos) positions, with one query per chromosome and batch of
+    positions (using the chrom/pos index)
+
+    Positions with no known variants are omitted.
+    """
+    by_chrom: ty.Dict[str, ty.Set[int]] = {}
+    for chrom, pos in positions:
+        by_chrom.setdefault(chrom, set()).add(pos)
+    records: ty.Dict[ty.Tuple[str, int], ty.List[RsidRecord]] = {}
+    for chrom, chrom_positions in sorted(by_chrom.items()):
+        # One parameter is used by the chromosome
+        for batch in _batches(
+            sorted(chrom_positions), SQLITE_MAX_PARAMETERS - 1
+        ):
+            for record in query_sqlite(
+                get_rsid_path(),
+                "SELECT chrom, pos, ref, alt, rsid FROM rsidTable WHERE chrom=? AND pos IN ({}) ORDER BY pos, ref, alt".format(
+                    ",".join("?" * len(batch))
+                ),
+                [chrom, *batch],
+            ):
+                records.setdefault((record[0], record[1]), []).append(record)
+    return records
+
+
+# Takes in chromosome and position, and returns (chrom, pos, ref, alt, rsid)
+def return_rsid(chrom, pos):
+    try:
+        return query_sqlite(
+            get_rsid_path(),
+            "SELECT * FROM rsidTable WHERE chrom=? AND pos=?",
+            (chrom, pos),
+        )[0]
+    except (ValueError, IndexError):
+        # The variant is not in the database
+        # TODO: Document schema of the database table and what these placeholder values mean
+        return [chrom, pos, "N", "N", "Unknown"]
@@ -0,0 +1,132 @@
+"""
+Multi-resolution summary of the best-PIP database, for fast region lookups
+
+The region view starts by finding the variant with the highest PIP in a region (optionally for one gene, or one study
+and tissue). Answered directly from the `sig` table, this reads and sorts every variant in the region. At ingest time
+(see `util/summarize.highest.pip.for.each.variant.sql.py`), the best row of each fixed-size bin is recorded, at
+several bin sizes; a region query then reads one summary row per bin that it fully covers, plus the variants in the
+(small) partial bins at its edges.
+
+Summary tables, each with the best row per bin (`sig_rowid` is the rowid of that row in `sig`):
+    sig_bin                           (bin_size, chrom, bin) -> pip, sig_rowid
+    sig_bin_gene                      (bin_size, chrom, gene_id, bin) -> pip, sig_rowid
+    sig_bin_study_tissue              (bin_size, chrom, study, tissue, bin) -> pip, sig_rowid
+
+Bin `k` of size `s` holds positions [k * s, (k + 1) * s - 1]. The best row has the highest PIP; ties are broken by
+rowid (the order in which rows were written).
+"""
+import sqlite3
+import typing as ty
+
+# Bin sizes, from largest to smallest
+BIN_SIZES = (1000000, 100000, 10000)
+
+# The columns that each summary table is grouped by (in addition to the chromosome and bin)
+SUMMARY_TABLES = {
+    "sig_bin": (),
+    "sig_bin_gene": ("gene_id",),
+    "sig_bin_study_tissue": ("study", "tissue"),
+}
+
+# Indexes that cover the filtered region queries on `sig` (for the partial bins at the edges of a region)
+COVERING_INDEXES = {
+    "idx_chrom_pos_pip": ("chrom", "pos", "pip"),
+    "idx_gene_chrom_pos_pip": ("gene_id", "chrom", "pos", "pip"),
+    "idx_study_tissue_chrom_pos_pip": (
+        "study",
+        "tissue",
+        "chrom",
+        "pos",
+        "pip",
+    ),
+}
+
+# A run of whole bins: (bin size, first bin, last bin)
+BinRange = ty.Tuple[int, int, int]
+
+
+def find_summary_table(
+    study: ty.Optional[str] = None,
+    tissue: ty.Optional[str] = None,
+    gene_id: ty.Optional[str] = None,
+) -> ty.Optional[ty.Tuple[str, ty.Dict[str, str]]]:
+    """
+    Find the summary table that can answer a query with the given filters
+
+    :return: The table name and the filters on its columns, or None if no summary table groups by these filters
+    """
+    filters = {
+        name: value
+        for name, value in (
+            ("study", study),
+            ("tissue", tissue),
+            ("gene_id", gene_id),
+        )
+        if value is not None
+    }
+    for table, columns in SUMMARY_TABLES.items():
+        if set(columns) == set(filters):
+            return table, filters
+    return None
+
+
+def cover_region(
+    start: int, end: int, bin_sizes: ty.Sequence[int] = BIN_SIZES
+) -> ty.Tuple[ty.List[BinRange], ty.List[ty.Tuple[int, int]]]:
+    """
+    Split a region [start, end] (inclusive) into runs of whole bins (using the largest bins that fit), and the
+    leftover edges that are smaller than the smallest bin
+
+    :return: A list of bin runs, and a list of (start, end) edges
+    """
+    if start > end:
+        return [], []
+    if not bin_sizes:
+        return [], [(start, end)]
+    size, smaller = bin_sizes[0], bin_sizes[1:]
+    first = -(-start // size)
+    last = (end + 1) // size - 1
+    if first > last:
+        return cover_region(start, end, smaller)
+    left_bins, left_edges = cover_region(start, first * size - 1, smaller)
+    right_bins, right_edges = cover_region((last + 1) * size, end, smaller)
+    return (
+        left_bins + [(size, first, last)] + right_bins,
+        left_edges + right_edges,
+    )
+
+
+def has_summary_tables(conn: sqlite3.Connection) -> bool:
+    names = {
+        name
+        for (name,) in conn.execute(
+            "SELECT name FROM sqlite_master WHERE type='table'"
+        )
+    }
+    return set(SUMMARY_TABLES) <= names
+
+
+def build_summary_tables(
+    conn: sqlite3.Connection, bin_sizes: ty.Sequence[int] = BIN_SIZES
+):
+    """(Re-)create the summary tables and covering indexes of a best-PIP database, from its `sig` table"""
+    for table, columns in SUMMARY_TABLES.items():
+        group = ", ".join(("chrom",) + columns)
+        conn.execute(f"DROP TABLE IF EXISTS {table}")
+        conn.execute(
+            f"CREATE TABLE {table} (bin_size INTEGER, {' TEXT, '.join(('chrom',) + columns)} TEXT, bin INTEGER, "
+            f"pip REAL, sig_rowid INTEGER, PRIMARY KEY (bin_size, {group}, bin)) WITHOUT ROWID"
+        )
+        for size in bin_sizes:
+            conn.execute(
+                f"INSERT INTO {table} (bin_size, {group}, bin, pip, sig_rowid) "
+                f"SELECT ?, {group}, bin, pip, sig_rowid FROM ("
+                f"  SELECT {group}, pos / ? AS bin, pip, rowid AS sig_rowid, ROW_NUMBER() OVER ("
+                f"    PARTITION BY {group}, pos / ? ORDER BY pip DESC, rowid"
+                f"  ) AS rank FROM sig"
+                f") WHERE rank = 1",
+                (size, size, size),
+            )
+    for name, columns in COVERING_INDEXES.items():
+        conn.execute(f"DROP INDEX IF EXISTS {name}")
+        conn.execute(f"CREATE INDEX {name} ON sig ({', '.join(columns)})")
@@ -0,0 +1,287 @@
+"""
+Server-side cache of API and view responses
+
+Many users look at the same few regions and variants (eg the examples on the homepage), and every request reads,
+filters, and serializes the same data again. Responses are cached by a key built from the endpoint, its normalized
+parameters, the version of the app, the storage backend, and the exact versions of the data files it reads (see
+`fivex.conditional.data_version`), so that a redeployed app or file (or a change to one of the data directories
+itself) is never served stale, even from the directory tier, which outlives each deploy. Parameters are normalized so that
+equivalent requests share an entry: the "chr" prefix of chromosomes and the version suffix of gene and transcript IDs
+are removed, and query parameters are sorted.
+
+There are two tiers:
+    - An in-memory LRU cache (per worker process), bounded by the total size of the responses it holds
+    - Optionally, a directory (eg on `/dev/shm` or a local disk) shared by all worker processes
+
+Streamed responses are still streamed: the body is copied as it is sent, and stored only if the response completes.
+
+When a link is shared, many clients can request the same data at once, before any response has been cached. Identical
+requests that arrive while the first is still being computed (in the same worker process) wait for it, and share its
+body, rather than all reading and parsing the same data ("single flight"). `stats()` reports how many were collapsed.
+"""
+import functools
+import hashlib
+import typing as ty
+
+from flask import current_app, request
+
+from .cache import DirectoryCache, Flight, LRUCache, SingleFlight
+from .conditional import FileLister, data_version, file_identity
+
+# Rough memory overhead of each entry in the in-memory tier, in addition to the size of the body
+_ENTRY_BYTES = 256
+
+_MEMORY_CACHE: ty.Optional[LRUCache] = None
+_DIRECTORY_CACHE: ty.Optional[DirectoryCache] = None
+_SINGLE_FLIGHT: ty.Optional[SingleFlight] = None
+
+# Requests that are coalesced share the response body, unless it is larger than this (or a cache tier, if larger)
+COALESCE_MAX_BYTES = 64 * 1024 ** 2
+
+# A response: mimetype and body
+Entry = ty.Tuple[str, bytes]
+
+
+def get_memory_cache() -> ty.Optional[LRUCache]:
+    """Get the in-memory response cache for this worker process, or None if it is disabled"""
+    global _MEMORY_CACHE
+    max_bytes = current_app.config["FIVEX_RESPONSE_CACHE_BYTES"]
+    if not max_bytes:
+        return None
+    if _MEMORY_CACHE is None or _MEMORY_CACHE.max_bytes != max_bytes:
+        _MEMORY_CACHE = LRUCache(max_bytes)
+    return _MEMORY_CACHE
+
+
+def get_directory_cache() -> ty.Optional[DirectoryCache]:
+    """Get the response cache directory shared by all worker processes, or None if it is not configured"""
+    global _DIRECTORY_CACHE
+    path = current_app.config["FIVEX_RESPONSE_CACHE_DIR"]
+    max_bytes = current_app.config["FIVEX_RESPONSE_CACHE_DIR_BYTES"]
+    if not path or not max_bytes:
+        return None
+    if (
+        _DIRECTORY_CACHE is None
+        or _DIRECTORY_CACHE.path != path
+        or _DIRECTORY_CACHE.max_bytes != max_bytes
+    ):
+        _DIRECTORY_CACHE = DirectoryCache(path, max_bytes)
+    return _DIRECTORY_CACHE
+
+
+def get_single_flight() -> ty.Optional[SingleFlight]:
+    """Get the tracker of in-flight requests for this worker process, or None if request coalescing is disabled"""
+    global _SINGLE_FLIGHT
+    timeout = current_app.config["FIVEX_REQUEST_COALESCING_TIMEOUT"]
+    if not timeout:
+        return None
+    if _SINGLE_FLIGHT is None or _SINGLE_FLIGHT.timeout != timeout:
+        _SINGLE_FLIGHT = SingleFlight(timeout)
+    return _SINGLE_FLIGHT
+
+
+def _max_entry_bytes(
+    memory: ty.Optional[LRUCache], directory: ty.Optional[DirectoryCache]
+) -> int:
+    """The size of the largest response body that is worth copying (to store or share)"""
+    return max(
+        COALESCE_MAX_BYTES,
+        memory.max_bytes if memory is not None else 0,
+        directory.max_bytes if directory is not None else 0,
+    )
+
+
+def _normalize(name: str, value: ty.Any) -> ty.Any:
+    """
+    Normalize a request parameter, so that equivalent requests share a cache entry
+
+    Every cached view must give the same response for parameters that normalize to the same value (eg by removing the
+    "chr" prefix and gene versions itself), or one form would be served the response of the other.
+    """
+    if not isinstance(value, str):
+        return value
+    if name == "chrom" and value.startswith("chr"):
+        return value[3:]
+    if name in ("gene_id", "transcript"):
+        return value.split(".")[0]
+    return value
+
+
+def cache_key(files: ty.Iterable[str] = ()) -> str:
+    """Build the cache key of the current request, given the data files that it reads"""
+    view_args = request.view_args or {}
+    parts = [
+        request.endpoint,
+        sorted(
+            (name, _normalize(name, value))
+            for name, value in view_args.items()
+        ),
+        sorted(
+            (name, _normalize(name, value))
+            for name, value in request.args.items(multi=True)
+        ),
+        current_app.config["FIVEX_STORAGE_BACKEND"],
+        data_version(files),
+        # Adding or removing files changes the modification time of the directory that holds them
+        [
+            file_identity(current_app.config[name])
+            for name in (
+                "FIVEX_DATA_DIR",
+                "FIVEX_COLUMNAR_DIR",
+                "FIVEX_GENE_INDEX_DIR",
+            )
+        ],
+    ]
+    return hashlib.sha1(repr(parts).encode()).hexdigest()
+
+
+def _encode(mimetype: str, body: bytes) -> bytes:
+    return mimetype.encode() + b"\n" + body
+
+
+def _decode(record: bytes) -> Entry:
+    mimetype, _, body = record.partition(b"\n")
+    return mimetype.decode(), body
+
+
+def _lookup(
+    memory: ty.Optional[LRUCache],
+    directory: ty.Optional[DirectoryCache],
+    key: str,
+) -> ty.Optional[Entry]:
+    entry = memory.get(key) if memory is not None else None
+    if entry is None and directory is not None:
+        record = directory.get(key)
+        if record is not None:
+            entry = _decode(record)
+            if memory is not None:
+                memory.put(key, entry, size=len(entry[1]) + _ENTRY_BYTES)
+    return entry
+
+
+def _store(
+    memory: ty.Optional[LRUCache],
+    directory: ty.Optional[DirectoryCache],
+    flight: ty.Optional[ty.Tuple[SingleFlight, Flight]],
+    key: str,
+    mimetype: str,
+    body: ty.Optional[bytes],
+):
+    """Store a response body (or None, if the response could not be stored), and share it with waiting requests"""
+    if body is not None:
+        if memory is not None:
+            memory.put(key, (mimetype, body), size=len(body) + _ENTRY_BYTES)
+        if directory is not None:
+            directory.put(key, _encode(mimetype, body))
+    if flight is not None:
+        flights, token = flight
+        flights.finish(
+            key, token, (mimetype, body) if body is not None else None
+        )
+
+
+def _copy_while_streaming(
+    pieces: ty.Iterable[bytes],
+    max_bytes: int,
+    on_complete: ty.Callable[[ty.Optional[bytes]], None],
+) -> ty.Iterator[bytes]:
+    """
+    Pass through the pieces of a streamed response, and provide the full body once the stream is complete
+
+    If the body is too large, or the stream is not completed (eg the client disconnects), None is provided instead.
+    """
+    buffer: ty.Optional[ty.List[bytes]] = []
+    size = 0
+    try:
+        for piece in pieces:
+            if buffer is not None:
+                size += len(piece)
+                if size <= max_bytes:
+                    buffer.append(piece)
+                else:
+                    # Stop copying responses that are too large to be stored
+                    buffer = None
+            yield piece
+    except BaseException:
+        buffer = None
+        raise
+    finally:
+        on_complete(b"".join(buffer) if buffer is not None else None)
+
+
+def cached(files: ty.Optional[FileLister] = None):
+    """
+    Decorate a view to cache its successful responses on the server
+
+    Concurrent identical requests (in the same worker process) are also coalesced: only the first computes the
+    response, and the others wait for it and share its body.
+
+    :param files: A function that lists the data files read by the view, called with the same arguments as the view.
+        Files used by all views (see `fivex.conditional.support_files`) do not need to be listed.
+    """
+
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            memory = get_memory_cache()
+            directory = get_directory_cache()
+            flights = get_single_flight()
+            if memory is None and directory is None and flights is None:
+                return view(*args, **kwargs)
+
+            key = cache_key(
+                files(*args, **kwargs) if files is not None else ()
+            )
+            entry = _lookup(memory, directory, key)
+            flight = None
+            if (
+                entry is None
+                and flights is not None
+                and request.method == "GET"
+            ):
+                leader, token = flights.begin(key)
+                if leader:
+                    flight = (flights, token)
+                else:
+                    # If the leader fails, compute the response independently
+                    entry = flights.wait(token)
+            if entry is not None:
+                mimetype, body = entry
+                return current_app.response_class(body, mimetype=mimetype)
+
+            try:
+                response = current_app.make_response(view(*args, **kwargs))
+            except BaseException:
+                _store(None, None, flight, key, "", None)
+                raise
+            store = functools.partial(
+                _store, memory, directory, flight, key, response.mimetype
+            )
+            if response.status_code != 200:
+                store(None)
+            elif response.is_streamed:
+                response.response = _copy_while_streaming(
+                    response.response,
+                    _max_entry_bytes(memory, directory),
+                    store,
+                )
+                if flight is not None:
+                    # The stream may never start (eg for a HEAD request): never leave other requests waiting
+                    response.call_on_close(functools.partial(store, None))
+            else:
+                store(response.get_data())
+            return response
+
+        return wrapper
+
+    return decorator
+
+
+def stats() -> dict:
+    """Report how well the response cache (and request coalescing) is working in this worker process"""
+    return {
+        "memory": _MEMORY_CACHE.stats() if _MEMORY_CACHE is not None else None,
+        "coalescing": _SINGLE_FLIGHT.stats()
+        if _SINGLE_FLIGHT is not None
+        else None,
+    }
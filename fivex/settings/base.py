@@ -25,6 +25,81 @@ FIVEX_DATA_DIR = os.getenv(
     ),
 )
 
+# Size (in bytes) of the memory-mapped region used when reading SQLite databases. Set to 0 to disable mmap I/O.
+FIVEX_SQLITE_MMAP_SIZE = int(
+    os.getenv("FIVEX_SQLITE_MMAP_SIZE", 256 * 1024 ** 2)
+)
+
+# Each worker process keeps a pool of open tabix files (with parsed indexes), to avoid re-opening files on every
+#   request. The pool is bounded by the number of idle handles and the estimated memory used by their indexes.
+FIVEX_TABIX_POOL_SIZE = int(os.getenv("FIVEX_TABIX_POOL_SIZE", 64))
+FIVEX_TABIX_POOL_INDEX_BYTES = int(
+    os.getenv("FIVEX_TABIX_POOL_INDEX_BYTES", 256 * 1024 ** 2)
+)
+
+# Decompressed blocks of tabix files can be cached in memory (per worker process), so that repeated queries over the
+#   same region do not decompress the same data again. Set the size (in bytes) to 0 to read files with pysam instead.
+#   Optionally, blocks can also be shared by all workers through a directory on a memory-backed filesystem.
+FIVEX_BLOCK_CACHE_BYTES = int(
+    os.getenv("FIVEX_BLOCK_CACHE_BYTES", 128 * 1024 ** 2)
+)
+FIVEX_BLOCK_CACHE_DIR = os.getenv("FIVEX_BLOCK_CACHE_DIR", None)
+FIVEX_BLOCK_CACHE_SHARED_BYTES = int(
+    os.getenv("FIVEX_BLOCK_CACHE_SHARED_BYTES", 1024 ** 3)
+)
+
+# Parsed credible sets (PIPs) are cached per file and region, in memory (per worker process). The cache is bounded by
+#   the estimated size (in bytes) of its entries. Set to 0 to disable.
+FIVEX_CREDIBLE_SET_CACHE_BYTES = int(
+    os.getenv("FIVEX_CREDIBLE_SET_CACHE_BYTES", 64 * 1024 ** 2)
+)
+
+# Association data can be read from the tabix-indexed text files ("tabix"), or from a columnar copy of each file
+#   ("columnar"), created at ingest time by `util/convert.tabix.to.columnar.py`. Files that have not been converted
+#   are always read with tabix. Columnar copies live in a mirror of the data directory (by default, the data directory).
+FIVEX_STORAGE_BACKEND = os.getenv("FIVEX_STORAGE_BACKEND", "tabix")
+FIVEX_COLUMNAR_DIR = os.getenv("FIVEX_COLUMNAR_DIR", FIVEX_DATA_DIR)
+
+# Study- and tissue-specific files can have a gene index, created at ingest time by `util/build.gene.index.py`, so that
+#   region queries for one gene only read the rows for that gene. Indexes live in a mirror of the data directory (by
+#   default, the data directory). They are used by the built-in tabix reader, and so require a block cache.
+FIVEX_GENE_INDEX_DIR = os.getenv("FIVEX_GENE_INDEX_DIR", FIVEX_DATA_DIR)
+
+# API and view responses carry ETags (based on the data files they read), so that browsers and proxies can cache
+#   them and revalidate cheaply. By default, cached responses must be revalidated before every use; set a maximum age
+#   (in seconds) to let them be reused without asking, at the cost of serving stale data for a while after a redeploy.
+FIVEX_HTTP_CACHE_MAX_AGE = int(os.getenv("FIVEX_HTTP_CACHE_MAX_AGE", 0))
+
+# ETags (and server-side cache keys) also identify the version of the app that made each response, from a hash of its
+#   source code. A deploy ID (eg a git commit or release tag) can be added to also cover changes that are not in the
+#   Python code, such as installed dependencies.
+FIVEX_DEPLOY_ID = os.getenv("FIVEX_DEPLOY_ID", "")
+
+# Batch queries (one region in several tracks, or many variants) read all of their files in one request, so the number
+#   of tracks or variants in one request is limited.
+FIVEX_BATCH_MAX_TRACKS = int(os.getenv("FIVEX_BATCH_MAX_TRACKS", 50))
+FIVEX_BATCH_MAX_VARIANTS = int(os.getenv("FIVEX_BATCH_MAX_VARIANTS", 1000))
+# Batch rsid lookups are cheap (only the rsid database is read), so many more are allowed per request
+FIVEX_BATCH_MAX_LOOKUPS = int(os.getenv("FIVEX_BATCH_MAX_LOOKUPS", 10000))
+
+# Successful API and view responses are also cached on the server, keyed by their (normalized) parameters and the
+#   versions of the data files they read. Each worker process keeps an in-memory cache, bounded by the total size (in
+#   bytes) of the responses it holds; set to 0 to disable. Optionally, responses can also be shared by all workers
+#   through a directory (eg on `/dev/shm` or a local disk), bounded by the total size of its files.
+FIVEX_RESPONSE_CACHE_BYTES = int(
+    os.getenv("FIVEX_RESPONSE_CACHE_BYTES", 256 * 1024 ** 2)
+)
+FIVEX_RESPONSE_CACHE_DIR = os.getenv("FIVEX_RESPONSE_CACHE_DIR", None)
+FIVEX_RESPONSE_CACHE_DIR_BYTES = int(
+    os.getenv("FIVEX_RESPONSE_CACHE_DIR_BYTES", 1024 ** 3)
+)
+
+# Identical requests that arrive while the first is still being computed wait for it (up to this many seconds), and
+#   share its response, rather than repeating the same work. Set to 0 to disable.
+FIVEX_REQUEST_COALESCING_TIMEOUT = float(
+    os.getenv("FIVEX_REQUEST_COALESCING_TIMEOUT", 30)
+)
+
 # .env file can optionally provide a Sentry key for automatic error reporting
 # TODO: add for frontend and backend
 SENTRY_DSN = os.getenv("SENTRY_DSN", None)
@@ -14,3 +14,6 @@ FIVEX_DATA_DIR = os.path.join(
     ),
     "data",
 )
+
+# Each test controls its own server-side caching, so that results never leak between tests
+FIVEX_RESPONSE_CACHE_BYTES = 0
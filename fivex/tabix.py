@@ -0,0 +1,615 @@
+"""
+Shared access to tabix-indexed data files
+
+Opening a tabix file means opening the bgzipped data file, and reading and parsing its entire `.tbi` index. Small
+queries (such as a single variant) can spend most of their time doing this, so each worker process keeps a pool of
+open file handles (with their parsed indexes) that are reused across requests.
+
+Adjacent and repeated queries also tend to read the same compressed (BGZF) blocks of the same files. When a block
+cache is configured, files are read by a pure-Python tabix reader that keeps decompressed blocks in memory (and,
+optionally, in a directory shared by all worker processes), instead of inflating each block again on every request.
+"""
+import collections
+import functools
+import gzip
+import os
+import struct
+import threading
+import typing as ty
+import zlib
+
+import pysam  # type: ignore
+from flask import current_app
+from zorp import readers  # type: ignore
+
+from .cache import DirectoryCache, LRUCache
+
+
+class TabixPool:
+    """
+    A per-process pool of open tabix file handles, keyed by path
+
+    A handle is checked out for the duration of a single fetch, so that two iterators over the same file (eg from
+    requests interleaved by gevent) never share a file position. Idle handles are kept in least-recently-used order,
+    and the oldest are closed when the pool holds more than `max_handles` handles, or when the (estimated) memory used
+    by their indexes exceeds `max_index_bytes`.
+    """
+
+    def __init__(
+        self,
+        max_handles: int = 64,
+        max_index_bytes: int = 256 * 1024 ** 2,
+        opener: ty.Callable[[str], ty.Any] = pysam.TabixFile,
+    ):
+        self.max_handles = max_handles
+        self.max_index_bytes = max_index_bytes
+        self._opener = opener
+
+        # Idle handles, in LRU order: the first entry is the least recently used. Each entry is (path, handle, size).
+        self._idle: ty.Deque[ty.Tuple[str, ty.Any, int]] = collections.deque()
+        self._index_bytes = 0
+        self._lock = threading.Lock()
+
+        # Counters for monitoring how well the pool is working
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _index_size(path: str) -> int:
+        """Estimate the memory used by the parsed index of a file (the index is compressed on disk)"""
+        try:
+            return 4 * os.path.getsize(f"{path}.tbi")
+        except OSError:
+            return 0
+
+    def acquire(self, path: str) -> ty.Any:
+        """Check out a handle for the specified file, opening the file if no idle handle is available"""
+        with self._lock:
+            # Search from the most recently used end, since hot files are likely to be there
+            for i in range(len(self._idle) - 1, -1, -1):
+                idle_path, handle, size = self._idle[i]
+                if idle_path == path:
+                    del self._idle[i]
+                    self._index_bytes -= size
+                    self.hits += 1
+                    return handle
+            self.misses += 1
+        return self._opener(path)
+
+    def release(self, path: str, handle: ty.Any):
+        """Return a handle to the pool, making it available to other requests"""
+        evicted = []
+        size = self._index_size(path)
+        with self._lock:
+            self._idle.append((path, handle, size))
+            self._index_bytes += size
+            while self._idle and (
+                len(self._idle) > self.max_handles
+                or self._index_bytes > self.max_index_bytes
+            ):
+                _, old_handle, old_size = self._idle.popleft()
+                self._index_bytes -= old_size
+                self.evictions += 1
+                evicted.append(old_handle)
+        for old_handle in evicted:
+            old_handle.close()
+
+    def fetch(
+        self, path: str, chrom: str, start: int, end: int
+    ) -> ty.Iterator[str]:
+        """
+        Fetch the raw lines of a region of the file, using a pooled handle
+
+        Errors from the underlying fetch (eg an unknown chromosome) are raised immediately, not on first iteration.
+        """
+        handle = self.acquire(path)
+        try:
+            iterator = handle.fetch(chrom, start, end)
+        except BaseException:
+            self.release(path, handle)
+            raise
+        return self._iterate(path, handle, iterator)
+
+    def _iterate(
+        self, path: str, handle: ty.Any, iterator: ty.Iterator[str]
+    ) -> ty.Iterator[str]:
+        try:
+            yield from iterator
+        finally:
+            # The handle is returned when iteration completes, or when the consumer discards the generator
+            self.release(path, handle)
+
+    def read_lines_at(
+        self, path: str, offsets: ty.Iterable[int]
+    ) -> ty.Iterator[str]:
+        """
+        Read the lines that start at each of a sequence of virtual file offsets, using a pooled handle
+
+        This requires the built-in tabix reader (a block cache must be configured).
+        """
+        handle = self.acquire(path)
+        if not hasattr(handle, "read_lines_at"):
+            self.release(path, handle)
+            raise TypeError(
+                "Reading lines by offset requires the built-in tabix reader"
+            )
+        return self._iterate(path, handle, handle.read_lines_at(offsets))
+
+    def clear(self):
+        """Close all idle handles"""
+        with self._lock:
+            idle = [handle for _, handle, _ in self._idle]
+            self._idle.clear()
+            self._index_bytes = 0
+        for handle in idle:
+            handle.close()
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "idle_handles": len(self._idle),
+            "index_bytes": self._index_bytes,
+        }
+
+
+class TabixIndex:
+    """
+    A parsed tabix (.tbi) index
+
+    See the specification: https://samtools.github.io/hts-specs/tabix.pdf
+    """
+
+    # Tabix uses the UCSC binning scheme: 5 levels of bins, with the smallest bins spanning 16kb
+    _MIN_SHIFT = 14
+    _LEVELS = ((26, 1), (23, 9), (20, 73), (17, 585), (14, 4681))
+
+    def __init__(self, path: str):
+        with gzip.open(path, "rb") as f:
+            data = f.read()
+
+        (
+            magic,
+            n_ref,
+            fmt,
+            col_seq,
+            col_beg,
+            col_end,
+            meta,
+            skip,
+            l_nm,
+        ) = struct.unpack_from("<4s8i", data, 0)
+        if magic != b"TBI\x01":
+            raise ValueError(f"Not a tabix index: {path}")
+        self.format = fmt
+        # Column numbers are 1-based in the index, and 0-based here
+        self.col_seq = col_seq - 1
+        self.col_beg = col_beg - 1
+        self.col_end = col_end - 1
+        self.meta = chr(meta)
+        self.skip = skip
+
+        offset = 36
+        names = data[offset : offset + l_nm].split(b"\x00")[:n_ref]
+        self.names = {name.decode(): i for i, name in enumerate(names)}
+        offset += l_nm
+
+        # For each reference sequence: {bin: [(begin, end) virtual offsets]}, and the linear index
+        self.bins: ty.List[ty.Dict[int, ty.List[ty.Tuple[int, int]]]] = []
+        self.linear: ty.List[ty.Tuple[int, ...]] = []
+        for _ in range(n_ref):
+            (n_bin,) = struct.unpack_from("<i", data, offset)
+            offset += 4
+            bins = {}
+            for _ in range(n_bin):
+                bin_number, n_chunk = struct.unpack_from("<Ii", data, offset)
+                offset += 8
+                chunks = struct.unpack_from(f"<{2 * n_chunk}Q", data, offset)
+                offset += 16 * n_chunk
+                bins[bin_number] = list(zip(chunks[::2], chunks[1::2]))
+            (n_intv,) = struct.unpack_from("<i", data, offset)
+            offset += 4
+            self.linear.append(struct.unpack_from(f"<{n_intv}Q", data, offset))
+            offset += 8 * n_intv
+            self.bins.append(bins)
+
+    @classmethod
+    def _region_bins(cls, beg: int, end: int) -> ty.Iterator[int]:
+        end -= 1
+        yield 0
+        for shift, first in cls._LEVELS:
+            yield from range(
+                first + (beg >> shift), first + (end >> shift) + 1
+            )
+
+    def chunks(
+        self, chrom: str, beg: int, end: int
+    ) -> ty.List[ty.Tuple[int, int]]:
+        """Find the (merged, sorted) ranges of virtual file offsets that may contain records in [beg, end)"""
+        tid = self.names[chrom]
+        linear = self.linear[tid]
+        if linear:
+            min_offset = linear[min(beg >> self._MIN_SHIFT, len(linear) - 1)]
+        else:
+            min_offset = 0
+
+        bins = self.bins[tid]
+        candidates = sorted(
+            chunk
+            for bin_number in self._region_bins(beg, end)
+            for chunk in bins.get(bin_number, ())
+            if chunk[1] > min_offset
+        )
+        merged: ty.List[ty.Tuple[int, int]] = []
+        for chunk_beg, chunk_end in candidates:
+            chunk_beg = max(chunk_beg, min_offset)
+            if merged and chunk_beg <= merged[-1][1]:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], chunk_end))
+            else:
+                merged.append((chunk_beg, chunk_end))
+        return merged
+
+
+class BlockCache:
+    """
+    A cache of decompressed BGZF blocks, keyed by (file identity, block offset)
+
+    Blocks are kept in a per-process LRU cache, bounded in bytes. Optionally, blocks can also be shared between worker
+    processes through a directory on a memory-backed filesystem (such as `/dev/shm`): each block is written there
+    once, atomically, and can then be read by every worker without decompressing it again.
+    """
+
+    def __init__(
+        self,
+        max_bytes: int,
+        shared_dir: ty.Optional[str] = None,
+        shared_max_bytes: int = 1024 ** 3,
+    ):
+        self._blocks = LRUCache(max_bytes)
+        self._shared = (
+            DirectoryCache(shared_dir, shared_max_bytes)
+            if shared_dir
+            else None
+        )
+        self.shared_hits = 0
+
+    def get(
+        self, key: ty.Tuple, load: ty.Callable[[], ty.Tuple[bytes, int]]
+    ) -> ty.Tuple[bytes, int]:
+        """
+        Get a block (as a tuple of decompressed data and compressed size), decompressing it if it is not cached
+        """
+        block = self._blocks.get(key)
+        if block is not None:
+            return block
+
+        if self._shared is not None:
+            record = self._shared.get(key)
+            if record is not None and len(record) >= 4:
+                self.shared_hits += 1
+                block = (record[4:], struct.unpack_from("<I", record)[0])
+        if block is None:
+            block = load()
+            if self._shared is not None:
+                self._shared.put(key, struct.pack("<I", block[1]) + block[0])
+
+        self._blocks.put(key, block, size=len(block[0]) + 64)
+        return block
+
+    def stats(self) -> dict:
+        return dict(self._blocks.stats(), shared_hits=self.shared_hits)
+
+
+def read_bgzf_block(fd: int, offset: int, path: str) -> ty.Tuple[bytes, int]:
+    """Read and decompress the BGZF block at a file offset. Returns the data and the (compressed) size of the block."""
+    header = os.pread(fd, 18, offset)
+    if len(header) < 18:
+        # End of file
+        return b"", 0
+    # The BGZF block size is stored in the "BC" extra subfield of the gzip header
+    (xlen,) = struct.unpack_from("<H", header, 10)
+    extra = os.pread(fd, xlen, offset + 12)
+    block_size = None
+    pos = 0
+    while pos + 4 <= len(extra):
+        si1, si2, slen = struct.unpack_from("<BBH", extra, pos)
+        if si1 == 66 and si2 == 67:
+            (block_size,) = struct.unpack_from("<H", extra, pos + 4)
+            block_size += 1
+            break
+        pos += 4 + slen
+    if block_size is None:
+        raise ValueError(f"Not a BGZF file: {path}")
+
+    payload = os.pread(fd, block_size - 12 - xlen - 8, offset + 12 + xlen)
+    return zlib.decompress(payload, -15), block_size
+
+
+class CachedTabixFile:
+    """
+    A minimal, read-only tabix file reader, which decompresses BGZF blocks through a shared block cache
+
+    This implements the subset of the `pysam.TabixFile` interface used by FIVEx (`fetch` and `close`). File reads use
+    positional I/O, so one instance can safely serve several iterators at once.
+    """
+
+    def __init__(self, path: str, block_cache: BlockCache):
+        self.path = path
+        self.index = TabixIndex(f"{path}.tbi")
+        self._block_cache = block_cache
+        self._fd = os.open(path, os.O_RDONLY)
+        stat = os.fstat(self._fd)
+        # Cached blocks are tied to this exact version of the file, so that a redeploy never serves stale data
+        self._identity = (path, stat.st_size, stat.st_mtime_ns)
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def __del__(self):
+        self.close()
+
+    def _load_block(self, offset: int) -> ty.Tuple[bytes, int]:
+        return read_bgzf_block(self._fd, offset, self.path)
+
+    def _block(self, offset: int) -> ty.Tuple[bytes, int]:
+        return self._block_cache.get(
+            self._identity + (offset,), lambda: self._load_block(offset)
+        )
+
+    def _read_lines(
+        self, chunk_beg: int, chunk_end: int
+    ) -> ty.Iterator[ty.List[str]]:
+        """
+        Read all lines that start within a range of virtual file offsets
+
+        Lines are returned in batches (about one batch per block), so that the caller can filter them in bulk.
+        """
+        block_offset = chunk_beg >> 16
+        position = chunk_beg & 0xFFFF
+        end_block = chunk_end >> 16
+        end_position = chunk_end & 0xFFFF
+        pending = b""
+        while True:
+            data, block_size = self._block(block_offset)
+            if not block_size:
+                # End of file
+                if pending:
+                    yield [pending.decode()]
+                return
+
+            if block_offset >= end_block:
+                # The last block of the range: read up to the end of the last line that starts before the end offset
+                #   (or just finish the line carried over from the previous block)
+                if not pending and end_position <= position:
+                    return
+                newline = data.find(b"\n", max(position, end_position - 1))
+                if newline != -1:
+                    buffer = pending + data[position:newline]
+                    yield buffer.decode().split("\n")
+                    return
+                # The last line continues into the next block
+                end_position = 0
+
+            buffer = pending + data[position:]
+            cut = buffer.rfind(b"\n")
+            if cut == -1:
+                pending = buffer
+            else:
+                yield buffer[:cut].decode().split("\n")
+                pending = buffer[cut + 1 :]
+            block_offset += block_size
+            position = 0
+            end_block = max(end_block, block_offset)
+
+    def read_lines_at(self, offsets: ty.Iterable[int]) -> ty.Iterator[str]:
+        """Read the lines that start at each of a sequence of virtual file offsets (see `iter_lines_with_offsets`)"""
+        for offset in offsets:
+            block_offset = offset >> 16
+            data, block_size = self._block(block_offset)
+            start = offset & 0xFFFF
+            newline = data.find(b"\n", start)
+            if newline != -1:
+                yield data[start:newline].decode()
+                continue
+            # The line continues into the following block(s)
+            pieces = [data[start:]]
+            while block_size:
+                block_offset += block_size
+                data, block_size = self._block(block_offset)
+                newline = data.find(b"\n")
+                if newline != -1:
+                    pieces.append(data[:newline])
+                    break
+                pieces.append(data)
+            yield b"".join(pieces).decode()
+
+    def fetch(self, chrom: str, start: int, end: int) -> ty.Iterator[str]:
+        """Fetch the lines of all records that overlap a region (0-based, half-open), like `pysam.TabixFile.fetch`"""
+        if start < 0:
+            raise ValueError(f"start out of range ({start})")
+        if end < start:
+            raise ValueError(f"invalid region: start ({start}) > end ({end})")
+        try:
+            chunks = self.index.chunks(chrom, start, end)
+        except KeyError:
+            raise ValueError(
+                f"could not create iterator for region '{chrom}:{start + 1}-{end}'"
+            )
+        if start == end:
+            # An empty region overlaps nothing (even a record that starts at that position)
+            return iter(())
+        return self._fetch(chrom, start, end, chunks)
+
+    def _interval(
+        self, line: str, chrom: str
+    ) -> ty.Optional[ty.Tuple[int, int]]:
+        """
+        Parse the (0-based, half-open) interval of a record, following the rules of htslib
+
+        Returns None for lines that are not records, and (-1, -1) for records on other chromosomes.
+        """
+        index = self.index
+        if not line or line.startswith(index.meta):
+            return None
+        fields = line.split(
+            "\t", max(index.col_seq, index.col_beg, index.col_end) + 1
+        )
+        try:
+            if fields[index.col_seq] != chrom:
+                return -1, -1
+            beg = int(fields[index.col_beg])
+            if index.col_end != index.col_beg:
+                end = int(fields[index.col_end])
+            elif index.format & 0x10000:
+                end = beg + 1
+            else:
+                end = beg
+        except (IndexError, ValueError):
+            return None
+        if not index.format & 0x10000:
+            beg -= 1
+        return beg, end
+
+    def _bisect(self, lines: ty.List[str], chrom: str, position: int) -> int:
+        """Find the index of the first line (in a sorted batch) whose record starts at or after a position"""
+        low, high = 0, len(lines)
+        while low < high:
+            middle = (low + high) // 2
+            interval = self._interval(lines[middle], chrom)
+            if interval is None or interval[0] < position:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def _fetch(
+        self,
+        chrom: str,
+        start: int,
+        end: int,
+        chunks: ty.List[ty.Tuple[int, int]],
+    ) -> ty.Iterator[str]:
+        # For files of single positions (the usual case for association data), records are sorted by both start and
+        #   end, so the lines that overlap the region can be found in each batch by binary search
+        point_records = self.index.col_end == self.index.col_beg
+        for chunk_beg, chunk_end in chunks:
+            for lines in self._read_lines(chunk_beg, chunk_end):
+                if point_records:
+                    first = self._interval(lines[0], chrom)
+                    last = self._interval(lines[-1], chrom)
+                    if (
+                        first is not None
+                        and last is not None
+                        and first[0] != -1
+                        and last[0] != -1
+                    ):
+                        low = (
+                            0
+                            if first[0] >= start
+                            else self._bisect(lines, chrom, start)
+                        )
+                        high = (
+                            len(lines)
+                            if last[0] < end
+                            else self._bisect(lines, chrom, end)
+                        )
+                        yield from lines[low:high]
+                        if high < len(lines):
+                            return
+                        continue
+
+                for line in lines:
+                    interval = self._interval(line, chrom)
+                    if interval is None:
+                        continue
+                    record_beg, record_end = interval
+                    if record_beg == -1 or record_beg >= end:
+                        # Records are sorted, so a new chromosome (or a record past the region) means that there are
+                        #   no more matches
+                        return
+                    if record_end > start:
+                        yield line
+
+
+def iter_lines_with_offsets(path: str) -> ty.Iterator[ty.Tuple[int, str]]:
+    """
+    Read every line of a bgzipped file, along with the BGZF virtual file offset where the line starts
+
+    A virtual offset is `(offset of the compressed block << 16) | offset of the line within the decompressed block`,
+    as used by tabix indexes.
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        block_offset = 0
+        # A line that continues from one block into the next: its starting offset, and the pieces read so far
+        pending: ty.Optional[ty.Tuple[int, ty.List[bytes]]] = None
+        while True:
+            data, block_size = read_bgzf_block(fd, block_offset, path)
+            if not block_size:
+                break
+            lines = data.split(b"\n")
+            position = 0
+            for line in lines[:-1]:
+                if pending is None:
+                    yield (block_offset << 16) | position, line.decode()
+                else:
+                    yield pending[0], b"".join(pending[1] + [line]).decode()
+                    pending = None
+                position += len(line) + 1
+            # The data after the last newline is the start of a line that continues in the next block
+            if lines[-1]:
+                if pending is None:
+                    pending = ((block_offset << 16) | position, [lines[-1]])
+                else:
+                    pending[1].append(lines[-1])
+            block_offset += block_size
+        if pending is not None:
+            yield pending[0], b"".join(pending[1]).decode()
+    finally:
+        os.close(fd)
+
+
+_POOL: ty.Optional[TabixPool] = None
+_POOL_PID = None
+
+
+def get_tabix_pool() -> TabixPool:
+    """Get the tabix handle pool for this worker process (handles are never shared across a fork)"""
+    global _POOL, _POOL_PID
+    pid = os.getpid()
+    if _POOL is None or _POOL_PID != pid:
+        config = current_app.config
+        opener: ty.Callable[[str], ty.Any] = pysam.TabixFile
+        if config["FIVEX_BLOCK_CACHE_BYTES"]:
+            block_cache = BlockCache(
+                config["FIVEX_BLOCK_CACHE_BYTES"],
+                shared_dir=config["FIVEX_BLOCK_CACHE_DIR"],
+                shared_max_bytes=config["FIVEX_BLOCK_CACHE_SHARED_BYTES"],
+            )
+            opener = functools.partial(
+                CachedTabixFile, block_cache=block_cache
+            )
+
+        _POOL = TabixPool(
+            max_handles=config["FIVEX_TABIX_POOL_SIZE"],
+            max_index_bytes=config["FIVEX_TABIX_POOL_INDEX_BYTES"],
+            opener=opener,
+        )
+        _POOL_PID = pid
+    return _POOL
+
+
+class PooledTabixReader(readers.TabixReader):
+    """A zorp TabixReader that borrows an open file handle from the shared pool, instead of opening the file itself"""
+
+    def fetch(self, chrom: str, start: int, end: int) -> ty.Iterable:
+        if not self._has_index:
+            raise FileNotFoundError(
+                "You must generate a tabix index before using region-based fetch"
+            )
+        iterator = get_tabix_pool().fetch(self._source, chrom, start, end)
+        return self._make_generator(iterator)
@@ -23,6 +23,27 @@ function retrieveBySuffix(point_data, field_suffix) {
     return match ? match[1] : null;
 }
 
+/**
+ * Expand a columnar API response (`format=columnar`) into the object-of-arrays form understood by LocusZoom. Row
+ *  responses (the default) are returned unchanged.
+ *
+ * The FIVEx adapters request the columnar format only when created with the `columnar: true` param.
+ *
+ * Low-cardinality fields are dictionary-encoded by the server as `{values: [...], codes: [...]}`, where each code
+ *  is an index into `values`.
+ * @param {object|object[]} data
+ */
+function decodeColumns(data) {
+    if (Array.isArray(data)) {
+        return data;
+    }
+    return Object.keys(data).reduce((acc, field) => {
+        const column = data[field];
+        acc[field] = Array.isArray(column) ? column : column.codes.map((code) => column.values[code]);
+        return acc;
+    }, {});
+}
+
 /**
  * Convert Posterior incl probabilities to a (truncated) log scale for rendering. The return values
  *   of this scale are (-4..0), so that very small PIPs aren't allowed to dominate the axis scale
@@ -95,7 +116,15 @@ class PheWASFIVEx extends PheWASLZ {
         chain.header.minimum_tss_distance = state.minimum_tss_distance;
         chain.header.y_field = state.y_field;
         chain.header.fivex_studies = new Set(state.fivex_studies || []);
-        return this.url;
+        // Opt-in: the columnar format is smaller, but is built in memory rather than streamed by the server
+        if (!this.params.columnar) {
+            return this.url;
+        }
+        return `${this.url}${this.url.includes('?') ? '&' : '?'}format=columnar`;
+    }
+
+    normalizeResponse(data) {
+        return super.normalizeResponse(decodeColumns(data));
     }
 
     annotateData(records, chain) {
@@ -229,6 +258,10 @@ class AssocFIVEx extends AssociationLZ {
     getURL(state) {
         const url = `${this.url}/${state.chr}/${state.start}-${state.end}/${this.params.study}/${this.params.tissue}/`;
         let params = {};
+        if (this.params.columnar) {
+            // Opt-in: the columnar format is smaller, but is built in memory rather than streamed by the server
+            params.format = 'columnar';
+        }
         // TODO: Is there ever a case where a LZ panel data source is allowed to omit gene/tissue/study info? If not, add validation.
         if (this.params.gene_id) {
             params.gene_id = this.params.gene_id;
@@ -238,6 +271,10 @@ class AssocFIVEx extends AssociationLZ {
         return `${url}?${params}`;
     }
 
+    normalizeResponse(data) {
+        return super.normalizeResponse(decodeColumns(data));
+    }
+
     annotateData(data) {
         data.forEach((item) => {
             item.variant = `${item.chromosome}:${item.position}_${item.ref_allele}/${item.alt_allele}`;
@@ -248,4 +285,4 @@ class AssocFIVEx extends AssociationLZ {
 
 LocusZoom.Adapters.add('AssocFIVEx', AssocFIVEx);
 
-export { retrieveBySuffix };
+export { decodeColumns, retrieveBySuffix };
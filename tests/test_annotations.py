@@ -0,0 +1,128 @@
+"""Test the in-memory gene annotation indexes"""
+import math
+import random
+
+import numpy as np
+import pysam
+
+from fivex.annotations import GeneFeature, IntervalIndex, TSSIndex
+
+
+def _make_tss_index():
+    return TSSIndex(
+        [
+            ("1", "ENSG_PLUS", 1000),
+            ("1", "ENSG_MINUS", -5000),
+            ("1", "ENSG_FAR", 900000),
+            ("2", "ENSG_OTHER", 1500),
+        ]
+    )
+
+
+def test_tss_lookup_by_gene():
+    index = _make_tss_index()
+    assert index.get("ENSG_MINUS") == -5000
+    assert index.get("ENSG_MISSING") is None
+
+
+def test_tss_genes_near_position():
+    index = _make_tss_index()
+    assert index.genes_near("1", 3000, 2000) == [
+        ("ENSG_PLUS", 1000),
+        ("ENSG_MINUS", -5000),
+    ]
+    assert index.genes_near("1", 3000, 1000) == []
+    assert index.genes_near("X", 3000, 1000000) == []
+
+
+def test_tss_distances_follow_strand():
+    index = _make_tss_index()
+    distance, position = index.distances(
+        np.array([2000, 2000, 2000]), ["ENSG_PLUS", "ENSG_MINUS", "missing"]
+    )
+    assert distance[:2].tolist() == [1000, 3000]
+    assert position[:2].tolist() == [-1000, -5000]
+    assert math.isnan(distance[2]) and math.isnan(position[2])
+
+
+def test_tss_index_matches_gencode_file(app):
+    from fivex import model
+
+    # Same value as the (equivalent) entry in tss.json.gz
+    assert model.get_tss_index().get("ENSG00000134243") == -109397918
+
+
+def _make_interval_index():
+    return IntervalIndex(
+        [
+            GeneFeature("1", 100, 200, "ENSG_A", "A"),
+            GeneFeature("1", 150, 5000, "ENSG_LONG", "LONG"),
+            GeneFeature("1", 4000, 4100, "ENSG_B", "B"),
+            GeneFeature("2", 100, 200, "ENSG_A", "A"),
+        ]
+    )
+
+
+def test_interval_overlaps():
+    index = _make_interval_index()
+    # Queries are 0-based and half-open, over 1-based closed intervals (like tabix)
+    assert [f.gene_id for f in index.fetch("1", 199, 300)] == [
+        "ENSG_A",
+        "ENSG_LONG",
+    ]
+    assert [f.gene_id for f in index.fetch("1", 200, 300)] == ["ENSG_LONG"]
+    assert [f.gene_id for f in index.fetch("chr1", 4050, 4051)] == [
+        "ENSG_LONG",
+        "ENSG_B",
+    ]
+    assert index.fetch("1", 5000, 6000) == []
+    assert index.fetch("X", 0, 6000) == []
+
+
+def test_interval_lookup_by_gene():
+    index = _make_interval_index()
+    assert [f.chrom for f in index.for_gene("ENSG_A")] == ["1", "2"]
+    assert [f.chrom for f in index.fetch("2", 0, 1000, gene_id="ENSG_A")] == [
+        "2"
+    ]
+    assert index.fetch("1", 300, 1000, gene_id="ENSG_A") == []
+    assert index.for_gene("ENSG_MISSING") == []
+
+
+def test_gene_interval_index_matches_tabix(app):
+    from fivex import model
+
+    index = model.get_gene_intervals()
+    reader = pysam.TabixFile(model.locate_gencode_data())
+    rng = random.Random(1)
+    regions = [
+        ("1", 109274968 - 500000, 109274968 + 500000),
+        ("Y", 1, 10 ** 8),
+    ]
+    for _ in range(50):
+        start = rng.randrange(1, 10 ** 8)
+        regions.append(
+            (
+                rng.choice(["1", "2", "X"]),
+                start,
+                start + rng.choice([1, 10 ** 6]),
+            )
+        )
+    for chrom, start, end in regions:
+        expected = [
+            (
+                int(fields[3]),
+                int(fields[4]),
+                fields[6].split(".")[0],
+                fields[8],
+            )
+            for fields in (
+                line.split("\t")
+                for line in reader.fetch(f"chr{chrom}", start - 1, end + 1)
+            )
+        ]
+        actual = [
+            (f.start, f.end, f.gene_id, f.symbol)
+            for f in index.fetch(chrom, start - 1, end + 1)
+        ]
+        assert actual == expected
@@ -1,8 +1,12 @@
 """Test the REST APIs"""
 
+import json
+
 import pytest
 from flask import url_for
 
+from fivex import conditional
+
 
 #####
 # Smoke tests: ensure that each page of the app loads.
@@ -73,3 +77,281 @@ def test_variant_api_rejects_invalid_option(client):
         data_type="somethingsomething",
     )
     assert client.get(url).status_code == 200
+
+
+def test_variant_api_streams_ndjson(client):
+    url = url_for("api.variant_query", chrom="1", pos=109274968)
+    expected = client.get(url).get_json()["data"]
+    response = client.get(
+        url_for("api.variant_query", chrom="1", pos=109274968, format="ndjson")
+    )
+    assert response.status_code == 200
+    assert response.mimetype == "application/x-ndjson"
+    rows = [json.loads(line) for line in response.data.splitlines()]
+    assert len(rows) == len(expected) > 0
+    assert rows[0]["variant_id"] == expected[0]["variant_id"]
+
+
+def test_region_api_columnar_format(client):
+    kwargs = dict(
+        chrom="1",
+        start=109174968,
+        end=109374968,
+        study="GTEx",
+        tissue="adipose_subcutaneous",
+    )
+    rows = client.get(url_for("api.region_query", **kwargs)).get_json()["data"]
+    response = client.get(
+        url_for("api.region_query", format="columnar", **kwargs)
+    )
+    assert response.status_code == 200
+    columns = response.get_json()["data"]
+    assert len(response.data) < len(json.dumps(rows)) / 2
+    assert columns["build"]["values"] == ["GRCh38"]
+    assert len(columns["position"]) == len(rows) > 0
+    assert columns["position"][-1] == rows[-1]["position"]
+
+
+def test_region_api_thins_points(client):
+    kwargs = dict(
+        chrom="1",
+        start=108774968,
+        end=109774968,
+        study="GTEx",
+        tissue="adipose_subcutaneous",
+        gene_id="ENSG00000197780",
+    )
+    rows = client.get(url_for("api.region_query", **kwargs)).get_json()["data"]
+    response = client.get(url_for("api.region_query", max_points=50, **kwargs))
+    assert response.status_code == 200
+    thinned = response.get_json()["data"]
+
+    members = [row["variant_id"] for row in rows if row["pip"] > 0]
+    assert len(members) > 0
+    assert len(thinned) <= 50 + len(members)
+    # Credible set members are always kept, as is the most significant point overall
+    assert set(members) <= {row["variant_id"] for row in thinned}
+    best = max(row["log_pvalue"] for row in rows)
+    assert max(row["log_pvalue"] for row in thinned) == best
+    # Rows stay in their original order
+    positions = [row["position"] for row in thinned]
+    assert positions == sorted(positions)
+
+
+def test_region_api_rejects_invalid_max_points(client):
+    url = url_for(
+        "api.region_query",
+        chrom="1",
+        start=108774968,
+        end=109774968,
+        study="GTEx",
+        tissue="adipose_subcutaneous",
+        max_points=0,
+    )
+    assert client.get(url).status_code == 400
+
+
+def test_batch_region_api_matches_single_queries(client):
+    region = dict(chrom="1", start=109174968, end=109374968)
+    tracks = ["GTEx:liver", "GTEx:adipose_subcutaneous"]
+    response = client.get(
+        url_for("api.region_query_batch", track=tracks, **region)
+    )
+    assert response.status_code == 200
+    groups = response.get_json()["data"]
+    assert [(group["study"], group["tissue"]) for group in groups] == [
+        ("GTEx", "liver"),
+        ("GTEx", "adipose_subcutaneous"),
+    ]
+    for group in groups:
+        single = client.get(
+            url_for(
+                "api.region_query",
+                study=group["study"],
+                tissue=group["tissue"],
+                **region,
+            )
+        ).get_json()["data"]
+        assert group["data"] == single
+        assert len(single) > 0
+
+    columnar = client.get(
+        url_for(
+            "api.region_query_batch", track=tracks, format="columnar", **region
+        )
+    ).get_json()["data"]
+    assert columnar[1]["data"]["position"] == [
+        row["position"] for row in groups[1]["data"]
+    ]
+
+
+@pytest.mark.parametrize(
+    "params",
+    [
+        {},
+        {"track": "GTEx"},
+        {"track": "GTEx:liver", "format": "ndjson"},
+        {"track": "GTEx:liver", "max_points": 0},
+    ],
+)
+def test_batch_region_api_rejects_invalid_options(client, params):
+    url = url_for(
+        "api.region_query_batch",
+        chrom="1",
+        start=109174968,
+        end=109374968,
+        **params,
+    )
+    assert client.get(url).status_code == 400
+
+
+@pytest.mark.parametrize(
+    "options",
+    [
+        {},
+        {"datatype": "txrev"},
+        {"study": "GTEx", "tissue": "adipose_subcutaneous"},
+    ],
+)
+def test_batch_variant_api_matches_single_queries(client, options):
+    queries = ["chr1:109274968", "rs12740374", "1_109274969", "rs0"]
+    response = client.post(
+        url_for("api.variant_query_batch"),
+        json=dict(variants=queries, **options),
+    )
+    assert response.status_code == 200
+    groups = response.get_json()["data"]
+    assert [
+        (group["variant"], group["chromosome"], group["position"])
+        for group in groups
+    ] == [
+        ("chr1:109274968", "1", 109274968),
+        ("rs12740374", "1", 109274968),
+        ("1_109274969", "1", 109274969),
+        ("rs0", None, None),
+    ]
+    for group in groups[:3]:
+        single = client.get(
+            url_for(
+                "api.variant_query",
+                chrom=group["chromosome"],
+                pos=group["position"],
+                **options,
+            )
+        ).get_json()["data"]
+        assert group["data"] == single
+    assert len(groups[0]["data"]) > 0
+    assert groups[3]["data"] == []
+
+
+@pytest.mark.parametrize(
+    "body",
+    [
+        None,
+        {},
+        {"variants": "rs12740374"},
+        {"variants": ["1-12345"]},
+        {"variants": ["1:109274968"], "study": ["GTEx"]},
+        {"variants": ["1:109274968"], "gene_id": 1},
+        {"variants": ["1:109274968"], "datatype": "eqtl"},
+        {"variants": ["1:109274968"], "datatype": ["ge"]},
+    ],
+)
+def test_batch_variant_api_rejects_invalid_requests(client, body):
+    response = client.post(url_for("api.variant_query_batch"), json=body)
+    assert response.status_code == 400
+
+
+def test_rsid_api_resolves_rsids_and_positions(client):
+    expected = [
+        {
+            "chromosome": "1",
+            "position": 109274968,
+            "ref_allele": "G",
+            "alt_allele": "T",
+            "rsid": "rs12740374",
+        }
+    ]
+    for query in ["rs12740374", "chr1:109274968"]:
+        response = client.get(url_for("api.rsid_query", query=query))
+        assert response.get_json()["data"] == expected
+    assert (
+        client.get(url_for("api.rsid_query", query="rs0")).get_json()["data"]
+        == []
+    )
+    assert (
+        client.get(url_for("api.rsid_query", query="BRCA1")).status_code == 400
+    )
+
+    queries = ["rs12740374", "1_109274968", "rs0"]
+    response = client.post(
+        url_for("api.rsid_query_batch"), json={"variants": queries}
+    )
+    assert response.get_json()["data"] == [
+        {"variant": "rs12740374", "data": expected},
+        {"variant": "1_109274968", "data": expected},
+        {"variant": "rs0", "data": []},
+    ]
+
+
+def test_api_supports_conditional_requests(client):
+    url = url_for("api.variant_query", chrom="1", pos=109274968)
+    response = client.get(url)
+    # Consume streamed responses, so that the request is complete (as a real client would)
+    assert response.data
+    etag = response.headers["ETag"]
+    assert response.cache_control.public
+    assert response.cache_control.no_cache
+
+    cached = client.get(url, headers={"If-None-Match": etag})
+    assert cached.status_code == 304
+    assert cached.data == b""
+    assert cached.headers["ETag"] == etag
+
+    # The ETag depends on the query parameters, and on the data files that are read
+    other = client.get(url, query_string={"datatype": "txrev"})
+    assert other.data
+    assert other.headers["ETag"] != etag
+    assert (
+        client.get(
+            url_for("api.variant_query", chrom="chr1", pos=109274968)
+        ).status_code
+        == 200
+    )
+
+
+def test_etag_changes_with_data_files(app, tmp_path):
+    data_file = tmp_path / "data.txt"
+    data_file.write_text("a")
+    with app.test_request_context("/data/variant/1_1/?b=2&a=1"):
+        before = conditional.compute_etag([str(data_file)])
+        data_file.write_text("ab")
+        after = conditional.compute_etag([str(data_file)])
+    with app.test_request_context("/data/variant/1_1/?a=1&b=2"):
+        reordered = conditional.compute_etag([str(data_file)])
+    assert before != after
+    assert reordered == after
+
+
+def test_etag_changes_with_deploy_and_derived_files(app, tmp_path):
+    source = tmp_path / "data" / "study_ge_tissue.all.tsv.gz"
+    source.parent.mkdir()
+    source.write_text("a")
+    meta = (
+        tmp_path
+        / "columns"
+        / "study_ge_tissue.all.tsv.gz.columns"
+        / "meta.json"
+    )
+    meta.parent.mkdir(parents=True)
+    meta.write_text("{}")
+    app.config["FIVEX_DATA_DIR"] = str(source.parent)
+    app.config["FIVEX_COLUMNAR_DIR"] = str(tmp_path / "columns")
+    app.config["FIVEX_STORAGE_BACKEND"] = "columnar"
+    with app.test_request_context("/data/region/1/1-2/study/tissue/"):
+        before = conditional.compute_etag([str(source)])
+        meta.write_text('{"rows": 0}')
+        rebuilt = conditional.compute_etag([str(source)])
+        app.config["FIVEX_DEPLOY_ID"] = "next"
+        redeployed = conditional.compute_etag([str(source)])
+    assert len({before, rebuilt, redeployed}) == 3
@@ -0,0 +1,247 @@
+"""Test the columnar storage backend and batch parsing"""
+import gzip
+import itertools
+import json
+import os
+
+import numpy as np
+import pytest
+from zorp import parser_utils  # type: ignore
+
+from fivex import columnar, create_app, model
+from fivex.api import format
+
+STUDY_TISSUE_FILES = [
+    ("ge", "GTEx", "adipose_subcutaneous"),
+    ("txrev", "GTEx", "adipose_subcutaneous"),
+]
+MERGED_FILES = [("ge", 109274968), ("txrev", 109274968)]
+
+
+@pytest.fixture(scope="module")
+def columnar_dir(tmp_path_factory):
+    """Convert some of the sample data files once, for all tests in this module"""
+    root = tmp_path_factory.mktemp("columnar")
+    app = create_app("fivex.settings.test")
+    with app.app_context():
+        for datatype, study, tissue in STUDY_TISSUE_FILES:
+            source = model.locate_study_tissue_data(study, tissue, datatype)
+            columnar.convert_association_file(
+                source,
+                _columnar_path(app, root, source),
+                study=study,
+                tissue=tissue,
+            )
+        for datatype, position in MERGED_FILES:
+            source = model.locate_data("1", position, datatype)
+            columnar.convert_association_file(
+                source, _columnar_path(app, root, source)
+            )
+    return root
+
+
+@pytest.fixture
+def columnar_app(app, columnar_dir):
+    """Serve the converted files from the columnar backend"""
+    app.config["FIVEX_STORAGE_BACKEND"] = "columnar"
+    app.config["FIVEX_COLUMNAR_DIR"] = str(columnar_dir)
+    return app
+
+
+def _columnar_path(app, root, source):
+    relative_path = os.path.relpath(source, app.config["FIVEX_DATA_DIR"])
+    return os.path.join(root, f"{relative_path}.columns")
+
+
+def _query_both(app, **kwargs):
+    """Run the same query against the tabix and columnar backends, and serialize both results"""
+    results = {}
+    for backend in ("tabix", "columnar"):
+        app.config["FIVEX_STORAGE_BACKEND"] = backend
+        results[backend] = json.dumps(
+            [variant.to_dict() for variant in format.query_variants(**kwargs)]
+        )
+    return results["tabix"], results["columnar"]
+
+
+def test_columnar_table_is_used_when_enabled(columnar_app):
+    source = model.locate_data("1", 109274968)
+    assert model.get_columnar_table(source) is not None
+    columnar_app.config["FIVEX_STORAGE_BACKEND"] = "tabix"
+    assert model.get_columnar_table(source) is None
+
+
+def test_reconverted_table_is_loaded_again(columnar_app, tmp_path):
+    source = model.locate_study_tissue_data("GTEx", "adipose_subcutaneous")
+    columnar_app.config["FIVEX_COLUMNAR_DIR"] = str(tmp_path)
+    path = _columnar_path(columnar_app, tmp_path, source)
+    assert model.get_columnar_table(source) is None
+    columnar.convert_association_file(
+        source, path, study="GTEx", tissue="adipose_subcutaneous"
+    )
+    table = model.get_columnar_table(source)
+    assert table is not None
+    assert model.get_columnar_table(source) is table
+    meta = os.path.join(path, "meta.json")
+    stat = os.stat(meta)
+    os.utime(meta, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+    assert model.get_columnar_table(source) is not table
+
+
+def test_unconverted_file_falls_back_to_tabix(columnar_app):
+    source = model.locate_study_tissue_data("GTEx", "liver")
+    assert model.get_columnar_table(source) is None
+    variants = list(
+        format.query_variants(
+            "1", 109274000, end=109276000, study="GTEx", tissue="liver"
+        )
+    )
+    assert len(variants) > 0
+
+
+@pytest.mark.parametrize(
+    "kwargs",
+    [
+        # Region view
+        dict(
+            chrom="1",
+            start=108774968,
+            end=109774968,
+            study="GTEx",
+            tissue="adipose_subcutaneous",
+            gene_id="ENSG00000134243",
+        ),
+        dict(
+            chrom="1",
+            start=108774968,
+            end=109774968,
+            study="GTEx",
+            tissue="adipose_subcutaneous",
+            gene_id="ENSG00000134243",
+            piponly=True,
+        ),
+        dict(
+            chrom="chr1",
+            start=109200000,
+            end=109300000,
+            study="GTEx",
+            tissue="adipose_subcutaneous",
+            datatype="txrev",
+        ),
+        # Variant view
+        dict(chrom="1", start=109274968),
+        dict(chrom="1", start=109274968, datatype="txrev"),
+        dict(chrom="1", start=109274969),
+        # Batch variant query
+        dict(
+            chrom="1",
+            start=109274968,
+            end=109275968,
+            positions=[109274968, 109275968],
+        ),
+    ],
+)
+def test_columnar_matches_tabix(columnar_app, kwargs):
+    tabix_result, columnar_result = _query_both(columnar_app, **kwargs)
+    assert tabix_result == columnar_result
+
+
+def test_column_block_filters(tmp_path):
+    writer = columnar.ColumnarWriter(
+        str(tmp_path / "table"), [("chromosome", "str"), ("position", "int")]
+    )
+    for row in [("1", 10), ("1", 20), ("1", 20), ("2", 5)]:
+        writer.append(row)
+    writer.close()
+
+    table = columnar.ColumnarTable(str(tmp_path / "table"))
+    assert table.rows("1", 11, 20) == (1, 3)
+    assert table.rows("2", 1, 4) == (3, 3)
+    assert table.rows("X", 1, 100) == (0, 0)
+
+    block = table.fetch("1", 1, 100)
+    assert len(block) == 3
+    assert block.equals("chromosome", "2").sum() == 0
+    assert block.take(block.values("position") > 10).values(
+        "position"
+    ).tolist() == [20, 20]
+    assert isinstance(block.values("chromosome"), np.ndarray)
+
+
+def test_writer_rejects_unsorted_chromosomes(tmp_path):
+    writer = columnar.ColumnarWriter(
+        str(tmp_path / "table"), [("chromosome", "str"), ("position", "int")]
+    )
+    writer.append(("1", 10))
+    writer.append(("2", 10))
+    with pytest.raises(ValueError):
+        writer.append(("1", 20))
+
+
+def test_split_lines_handles_prefix_and_ragged_lines():
+    columns = [("study", "str"), ("a", "str"), ("b", "int")]
+    raw = columnar.split_lines(["x\t1", "y\t2\textra"], columns, ["S"])
+    assert raw == {"study": ["S", "S"], "a": ("x", "y"), "b": ("1", "2")}
+    raw = columnar.split_lines(["x\t1", "y\t2"], columns, ["S"])
+    assert list(raw["a"]) == ["x", "y"]
+    assert list(raw["b"]) == ["1", "2"]
+
+
+def test_parse_columns_matches_row_parser():
+    raw = {
+        "log_pvalue": ["0.5", "1e-400", "0", "NA"],
+        "r2": ["0.1", "NA", "1", "0.5"],
+    }
+    columns = [("log_pvalue", "float"), ("r2", "float")]
+    block = columnar.parse_columns(raw, ["log_pvalue", "r2"], columns)
+    assert block.values("log_pvalue")[:3].tolist() == [
+        parser_utils.parse_pval_to_log(value)
+        for value in raw["log_pvalue"][:3]
+    ]
+    assert np.isnan(block.values("log_pvalue")[3])
+    assert np.isnan(block.values("r2")[1])
+
+    block = columnar.parse_columns(
+        raw, ["r2"], columns, selection=np.array([0, 2])
+    )
+    assert block.values("r2").tolist() == [0.1, 1.0]
+
+
+def test_batch_parser_matches_variant_parser(app):
+    source = model.locate_data("1", 109274968)
+    with gzip.open(source, "rt") as f:
+        lines = [line.rstrip("\n") for line in itertools.islice(f, 500)]
+    parser = format.VariantParser(datatype="ge")
+    expected = [parser(line).to_dict() for line in lines]
+    block = columnar.parse_columns(
+        columnar.split_lines(lines, columnar.ASSOCIATION_COLUMNS),
+        [name for name, _ in columnar.ASSOCIATION_COLUMNS],
+        columnar.ASSOCIATION_COLUMNS,
+    )
+    actual = [
+        variant.to_dict() for variant in format.variants_from_block(block)
+    ]
+    assert json.dumps(actual) == json.dumps(expected)
+
+
+def test_thin_mask_keeps_best_point_per_bin():
+    positions = np.array([1, 2, 3, 6, 7, 10])
+    log_pvalues = np.array([1.0, 3.0, 2.0, np.nan, 0.5, 4.0])
+    mask = format.thin_mask(positions, log_pvalues, 1, 10, 2)
+    # Bins are [1, 5] and [6, 10]
+    assert positions[mask].tolist() == [2, 10]
+    assert format.thin_mask(positions, log_pvalues, 1, 10, 100).all()
+
+
+def test_thinned_query_matches_across_backends(columnar_app):
+    tabix_result, columnar_result = _query_both(
+        columnar_app,
+        chrom="1",
+        start=108774968,
+        end=109774968,
+        study="GTEx",
+        tissue="adipose_subcutaneous",
+        max_points=100,
+    )
+    assert tabix_result == columnar_result
+    assert 0 < len(json.loads(tabix_result)) <= 100
@@ -0,0 +1,132 @@
+"""Test the ingest-time join of credible sets onto association files"""
+import json
+import os
+import shutil
+
+import pytest
+
+from fivex import columnar, create_app, credible_sets, model
+from fivex.api import format
+
+QUERIES = [
+    # Region view
+    dict(
+        chrom="1",
+        start=108774968,
+        end=109774968,
+        study="GTEx",
+        tissue="adipose_subcutaneous",
+        gene_id="ENSG00000197780",
+    ),
+    dict(
+        chrom="1",
+        start=108774968,
+        end=109774968,
+        study="GTEx",
+        tissue="adipose_subcutaneous",
+        gene_id="ENSG00000197780",
+        piponly=True,
+        max_points=20,
+    ),
+    # Variant view
+    dict(chrom="1", start=109274968),
+    # Txrevise data is joined with the gene expression credible sets, by gene (as at query time)
+    dict(
+        chrom="1",
+        start=108774968,
+        end=109774968,
+        study="FUSION",
+        tissue="muscle_naive",
+        gene_id="ENSG00000134222",
+        datatype="txrev",
+    ),
+    dict(chrom="1", start=109274968, datatype="txrev"),
+]
+
+
+@pytest.fixture(scope="module")
+def joined_data_dir(tmp_path_factory):
+    """A copy of the sample data, with credible sets joined onto some of the association files"""
+    app = create_app("fivex.settings.test")
+    root = str(tmp_path_factory.mktemp("joined") / "data")
+    shutil.copytree(app.config["FIVEX_DATA_DIR"], root)
+    app.config["FIVEX_DATA_DIR"] = root
+    with app.app_context():
+        for datatype, study, tissue in [
+            ("ge", "GTEx", "adipose_subcutaneous"),
+            ("txrev", "FUSION", "muscle_naive"),
+        ]:
+            source = model.locate_study_tissue_data(
+                study, tissue, datatype=datatype
+            )
+            counts = credible_sets.join_credible_sets(
+                source,
+                model.get_credible_interval_path(
+                    "1",
+                    study,
+                    tissue,
+                    datatype=credible_sets.CREDIBLE_SET_DATATYPE,
+                ),
+                f"{source}.joined",
+                study=study,
+                tissue=tissue,
+            )
+            assert counts[1] > 0
+            source = model.locate_data("1", 109274968, datatype=datatype)
+            counts = credible_sets.join_credible_sets(
+                source,
+                model.get_credible_interval_path(
+                    "1", datatype=credible_sets.CREDIBLE_SET_DATATYPE
+                ),
+                f"{source}.joined",
+            )
+            assert counts[1] > 0
+    # Replace the original files with the joined copies
+    for dirpath, _, filenames in os.walk(root):
+        for filename in filenames:
+            if filename.endswith(".joined"):
+                path = os.path.join(dirpath, filename)
+                os.replace(path, path[: -len(".joined")])
+                os.replace(f"{path}.tbi", f"{path[: -len('.joined')]}.tbi")
+    return root
+
+
+def _query(**kwargs):
+    return json.dumps(
+        [variant.to_dict() for variant in format.query_variants(**kwargs)]
+    )
+
+
+@pytest.mark.parametrize("kwargs", QUERIES)
+def test_joined_files_match_query_time_join(
+    app, joined_data_dir, monkeypatch, kwargs
+):
+    with app.app_context():
+        expected = _query(**kwargs)
+    app.config["FIVEX_DATA_DIR"] = joined_data_dir
+    with app.app_context():
+        # Joined files are read without opening the credible set files
+        monkeypatch.setattr(format, "CIAdder", None)
+        assert _query(**kwargs) == expected
+    assert any(row["pip"] > 0 for row in json.loads(expected))
+
+
+def test_joined_files_can_be_converted_to_columnar(
+    app, joined_data_dir, tmp_path
+):
+    app.config["FIVEX_DATA_DIR"] = joined_data_dir
+    with app.app_context():
+        source = model.locate_data("1", 109274968)
+        assert model.count_columns(source) == len(
+            columnar.JOINED_ASSOCIATION_COLUMNS
+        )
+        expected = _query(**QUERIES[2])
+        relative_path = os.path.relpath(source, joined_data_dir)
+        columnar.convert_association_file(
+            source, str(tmp_path / f"{relative_path}.columns")
+        )
+    app.config["FIVEX_STORAGE_BACKEND"] = "columnar"
+    app.config["FIVEX_COLUMNAR_DIR"] = str(tmp_path)
+    with app.app_context():
+        assert "pip" in model.get_columnar_table(source).meta["columns"]
+        assert _query(**QUERIES[2]) == expected
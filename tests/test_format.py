@@ -0,0 +1,50 @@
+"""Test the credible set join"""
+from fivex import model
+from fivex.api import format
+
+
+def _ci_adder(**kwargs):
+    return format.CIAdder(
+        model.get_credible_interval_path("1", "GTEx", "adipose_subcutaneous"),
+        "1",
+        108774968,
+        end=109774968,
+        study="GTEx",
+        tissue="adipose_subcutaneous",
+        gene_id="ENSG00000197780",
+        **kwargs,
+    )
+
+
+def test_credible_sets_are_cached(app):
+    with app.app_context():
+        cache = format.get_credible_set_cache()
+        cache.clear()
+        first = _ci_adder()
+        hits = cache.stats()["hits"]
+        second = _ci_adder()
+        assert cache.stats()["hits"] == hits + 1
+        assert second.ci_data is first.ci_data
+        assert len(first.ci_data) > 0
+        key = next(iter(first.ci_data))
+        assert key[0] == "1" and isinstance(key[1], int)
+
+
+def test_credible_set_lookup_matches_uncached(app):
+    results = []
+    for cache_bytes in (0, 1024 ** 2, 1024 ** 2):
+        app.config["FIVEX_CREDIBLE_SET_CACHE_BYTES"] = cache_bytes
+        with app.app_context():
+            variants = format.query_variants(
+                "1",
+                108774968,
+                end=109774968,
+                study="GTEx",
+                tissue="adipose_subcutaneous",
+                gene_id="ENSG00000197780",
+                piponly=True,
+            )
+            results.append([variant.to_dict() for variant in variants])
+    assert len(results[0]) > 0
+    assert all(row["cs_index"] != "-" for row in results[0])
+    assert results[0] == results[1] == results[2]
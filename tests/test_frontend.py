@@ -3,6 +3,9 @@ Test frontend HTML views
 """
 from flask import url_for
 
+import fivex
+from fivex import model
+
 
 #####
 # Smoke tests: ensure that each page of the app loads.
@@ -25,3 +28,41 @@ def test_loads_variant(client):
 def test_region_must_provide_query_params(client):
     url = url_for("frontend.region_view")
     assert client.get(url).status_code == 400
+
+
+def test_variant_lists_cis_genes(client):
+    url = url_for("frontend.variant_view", chrom="1", pos=109274968)
+    content = client.get(url).get_json()
+    genes = {gene["symbol"]: gene for gene in content["cis_genes"]}
+    assert "SORT1" in genes
+    assert all(abs(gene["tss_distance"]) <= 1000000 for gene in genes.values())
+    # The same TSS distance as in the PheWAS data for this variant
+    phewas = client.get(
+        url_for("api.variant_query", chrom="1", pos=109274968)
+    ).get_json()["data"]
+    expected = {row["gene_id"]: row["tss_distance"] for row in phewas}
+    for gene in content["cis_genes"]:
+        if gene["gene_id"] in expected:
+            assert gene["tss_distance"] == expected[gene["gene_id"]]
+
+
+def test_variant_without_rsid(client):
+    # This variant has a credible set, but is not in the rsid database
+    url = url_for("frontend.variant_view", chrom="1", pos=109509517)
+    content = client.get(url).get_json()
+    assert content["rsid"] == "Unknown"
+    assert content["top_gene"] != "No_gene"
+
+
+def test_warm_up_loads_lookup_tables(app):
+    timings = fivex.warm_up(app)
+    # The sample data has no transcripts file, so that table is skipped
+    assert set(timings) == {
+        "gene_locator",
+        "gene_names",
+        "tss_index",
+        "gene_intervals",
+    }
+    assert model.get_gene_locator.cache_info().currsize == 1
+    with app.app_context():
+        assert model.get_gene_locator().at("1", 109274968)
@@ -0,0 +1,100 @@
+"""Test the gene-keyed secondary index"""
+import gzip
+import json
+import os
+
+import pytest
+
+from fivex import create_app, geneindex, model
+from fivex.api import format
+from fivex.tabix import iter_lines_with_offsets
+
+
+@pytest.fixture(scope="module")
+def index_dir(tmp_path_factory):
+    """Index one of the sample data files once, for all tests in this module"""
+    root = tmp_path_factory.mktemp("genes")
+    app = create_app("fivex.settings.test")
+    with app.app_context():
+        source = model.locate_study_tissue_data("GTEx", "adipose_subcutaneous")
+        relative_path = os.path.relpath(source, app.config["FIVEX_DATA_DIR"])
+        geneindex.build_gene_index(
+            source, os.path.join(root, f"{relative_path}.genes")
+        )
+    return root
+
+
+@pytest.fixture
+def indexed_app(app, index_dir):
+    app.config["FIVEX_GENE_INDEX_DIR"] = str(index_dir)
+    return app
+
+
+def _query(gene_id, **kwargs):
+    return json.dumps(
+        [
+            variant.to_dict()
+            for variant in format.query_variants(
+                "1",
+                108774968,
+                end=109774968,
+                study="GTEx",
+                tissue="adipose_subcutaneous",
+                gene_id=gene_id,
+                **kwargs,
+            )
+        ]
+    )
+
+
+def test_lines_with_offsets_match_file(app):
+    source = model.locate_study_tissue_data("GTEx", "adipose_subcutaneous")
+    with gzip.open(source, "rt") as f:
+        expected = f.read().split("\n")[:-1]
+    lines = list(iter_lines_with_offsets(source))
+    assert [line for _, line in lines] == expected
+
+    # Lines can be read back from their offsets, including lines that span two blocks
+    offsets = [offset for offset, _ in lines[::97]]
+    with app.app_context():
+        pool = format.get_tabix_pool()
+        assert list(pool.read_lines_at(source, offsets)) == expected[::97]
+
+
+@pytest.mark.parametrize(
+    "gene_id", ["ENSG00000134243", "ENSG00000197780", "ENSG00000000000"]
+)
+def test_indexed_query_matches_scan(app, index_dir, gene_id):
+    expected = _query(gene_id)
+    app.config["FIVEX_GENE_INDEX_DIR"] = str(index_dir)
+    source = model.locate_study_tissue_data("GTEx", "adipose_subcutaneous")
+    assert model.get_gene_index(source) is not None
+    assert _query(gene_id) == expected
+    assert _query(gene_id, piponly=True, max_points=20) == _query(
+        gene_id, piponly=True, max_points=20
+    )
+
+
+def test_index_is_limited_to_region(indexed_app):
+    source = model.locate_study_tissue_data("GTEx", "adipose_subcutaneous")
+    index = model.get_gene_index(source)
+    offsets = index.offsets("ENSG00000134243", "1", 109274968, 109274968)
+    assert 0 < len(offsets) < 5
+    assert len(index.offsets("ENSG00000134243", "2", 1, 10 ** 9)) == 0
+
+
+def test_index_is_ignored_when_unavailable(indexed_app):
+    source = model.locate_study_tissue_data("GTEx", "adipose_subcutaneous")
+    indexed_app.config["FIVEX_BLOCK_CACHE_BYTES"] = 0
+    assert model.get_gene_index(source) is None
+    indexed_app.config["FIVEX_BLOCK_CACHE_BYTES"] = 1024 ** 2
+    other = model.locate_study_tissue_data("GTEx", "liver")
+    assert model.get_gene_index(other) is None
+
+
+def test_stale_index_is_ignored(tmp_path, indexed_app):
+    source = model.locate_study_tissue_data("GTEx", "adipose_subcutaneous")
+    index = model.get_gene_index(source)
+    assert index.matches(source)
+    index.meta = dict(index.meta, source=[0, 0])
+    assert not index.matches(source)
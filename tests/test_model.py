@@ -0,0 +1,116 @@
+"""Test the data access layer"""
+import sqlite3
+
+import pytest
+from werkzeug.exceptions import HTTPException
+
+from fivex import model, pip_summary
+
+
+def test_sqlite_connection_is_reused(app):
+    path = model.get_best_per_variant_lookup()
+    assert model.get_sqlite_connection(path) is model.get_sqlite_connection(
+        path
+    )
+
+
+def test_sqlite_connection_is_read_only(app):
+    path = model.get_best_per_variant_lookup()
+    with pytest.raises(sqlite3.OperationalError):
+        model.query_sqlite(path, "DELETE FROM sig")
+    assert model.query_sqlite(path, "SELECT COUNT(*) FROM sig")[0][0] > 0
+
+
+def test_sqlite_connection_rejects_missing_file(app, tmp_path):
+    with pytest.raises(sqlite3.OperationalError):
+        model.get_sqlite_connection(str(tmp_path / "missing.db"))
+    assert not (tmp_path / "missing.db").exists()
+
+
+@pytest.mark.parametrize("name", ["a?b.db", "a#b.db", "a%20b.db", "a b.db"])
+def test_sqlite_connection_escapes_path(app, tmp_path, name):
+    path = tmp_path / name
+    conn = sqlite3.connect(str(path))
+    conn.execute("CREATE TABLE t (x INTEGER)")
+    conn.execute("INSERT INTO t VALUES (1)")
+    conn.commit()
+    conn.close()
+    assert model.query_sqlite(str(path), "SELECT x FROM t") == [(1,)]
+
+
+def test_gene_names_are_loaded_once(app):
+    names = model.get_gene_names_conversion()
+    assert names is model.get_gene_names_conversion()
+    assert names["ENSG00000187223"] == "LCE2D"
+    with pytest.raises(TypeError):
+        names["ENSG00000187223"] = "something else"  # type: ignore
+
+
+def test_rsid_lookups_are_batched(app, monkeypatch):
+    monkeypatch.setattr(model, "SQLITE_MAX_PARAMETERS", 2)
+    rsids = model.find_rsids(["rs12740374", "rs934197", "rs0", "rs12740374"])
+    assert rsids == {
+        "rs12740374": [("1", 109274968, "G", "T", "rs12740374")],
+        "rs934197": [("2", 21044589, "G", "A", "rs934197")],
+    }
+    positions = model.find_positions(
+        [("1", 109274968), ("1", 1), ("1", 2), ("2", 21044589)]
+    )
+    assert positions == {
+        ("1", 109274968): rsids["rs12740374"],
+        ("2", 21044589): rsids["rs934197"],
+    }
+    assert model.find_rsids([]) == {}
+
+
+def test_cover_region_uses_whole_bins():
+    bins, edges = pip_summary.cover_region(
+        1995000, 3120500, bin_sizes=(1000000, 100000, 10000)
+    )
+    covered = sorted(
+        [(first * size, (last + 1) * size - 1) for size, first, last in bins]
+        + edges
+    )
+    # The bins and edges tile the region exactly
+    assert covered[0][0] == 1995000
+    assert covered[-1][1] == 3120500
+    for (_, end), (start, _) in zip(covered, covered[1:]):
+        assert start == end + 1
+    assert all(end - start < 10000 for start, end in edges)
+    assert (1000000, 2, 2) in bins
+    assert pip_summary.cover_region(10, 5) == ([], [])
+
+
+@pytest.mark.parametrize(
+    "filters",
+    [
+        {},
+        {"gene_id": "ENSG00000134243"},
+        {"study": "GTEx", "tissue": "adipose_subcutaneous"},
+        {"study": "GTEx"},
+    ],
+)
+def test_best_variant_summary_matches_full_scan(app, monkeypatch, filters):
+    regions = [
+        (108774968, 109774968),
+        (108000000, 110999999),
+        (109274000, 109275000),
+        (109100001, 109299999),
+    ]
+    assert model._has_pip_summary(model.get_best_per_variant_lookup())
+    with_summary = []
+    for start, end in regions:
+        with_summary.append(_best_or_none("1", start, end, **filters))
+    monkeypatch.setattr(model, "_has_pip_summary", lambda path: False)
+    full_scan = [
+        _best_or_none("1", start, end, **filters) for start, end in regions
+    ]
+    assert with_summary == full_scan
+    assert any(result is not None for result in full_scan)
+
+
+def _best_or_none(*args, **kwargs):
+    try:
+        return model.get_best_study_tissue_gene(*args, **kwargs)
+    except HTTPException:
+        return None
@@ -0,0 +1,232 @@
+"""Test the server-side response cache"""
+import threading
+import time
+
+import pytest
+from flask import url_for
+
+from fivex import model, response_cache
+from fivex.annotations import IntervalIndex, TranscriptFeature
+from fivex.cache import DirectoryCache, SingleFlight
+
+
+@pytest.fixture
+def cached_app(app):
+    app.config["FIVEX_RESPONSE_CACHE_BYTES"] = 64 * 1024 ** 2
+    cache = response_cache.get_memory_cache()
+    cache.clear()
+    return app
+
+
+def test_equivalent_requests_share_a_cache_entry(cached_app, client):
+    cache = response_cache.get_memory_cache()
+    url = url_for("api.variant_query", chrom="1", pos=109274968)
+    first = client.get(url, query_string={"gene_id": "ENSG00000134243.11"})
+    assert first.status_code == 200
+    # Streamed responses are stored once they have been sent
+    assert len(cache) == 0
+    assert first.data
+    assert len(cache) == 1
+
+    equivalent = url_for("api.variant_query", chrom="chr1", pos=109274968)
+    second = client.get(
+        equivalent, query_string={"gene_id": "ENSG00000134243"}
+    )
+    assert cache.stats()["hits"] == 1
+    assert second.data == first.data
+    assert second.mimetype == first.mimetype
+    assert second.headers["ETag"]
+
+    client.get(url, query_string={"datatype": "txrev"}).data
+    assert len(cache) == 2
+
+
+# Pairs of requests that share a cache entry (the "chr" prefix and gene versions are removed from the key)
+EQUIVALENT_REQUESTS = [
+    (
+        "/data/cs/1/108774968-109774968/?gene_id=ENSG00000197780",
+        "/data/cs/chr1/108774968-109774968/?gene_id=ENSG00000197780.5",
+    ),
+    ("/views/variant/1_109274968/", "/views/variant/chr1_109274968/"),
+    (
+        "/data/best/region/1/108774968-109774968/?gene_id=ENSG00000197780",
+        "/data/best/region/chr1/108774968-109774968/?gene_id=ENSG00000197780.5",
+    ),
+    (
+        "/views/region/?chrom=1&start=108774968&end=109774968&gene_id=ENSG00000197780",
+        "/views/region/?chrom=chr1&start=108774968&end=109774968&gene_id=ENSG00000197780.5",
+    ),
+    (
+        "/views/gencode/transcripts/1/100-1000/?gene_id=ENSG1",
+        "/views/gencode/transcripts/chr1/100-1000/?gene_id=ENSG1.2",
+    ),
+]
+
+
+@pytest.mark.parametrize("urls", EQUIVALENT_REQUESTS)
+def test_cached_responses_match_uncached_responses(app, monkeypatch, urls):
+    # The sample data has no transcripts file
+    transcripts = IntervalIndex(
+        [
+            TranscriptFeature("1", 200, 800, "ENSG1", "ENST1", "GENE1"),
+            TranscriptFeature("1", 300, 900, "ENSG2", "ENST2", "GENE2"),
+        ]
+    )
+    monkeypatch.setattr(model, "get_transcript_intervals", lambda: transcripts)
+    client = app.test_client()
+
+    def get(url):
+        response = client.get(url)
+        return response.status_code, response.get_data()
+
+    app.config["FIVEX_RESPONSE_CACHE_BYTES"] = 0
+    uncached = [get(url) for url in urls]
+    assert uncached[0][0] == 200
+    assert uncached[1] == uncached[0]
+
+    app.config["FIVEX_RESPONSE_CACHE_BYTES"] = 64 * 1024 ** 2
+    response_cache.get_memory_cache().clear()
+    # Whichever request comes first fills the cache entry for both
+    for order in (urls, urls[::-1]):
+        response_cache.get_memory_cache().clear()
+        assert [get(url) for url in order] == uncached
+
+
+def test_errors_are_not_cached(cached_app, client):
+    url = url_for(
+        "api.region_query",
+        chrom="1",
+        start=108774968,
+        end=109774968,
+        study="GTEx",
+        tissue="adipose_subcutaneous",
+    )
+    response = client.get(url, query_string={"max_points": 0})
+    assert response.status_code == 400
+    assert len(response_cache.get_memory_cache()) == 0
+
+
+def test_cache_key_changes_with_data_files(app, tmp_path):
+    data_file = tmp_path / "data.txt"
+    data_file.write_text("a")
+    with app.test_request_context("/data/variant/1_1/?b=2&a=1"):
+        before = response_cache.cache_key([str(data_file)])
+        data_file.write_text("ab")
+        after = response_cache.cache_key([str(data_file)])
+    with app.test_request_context("/data/variant/1_1/?a=1&b=2"):
+        reordered = response_cache.cache_key([str(data_file)])
+    assert before != after
+    assert reordered == after
+
+
+def test_cache_key_changes_with_deploy_and_backend(app):
+    with app.test_request_context("/data/variant/1_1/"):
+        before = response_cache.cache_key()
+        app.config["FIVEX_STORAGE_BACKEND"] = "columnar"
+        columnar = response_cache.cache_key()
+        app.config["FIVEX_DEPLOY_ID"] = "next"
+        redeployed = response_cache.cache_key()
+    assert len({before, columnar, redeployed}) == 3
+
+
+def test_directory_tier_is_shared_between_workers(app, client, tmp_path):
+    app.config["FIVEX_RESPONSE_CACHE_BYTES"] = 0
+    app.config["FIVEX_RESPONSE_CACHE_DIR"] = str(tmp_path)
+    url = url_for(
+        "frontend.get_genes_in_region",
+        chrom="1",
+        start=109000000,
+        end=109500000,
+    )
+    first = client.get(url)
+    assert len(list(tmp_path.iterdir())) == 1
+
+    # A different worker process starts with an empty memory cache, and finds the response on disk
+    app.config["FIVEX_RESPONSE_CACHE_BYTES"] = 64 * 1024 ** 2
+    response_cache.get_memory_cache().clear()
+    second = client.get(url)
+    assert second.data == first.data
+    assert second.mimetype == first.mimetype
+    assert len(response_cache.get_memory_cache()) == 1
+
+
+def test_directory_cache_is_bounded(tmp_path):
+    cache = DirectoryCache(str(tmp_path), max_bytes=25)
+    for i in range(5):
+        cache.put(i, b"x" * 10)
+    assert cache.get(4) == b"x" * 10
+    cache.prune()
+    assert sum(f.stat().st_size for f in tmp_path.iterdir()) <= 25
+    assert cache.get("missing") is None
+
+
+def test_single_flight_shares_the_leaders_result():
+    flights = SingleFlight(timeout=10)
+    leader, flight = flights.begin("key")
+    assert leader
+
+    results = []
+
+    def follow():
+        is_leader, token = flights.begin("key")
+        results.append((is_leader, flights.wait(token)))
+
+    followers = [threading.Thread(target=follow) for _ in range(5)]
+    for thread in followers:
+        thread.start()
+    time.sleep(0.05)
+    flights.finish("key", flight, b"result")
+    flights.finish("key", flight, None)  # Later calls have no effect
+    for thread in followers:
+        thread.join()
+
+    assert results == [(False, b"result")] * 5
+    assert flights.stats() == {
+        "leaders": 1,
+        "collapsed": 5,
+        "timeouts": 0,
+        "in_flight": 0,
+    }
+    # Once finished, the next caller computes the result again
+    assert flights.begin("key")[0]
+
+
+def test_single_flight_gives_up_on_stalled_leaders():
+    flights = SingleFlight(timeout=0.05)
+    _, flight = flights.begin("key")
+    leader, token = flights.begin("key")
+    assert not leader
+    assert flights.wait(token) is None
+    assert flights.stats()["timeouts"] == 1
+    # A new caller replaces the stalled leader
+    assert flights.begin("key")[0]
+
+
+def test_requests_never_leave_a_flight_open(app, client):
+    url = url_for("api.variant_query", chrom="1", pos=109274968)
+    assert client.head(url).data == b""
+    assert client.get(url).data
+    assert response_cache.get_single_flight().stats()["in_flight"] == 0
+
+
+def test_concurrent_requests_are_coalesced(app):
+    flights = response_cache.get_single_flight()
+    before = flights.stats()["collapsed"]
+    url = "/data/variant/1_109274968/"
+    barrier = threading.Barrier(4)
+    bodies = []
+
+    def fetch():
+        client = app.test_client()
+        barrier.wait()
+        bodies.append(client.get(url).data)
+
+    threads = [threading.Thread(target=fetch) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(set(bodies)) == 1
+    assert len(bodies[0]) > 0
+    assert flights.stats()["collapsed"] > before
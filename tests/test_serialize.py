@@ -0,0 +1,157 @@
+"""Test the fast JSON serializer and the row containers"""
+import json
+
+import pytest
+
+from fivex.api import format, serialize
+
+
+def _variant(position, **kwargs):
+    fields = dict(
+        study="GTEx",
+        tissue="liver",
+        txrevise_event=None,
+        chromosome="1",
+        position=position,
+        ref_allele="A",
+        alt_allele="G",
+        variant=f"chr1_{position}_A_G",
+        ma_samples=10,
+        maf=0.1,
+        log_pvalue=2.0,
+        beta=0.5,
+        stderr_beta=0.1,
+        vartype="SNP",
+        ac=20,
+        an=200,
+        r2=None,
+        molecular_trait_object_id="ENSG00000134243",
+        gene_id="ENSG00000134243",
+        median_tpm=1.0,
+        rsid="rs1",
+        build="GRCh38",
+        tss_distance=-5,
+        tss_position=-109397918,
+        symbol="SORT1",
+        system="Liver",
+        transcript=None,
+    )
+    fields.update(kwargs)
+    return format.VariantContainer(**fields)
+
+
+def test_variant_container_derived_fields():
+    variant = _variant(109274968)
+    assert not hasattr(variant, "__dict__")
+    result = variant.to_dict()
+    assert result["variant_id"] == "1:109,274,968_A/G"
+    assert result["samples"] == 100
+    assert result["studytissue"] == "GTEx-liver"
+    assert result["pip"] is None
+    assert "r2" not in result
+
+
+def test_ci_container_optional_fields():
+    fields = ["GTEx", "liver", "ENSG1", "1_10_A_G", "1", 10, "A", "G"]
+    fields += ["cs", "L1", "1:1-20", 0.5, 1.0, 0.1, 0.1, 2, 0.1, 0.1, 1.0]
+    container = format.CIContainer(*fields, symbol="SORT1")
+    assert container.variant_id == "1:10_A/G"
+    assert container.maf is None
+    assert container.to_dict()["symbol"] == "SORT1"
+    with pytest.raises(TypeError):
+        format.CIContainer(*fields, not_a_field=1)
+
+
+@pytest.mark.parametrize("count", [0, 1, serialize.CHUNK_SIZE + 1])
+def test_rows_response_matches_jsonify(app, count):
+    rows = [_variant(100 + i) for i in range(count)]
+    response = serialize.rows_response(rows)
+    assert response.mimetype == "application/json"
+
+    expected = [row.to_dict() for row in rows]
+    for i, item in enumerate(expected):
+        item["id"] = i
+    assert json.loads(response.data) == {"data": expected}
+
+
+@pytest.mark.parametrize("count", [0, serialize.CHUNK_SIZE + 1])
+def test_stream_rows_response_matches_buffered(app, count):
+    rows = [_variant(100 + i) for i in range(count)]
+    with app.test_request_context():
+        expected = serialize.rows_response(rows).data
+        response = serialize.stream_rows_response(iter(rows))
+        assert response.is_streamed
+        assert response.mimetype == "application/json"
+        assert b"".join(response.response) == expected
+
+
+def test_stream_rows_response_ndjson(app):
+    rows = [_variant(100 + i) for i in range(3)]
+    with app.test_request_context():
+        response = serialize.stream_rows_response(iter(rows), ndjson=True)
+        assert response.mimetype == serialize.NDJSON_MIMETYPE
+        lines = b"".join(response.response).splitlines()
+    assert [json.loads(line)["id"] for line in lines] == [0, 1, 2]
+    assert json.loads(lines[1])["position"] == 101
+
+
+def test_encode_column():
+    assert serialize.encode_column(["a", "b", "a", "a"]) == {
+        "values": ["a", "b"],
+        "codes": [0, 1, 0, 0],
+    }
+    assert serialize.encode_column([None, None]) == {
+        "values": [None],
+        "codes": [0, 0],
+    }
+    # Numbers and mostly-distinct strings are left alone
+    assert serialize.encode_column([1, 1, 1]) == [1, 1, 1]
+    assert serialize.encode_column(["a", "b", "c"]) == ["a", "b", "c"]
+
+
+@pytest.mark.parametrize("count", [0, 5])
+def test_columnar_response_decodes_to_rows(app, count):
+    rows = [_variant(100 + i) for i in range(count)]
+    with app.test_request_context():
+        expected = json.loads(serialize.rows_response(rows).data)["data"]
+        response = serialize.columnar_response(
+            format.VariantContainer.to_columns(rows)
+        )
+    columns = json.loads(response.data)["data"]
+    assert columns["study"] == (
+        {"values": ["GTEx"], "codes": [0] * count} if count else []
+    )
+    for field, values in columns.items():
+        if isinstance(values, dict):
+            columns[field] = [
+                values["values"][code] for code in values["codes"]
+            ]
+    actual = [
+        {field: values[i] for field, values in columns.items()}
+        for i in range(count)
+    ]
+    assert actual == expected
+    assert set(columns) == set(format.VariantContainer.to_columns([])) | {"id"}
+
+
+def test_grouped_response(app):
+    groups = [({"tissue": "liver"}, [_variant(100), _variant(200)]), ({}, [])]
+    with app.test_request_context():
+        response = serialize.grouped_response(groups)
+        columnar = serialize.grouped_response(
+            [
+                (labels, format.VariantContainer.to_columns(rows))
+                for labels, rows in groups
+            ],
+            columnar=True,
+        )
+        expected = json.loads(serialize.rows_response(groups[0][1]).data)
+    content = json.loads(response.data)["data"]
+    assert content == [
+        {"tissue": "liver", "data": expected["data"]},
+        {"data": []},
+    ]
+    content = json.loads(columnar.data)["data"]
+    assert content[0]["tissue"] == "liver"
+    assert content[0]["data"]["position"] == [100, 200]
+    assert content[1]["data"]["id"] == []
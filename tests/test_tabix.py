@@ -0,0 +1,130 @@
+"""Test shared access to tabix files"""
+import pysam
+import pytest
+
+from fivex import model
+from fivex.cache import LRUCache
+from fivex.tabix import BlockCache, CachedTabixFile, TabixPool
+
+
+class FakeHandle:
+    def __init__(self, path):
+        self.path = path
+        self.closed = False
+
+    def fetch(self, chrom, start, end):
+        if chrom != "1":
+            raise ValueError("could not create iterator for region")
+        return iter(["a", "b"])
+
+    def close(self):
+        self.closed = True
+
+
+def test_pool_reuses_handles():
+    pool = TabixPool(opener=FakeHandle)
+    assert list(pool.fetch("file1", "1", 1, 2)) == ["a", "b"]
+    assert list(pool.fetch("file1", "1", 1, 2)) == ["a", "b"]
+    assert pool.stats()["misses"] == 1
+    assert pool.stats()["hits"] == 1
+
+
+def test_pool_does_not_share_handles_between_open_iterators():
+    pool = TabixPool(opener=FakeHandle)
+    first = pool.fetch("file1", "1", 1, 2)
+    next(first)
+    second = pool.fetch("file1", "1", 1, 2)
+    assert pool.stats()["misses"] == 2
+    list(first), list(second)
+    assert pool.stats()["idle_handles"] == 2
+
+
+def test_pool_evicts_least_recently_used():
+    pool = TabixPool(max_handles=1, opener=FakeHandle)
+    handle1 = pool.acquire("file1")
+    handle2 = pool.acquire("file2")
+    pool.release("file1", handle1)
+    pool.release("file2", handle2)
+    assert handle1.closed and not handle2.closed
+    assert pool.stats()["evictions"] == 1
+
+
+def test_pool_raises_fetch_errors_eagerly():
+    pool = TabixPool(opener=FakeHandle)
+    with pytest.raises(ValueError):
+        pool.fetch("file1", "nonexistent", 1, 2)
+    # The handle is still returned to the pool
+    assert pool.stats()["idle_handles"] == 1
+
+
+def test_pool_reads_real_files(app):
+    pool = TabixPool()
+    source = model.locate_data("1", 109274968)
+    first = list(pool.fetch(source, "1", 109274967, 109274969))
+    second = list(pool.fetch(source, "1", 109274967, 109274969))
+    assert first and first == second
+    assert pool.stats()["hits"] == 1
+
+
+def test_lru_cache_is_bounded_by_size():
+    cache = LRUCache(max_bytes=10)
+    cache.put("a", b"12345")
+    cache.put("b", b"12345")
+    assert cache.get("a") == b"12345"
+    cache.put("c", b"12345")
+    # "b" was the least recently used item
+    assert "b" not in cache and "a" in cache and "c" in cache
+    assert cache.stats()["evictions"] == 1
+
+
+@pytest.mark.parametrize(
+    "region",
+    [
+        ("1", 108774967, 109774969),
+        ("1", 109274967, 109274969),
+        ("1", 0, 1),
+        ("1", 200000000, 200000001),
+        ("1", 109274967, 109274967),
+        ("1", 109274968, 109274968),
+    ],
+)
+def test_cached_reader_matches_pysam(app, region):
+    source = model.locate_study_tissue_data("GTEx", "adipose_subcutaneous")
+    expected = list(pysam.TabixFile(source).fetch(*region))
+    reader = CachedTabixFile(source, BlockCache(1024 ** 2))
+    assert list(reader.fetch(*region)) == expected
+    # A second read is served from the block cache
+    assert list(reader.fetch(*region)) == expected
+
+
+def test_cached_reader_matches_pysam_for_intervals(app):
+    source = model.locate_gencode_data()
+    expected = list(
+        pysam.TabixFile(source).fetch("chr1", 109000000, 110000000)
+    )
+    reader = CachedTabixFile(source, BlockCache(1024 ** 2))
+    assert list(reader.fetch("chr1", 109000000, 110000000)) == expected
+    # An empty region overlaps no interval, even one that contains it
+    assert (
+        list(pysam.TabixFile(source).fetch("chr1", 36402721, 36402721)) == []
+    )
+    assert list(reader.fetch("chr1", 36402721, 36402721)) == []
+
+
+def test_cached_reader_rejects_unknown_chromosome(app):
+    reader = CachedTabixFile(model.locate_data("1", 109274968), BlockCache(1))
+    with pytest.raises(ValueError):
+        reader.fetch("nonexistent", 1, 2)
+
+
+def test_block_cache_can_be_shared_between_processes(app, tmp_path):
+    source = model.locate_data("1", 109274968)
+    first_worker = CachedTabixFile(
+        source, BlockCache(1024 ** 2, str(tmp_path))
+    )
+    expected = list(first_worker.fetch("1", 109274967, 109274969))
+
+    second_cache = BlockCache(1024 ** 2, str(tmp_path))
+    second_worker = CachedTabixFile(source, second_cache)
+    assert list(second_worker.fetch("1", 109274967, 109274969)) == expected
+    assert second_cache.stats()["shared_hits"] > 0
@@ -0,0 +1,564 @@
+"""
+Benchmark every API and view endpoint of FIVEx, against a data directory (by default, the sample data)
+
+Requests are made through the Flask test client, in a single process, so that the cost of the application itself is
+measured (without a web server or network). For each endpoint, the script reports latency percentiles, the number of
+rows returned per second, and the peak memory allocated while serving a request. Results can be saved as a JSON
+baseline, and later runs compared against it.
+
+Each response is also checked against the reference configuration: association data read from the tabix files with
+pysam, and no caches, gene indexes, or columnar copies. This catches optimizations that change the results.
+
+Use `util/generate.synthetic.data.py` to create a larger data directory. Example:
+
+    python util/generate.synthetic.data.py -o /tmp/fivex-synthetic --columnar
+    python util/benchmark.endpoints.py -d /tmp/fivex-synthetic --save baseline.json
+    python util/benchmark.endpoints.py -d /tmp/fivex-synthetic -c FIVEX_STORAGE_BACKEND=columnar --baseline baseline.json
+"""
+import argparse
+import glob
+import json
+import math
+import os
+import re
+import resource
+import sqlite3
+import sys
+import time
+import tracemalloc
+
+import pysam  # type: ignore
+
+# Allow this script to be run from anywhere, using the application itself
+sys.path.insert(
+    0, os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+)
+
+import fivex  # noqa: E402 isort:skip
+from fivex import model  # noqa: E402 isort:skip
+
+# The reference configuration, which reads every file in the simplest way
+REFERENCE_CONFIG = {
+    "FIVEX_STORAGE_BACKEND": "tabix",
+    "FIVEX_BLOCK_CACHE_BYTES": 0,
+    "FIVEX_BLOCK_CACHE_DIR": None,
+    "FIVEX_CREDIBLE_SET_CACHE_BYTES": 0,
+    "FIVEX_RESPONSE_CACHE_BYTES": 0,
+    "FIVEX_RESPONSE_CACHE_DIR": None,
+}
+
+# By default, each request is measured without the server-side response cache (set it with -c to measure it)
+BENCHMARK_CONFIG = {
+    "FIVEX_RESPONSE_CACHE_BYTES": 0,
+    "FIVEX_RESPONSE_CACHE_DIR": None,
+}
+
+# Size of the region used by region queries, centered on the chosen variant (as in the homepage examples)
+REGION_WIDTH = 1000000
+
+# Number of variants in a batch variant query
+BATCH_VARIANTS = 50
+
+_MERGED_FILE = re.compile(
+    r"all\.EBI\.(\w+)\.data\.chr(\w+)\.(\d+)-(\d+)\.tsv\.gz$"
+)
+
+
+def make_app(data_dir: str, config: dict):
+    app = fivex.create_app("fivex.settings.base")
+    app.config["FIVEX_DATA_DIR"] = data_dir
+    app.config["FIVEX_COLUMNAR_DIR"] = data_dir
+    app.config["FIVEX_GENE_INDEX_DIR"] = data_dir
+    app.config.update(config)
+    return app
+
+
+def find_tracks(data_dir: str, datatype: str):
+    """(study, tissue) of each study- and tissue-specific association file"""
+    tracks = []
+    pattern = os.path.join(
+        data_dir, "ebi_original", datatype, "*", "*.all.tsv.gz"
+    )
+    for path in sorted(glob.glob(pattern)):
+        study = os.path.basename(os.path.dirname(path))
+        prefix = f"{study}_{datatype}_"
+        tracks.append(
+            (study, os.path.basename(path)[len(prefix) : -len(".all.tsv.gz")])
+        )
+    return tracks
+
+
+def choose_variant(app, datatype: str):
+    """
+    Choose a variant to query: the best variant (highest PIP) in the first merged chunk that has one with data, and the
+    gene and track of that PIP. Otherwise, the first variant of the first chunk.
+
+    :return: (chrom, pos, gene_id, study, tissue), or None if there is no data
+    """
+    data_dir = app.config["FIVEX_DATA_DIR"]
+    chunks = sorted(
+        glob.glob(os.path.join(data_dir, f"ebi_{datatype}", "*", "*.tsv.gz"))
+    )
+    first = None
+    for path in chunks:
+        match = _MERGED_FILE.search(path)
+        if not match:
+            continue
+        chrom, start, end = (
+            match.group(2),
+            int(match.group(3)),
+            int(match.group(4)),
+        )
+        with pysam.TabixFile(path) as chunk:
+            if first is None:
+                fields = next(chunk.fetch(chrom), "").split("\t")
+                if len(fields) > 18:
+                    first = (chrom, int(fields[4]), fields[18], *fields[:2])
+            with app.app_context():
+                try:
+                    rows = model.query_sqlite(
+                        model.get_best_per_variant_lookup(datatype),
+                        "SELECT chrom, pos, gene_id, study, tissue FROM sig "
+                        "WHERE chrom=? AND pos BETWEEN ? AND ? ORDER BY pip DESC, rowid LIMIT 1",
+                        (chrom, start, end),
+                    )
+                except sqlite3.Error:
+                    rows = []
+            # The best-variant database may cover more variants than the association data (eg in the sample data)
+            for row in rows:
+                if next(chunk.fetch(chrom, row[1] - 1, row[1]), None):
+                    return row
+    return first
+
+
+def sample_variants(app, chrom: str, start: int, end: int, count: int):
+    """Variants (and their rsids) in a region, from the rsid database"""
+    with app.app_context():
+        return model.query_sqlite(
+            model.get_rsid_path(),
+            "SELECT chrom, pos, rsid FROM rsidTable WHERE chrom=? AND pos BETWEEN ? AND ? ORDER BY pos LIMIT ?",
+            (chrom, start, end, count),
+        )
+
+
+def build_cases(app):
+    """
+    Choose the requests to benchmark, from the data that is available
+
+    :return: name -> (method, url, JSON body or None)
+    """
+    cases = {}
+    for datatype in ("ge", "txrev"):
+        variant = choose_variant(app, datatype)
+        tracks = find_tracks(app.config["FIVEX_DATA_DIR"], datatype)
+        if variant is None or not tracks:
+            continue
+        chrom, pos, gene_id, study, tissue = variant
+        if (study, tissue) not in tracks:
+            study, tissue = tracks[0]
+        start = max(1, pos - REGION_WIDTH // 2)
+        end = pos + REGION_WIDTH // 2
+        region = f"{chrom}/{start}-{end}"
+        dt = f"datatype={datatype}"
+        prefix = "" if datatype == "ge" else f"{datatype} "
+
+        cases.update(
+            {
+                f"{prefix}region": (
+                    "GET",
+                    f"/data/region/{region}/{study}/{tissue}/?{dt}",
+                    None,
+                ),
+                f"{prefix}region gene": (
+                    "GET",
+                    f"/data/region/{region}/{study}/{tissue}/?{dt}&gene_id={gene_id}",
+                    None,
+                ),
+                f"{prefix}region gene columnar": (
+                    "GET",
+                    f"/data/region/{region}/{study}/{tissue}/?{dt}&gene_id={gene_id}&format=columnar",
+                    None,
+                ),
+                f"{prefix}region max_points": (
+                    "GET",
+                    f"/data/region/{region}/{study}/{tissue}/?{dt}&max_points=500",
+                    None,
+                ),
+                f"{prefix}region batch": (
+                    "GET",
+                    f"/data/region/{region}/?{dt}&gene_id={gene_id}&"
+                    + "&".join(f"track={s}:{t}" for s, t in tracks[:10]),
+                    None,
+                ),
+                f"{prefix}variant": (
+                    "GET",
+                    f"/data/variant/{chrom}_{pos}/?{dt}",
+                    None,
+                ),
+                f"{prefix}variant columnar": (
+                    "GET",
+                    f"/data/variant/{chrom}_{pos}/?{dt}&format=columnar",
+                    None,
+                ),
+                f"{prefix}credible sets": (
+                    "GET",
+                    f"/data/cs/{region}/?{dt}",
+                    None,
+                ),
+            }
+        )
+        with app.app_context():
+            has_best_variants = os.path.isfile(
+                model.get_best_per_variant_lookup(datatype)
+            )
+        if has_best_variants:
+            cases[f"{prefix}view variant"] = (
+                "GET",
+                f"/views/variant/{chrom}_{pos}/?data_type={datatype}",
+                None,
+            )
+        if datatype != "ge":
+            continue
+
+        batch = sample_variants(app, chrom, start, end, BATCH_VARIANTS)
+        queries = [f"{c}:{p}" for c, p, _ in batch[::2]] + [
+            rsid for _, _, rsid in batch[1::2]
+        ]
+        cases.update(
+            {
+                "best region": ("GET", f"/data/best/region/{region}/", None),
+                "best region gene": (
+                    "GET",
+                    f"/data/best/region/{region}/?gene_id={gene_id}",
+                    None,
+                ),
+                "variants batch": (
+                    "POST",
+                    "/data/variants/",
+                    {"variants": queries},
+                ),
+                "rsid": (
+                    "GET",
+                    f"/data/rsid/{batch[0][2] if batch else 'rs1'}/",
+                    None,
+                ),
+                "rsid batch": (
+                    "POST",
+                    "/data/rsid/",
+                    {"variants": [rsid for _, _, rsid in batch]},
+                ),
+                "view region": (
+                    "GET",
+                    f"/views/region/?chrom={chrom}&start={start}&end={end}",
+                    None,
+                ),
+                "view region gene": (
+                    "GET",
+                    f"/views/region/?chrom={chrom}&start={start}&end={end}&gene_id={gene_id}",
+                    None,
+                ),
+                "gencode genes": (
+                    "GET",
+                    f"/views/gencode/genes/{region}/",
+                    None,
+                ),
+            }
+        )
+        with app.app_context():
+            has_transcripts = os.path.isfile(
+                model.locate_gencode_transcript_data()
+            )
+        if has_transcripts:
+            cases["gencode transcripts"] = (
+                "GET",
+                f"/views/gencode/transcripts/{region}/?gene_id={gene_id}",
+                None,
+            )
+    return cases
+
+
+def request(client, method: str, url: str, body):
+    response = client.open(url, method=method, json=body)
+    data = response.data
+    if response.status_code != 200:
+        raise RuntimeError(f"{method} {url} returned {response.status_code}")
+    return data
+
+
+def count_rows(payload) -> int:
+    """Count the rows in a response: the items of a list, or the values of a column, of `data` (or of each group)"""
+    data = payload.get("data") if isinstance(payload, dict) else payload
+    if isinstance(data, list):
+        if data and isinstance(data[0], dict) and "data" in data[0]:
+            return sum(count_rows(group) for group in data)
+        return len(data)
+    if isinstance(data, dict) and isinstance(data.get("id"), list):
+        return len(data["id"])
+    return 1
+
+
+def percentile(values, fraction: float) -> float:
+    """Percentile of a list of values (nearest rank)"""
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)]
+
+
+def measure(app, cases: dict, repeat: int, warmup: int):
+    """
+    Time each case, then serve it once more while tracing memory allocations
+
+    :return: name -> results, and name -> decoded response (for the correctness check)
+    """
+    client = app.test_client()
+    results = {}
+    responses = {}
+    for name, (method, url, body) in cases.items():
+        for _ in range(warmup):
+            request(client, method, url, body)
+        latencies = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            data = request(client, method, url, body)
+            latencies.append(time.perf_counter() - start)
+
+        tracemalloc.start()
+        request(client, method, url, body)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        payload = json.loads(data)
+        responses[name] = payload
+        rows = count_rows(payload)
+        median = percentile(latencies, 0.5)
+        results[name] = {
+            "url": url,
+            "requests": repeat,
+            "p50_ms": median * 1000,
+            "p90_ms": percentile(latencies, 0.9) * 1000,
+            "p99_ms": percentile(latencies, 0.99) * 1000,
+            "max_ms": max(latencies) * 1000,
+            "rows": rows,
+            "rows_per_s": rows / median if median else None,
+            "bytes": len(data),
+            "peak_alloc_bytes": peak,
+        }
+    return results, responses
+
+
+def differences(expected, actual, path="", limit=5) -> list:
+    """Describe (up to `limit`) differences between two decoded responses. Numbers may differ by rounding."""
+    if isinstance(expected, dict) and isinstance(actual, dict):
+        if expected.keys() != actual.keys():
+            return [
+                f"{path or '/'}: keys {sorted(expected)} != {sorted(actual)}"
+            ]
+        found = []
+        for key in expected:
+            found += differences(
+                expected[key], actual[key], f"{path}/{key}", limit - len(found)
+            )
+            if len(found) >= limit:
+                break
+        return found
+    if isinstance(expected, list) and isinstance(actual, list):
+        if len(expected) != len(actual):
+            return [f"{path or '/'}: {len(expected)} items != {len(actual)}"]
+        found = []
+        for i, (left, right) in enumerate(zip(expected, actual)):
+            found += differences(
+                left, right, f"{path}/{i}", limit - len(found)
+            )
+            if len(found) >= limit:
+                break
+        return found
+    if (
+        isinstance(expected, float)
+        and isinstance(actual, (int, float))
+        and math.isclose(expected, actual, rel_tol=1e-9, abs_tol=1e-12)
+    ):
+        return []
+    if expected != actual:
+        return [f"{path or '/'}: {expected!r} != {actual!r}"]
+    return []
+
+
+def check(data_dir: str, cases: dict, responses: dict) -> dict:
+    """Compare each response with the response of the reference configuration"""
+    client = make_app(data_dir, REFERENCE_CONFIG).test_client()
+    return {
+        name: differences(
+            json.loads(request(client, method, url, body)), responses[name]
+        )
+        for name, (method, url, body) in cases.items()
+    }
+
+
+def parse_config(values) -> dict:
+    """Parse `NAME=VALUE` config overrides. Values are read as JSON when possible (eg numbers, null)."""
+    config = {}
+    for item in values or []:
+        name, _, value = item.partition("=")
+        try:
+            config[name] = json.loads(value)
+        except ValueError:
+            config[name] = value
+    return config
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark FIVEx's API and view endpoints, and check their results"
+    )
+    parser.add_argument(
+        "-d",
+        "--data-dir",
+        type=str,
+        default=os.environ.get(
+            "FIVEX_DATA_DIR",
+            os.path.join(
+                os.path.dirname(os.path.dirname(os.path.realpath(__file__))),
+                "data",
+            ),
+        ),
+        help="FIVEx data directory (default: $FIVEX_DATA_DIR, or the sample data)",
+    )
+    parser.add_argument(
+        "-n",
+        "--repeat",
+        type=int,
+        default=10,
+        help="Timed requests per endpoint",
+    )
+    parser.add_argument(
+        "-w",
+        "--warmup",
+        type=int,
+        default=2,
+        help="Untimed requests per endpoint, made first",
+    )
+    parser.add_argument(
+        "-c",
+        "--config",
+        action="append",
+        metavar="NAME=VALUE",
+        help="Override an app setting (repeat for several), eg -c FIVEX_STORAGE_BACKEND=columnar",
+    )
+    parser.add_argument(
+        "-k",
+        "--only",
+        type=str,
+        default=None,
+        help="Only run the endpoints whose name contains this text",
+    )
+    parser.add_argument(
+        "--save",
+        type=str,
+        default=None,
+        help="Save the results as a JSON baseline",
+    )
+    parser.add_argument(
+        "--baseline",
+        type=str,
+        default=None,
+        help="Compare the results with a saved JSON baseline",
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="Report endpoints whose median latency grew by more than this fraction of the baseline",
+    )
+    parser.add_argument(
+        "--min-change-ms",
+        type=float,
+        default=1.0,
+        help="Ignore smaller changes in median latency (timer noise)",
+    )
+    parser.add_argument(
+        "--no-check",
+        action="store_true",
+        help="Do not compare responses with the reference configuration",
+    )
+    args = parser.parse_args()
+
+    data_dir = os.path.realpath(args.data_dir)
+    config = dict(BENCHMARK_CONFIG, **parse_config(args.config))
+    app = make_app(data_dir, config)
+    cases = build_cases(app)
+    if args.only:
+        cases = {
+            name: case for name, case in cases.items() if args.only in name
+        }
+    if not cases:
+        parser.error(f"No data to benchmark in {data_dir}")
+
+    warm_up = fivex.warm_up(app)
+    results, responses = measure(app, cases, args.repeat, args.warmup)
+    report = {
+        "data_dir": data_dir,
+        "config": config,
+        "python": sys.version.split()[0],
+        "warm_up_s": warm_up,
+        "peak_rss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        * 1024,
+        "results": results,
+    }
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+
+    print(
+        f"{'endpoint':<28} {'p50 ms':>9} {'p90 ms':>9} {'p99 ms':>9} {'rows':>8} {'rows/s':>11} {'peak KiB':>9}"
+        + (f" {'baseline':>9} {'change':>8}" if baseline else "")
+    )
+    regressions = []
+    for name, result in results.items():
+        line = (
+            f"{name:<28} {result['p50_ms']:>9.2f} {result['p90_ms']:>9.2f} {result['p99_ms']:>9.2f} "
+            f"{result['rows']:>8} {result['rows_per_s'] or 0:>11.0f} {result['peak_alloc_bytes'] / 1024:>9.0f}"
+        )
+        if name in baseline:
+            before = baseline[name]["p50_ms"]
+            change = result["p50_ms"] / before - 1 if before else 0.0
+            line += f" {before:>9.2f} {change:>+8.0%}"
+            if (
+                change > args.tolerance
+                and result["p50_ms"] - before > args.min_change_ms
+            ):
+                regressions.append(name)
+                line += "  SLOWER"
+        print(line)
+    print(f"Peak RSS: {report['peak_rss_bytes'] / 1024 ** 2:.0f} MiB")
+
+    failures = {}
+    if not args.no_check:
+        failures = {
+            name: found
+            for name, found in check(data_dir, cases, responses).items()
+            if found
+        }
+        for name, found in failures.items():
+            print(f"MISMATCH {name} ({cases[name][1]}):")
+            for difference in found:
+                print(f"    {difference}")
+        if not failures:
+            print(
+                f"All {len(cases)} responses match the reference configuration"
+            )
+    report["mismatches"] = failures
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    if regressions:
+        print(
+            f"Slower than the baseline (by more than {args.tolerance:.0%}): {', '.join(regressions)}"
+        )
+    if failures or regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,701 @@
+"""
+Load-test a FIVEx server: replay a mix of requests at a target rate, and measure throughput, latency, errors, and the
+memory used by each worker over time
+
+Single-request benchmarks (see `util/benchmark.endpoints.py`) do not show the contention between concurrent requests
+in a deployed server. This script starts the app with gunicorn (as in `deploy/fivex.service`), or targets a server
+that is already running, and sends requests at a fixed rate from many client threads. Latency is measured from the
+time each request was scheduled to be sent, so that a server that falls behind is not hidden by a client that waits
+for it.
+
+The requests come from an access log (Apache "combined" format, as written by `deploy/sample-apache-https.conf`, or
+a file with one URL path per line), or are generated from the data directory: a mix of region, variant, best-variant
+and gencode requests, with a few popular URLs requested much more often than the rest. Examples:
+
+    python util/benchmark.load.py -d /tmp/fivex-synthetic --worker-class gevent --workers 4 --rate 50 --duration 60
+    python util/benchmark.load.py -d /tmp/fivex-synthetic --worker-class sync --workers 8 --rate 50 --duration 60 \\
+        -e FIVEX_RESPONSE_CACHE_BYTES=0 --baseline gevent.json
+    python util/benchmark.load.py --access-log /var/log/apache2/fivex-access.log --url http://localhost:8877
+
+Each run can be saved (--save) and compared with an earlier one (--baseline), to compare worker classes, worker counts
+and cache settings before deploying. Memory is measured on Linux only (from /proc).
+"""
+import argparse
+import collections
+import glob
+import gzip
+import http.client
+import json
+import math
+import os
+import random
+import re
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+import typing as ty
+import urllib.parse
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+# Apache "combined" (or "common") log lines: ... "GET /api/data/variant/1_109274968/ HTTP/1.1" 200 ...
+_LOG_LINE = re.compile(r'"(?:GET|HEAD) (\S+) HTTP/[0-9.]+"')
+
+# In production, the app is served behind a proxy, under this prefix
+PROXY_PREFIX = "/api"
+
+# Kinds of requests, by URL path, for the report and the generated mix
+KINDS = [
+    ("region", re.compile(r"^/data/region/")),
+    ("variant", re.compile(r"^/data/variant/")),
+    ("best", re.compile(r"^/data/best/")),
+    ("credible sets", re.compile(r"^/data/cs/")),
+    ("rsid", re.compile(r"^/data/rsid/")),
+    ("gencode", re.compile(r"^/views/gencode/")),
+    ("view variant", re.compile(r"^/views/variant/")),
+    ("view region", re.compile(r"^/views/region/")),
+]
+
+DEFAULT_MIX = "region=4,variant=3,best=2,gencode=1"
+
+_MERGED_FILE = re.compile(
+    r"all\.EBI\.ge\.data\.chr(\w+)\.(\d+)-(\d+)\.tsv\.gz$"
+)
+
+
+def classify(path: str) -> str:
+    for kind, pattern in KINDS:
+        if pattern.match(path):
+            return kind
+    return "other"
+
+
+def read_access_log(path: str) -> ty.List[str]:
+    """The URL paths of the API and view requests in an access log (or a list of paths), in order"""
+    opener = gzip.open if path.endswith(".gz") else open
+    paths = []
+    with opener(path, "rt") as f:
+        for line in f:
+            line = line.strip()
+            match = _LOG_LINE.search(line)
+            if match:
+                line = match.group(1)
+            elif not line.startswith("/"):
+                continue
+            if line.startswith(PROXY_PREFIX + "/"):
+                line = line[len(PROXY_PREFIX) :]
+            if line.startswith(("/data/", "/views/")):
+                paths.append(line)
+    return paths
+
+
+def read_data_points(data_dir: str, limit: int = 100000):
+    """
+    Read (chrom, pos, gene_id) of the variants in the merged gene expression files, and the (study, tissue) tracks
+    """
+    points = []
+    for path in sorted(
+        glob.glob(os.path.join(data_dir, "ebi_ge", "*", "*.tsv.gz"))
+    ):
+        match = _MERGED_FILE.search(path)
+        if not match:
+            continue
+        seen = set()
+        with gzip.open(path, "rt") as f:
+            for i, line in enumerate(f):
+                if i >= limit:
+                    break
+                fields = line.split("\t", 5)
+                key = (fields[3], int(fields[4]), fields[2])
+                if key not in seen:
+                    seen.add(key)
+                    points.append(key)
+    tracks = []
+    for path in sorted(
+        glob.glob(
+            os.path.join(data_dir, "ebi_original", "ge", "*", "*.all.tsv.gz")
+        )
+    ):
+        study = os.path.basename(os.path.dirname(path))
+        prefix = f"{study}_ge_"
+        tracks.append(
+            (study, os.path.basename(path)[len(prefix) : -len(".all.tsv.gz")])
+        )
+    return points, tracks
+
+
+def generate_mix(
+    data_dir: str,
+    mix: ty.Dict[str, float],
+    distinct: int,
+    count: int,
+    zipf: float,
+    rng: random.Random,
+) -> ty.List[str]:
+    """
+    Generate a request mix from the data: `distinct` different URLs (of each kind, in proportion to its weight), and
+    `count` requests drawn from them with a Zipf distribution (the most popular URL is requested most often)
+    """
+    points, tracks = read_data_points(data_dir)
+    if not points or not tracks:
+        raise SystemExit(f"No gene expression data found in {data_dir}")
+    kinds = list(mix)
+    weights = [mix[kind] for kind in kinds]
+    urls = []
+    for _ in range(distinct):
+        kind = rng.choices(kinds, weights)[0]
+        chrom, pos, gene_id = rng.choice(points)
+        width = rng.choice([200000, 500000, 1000000])
+        start, end = max(1, pos - width // 2), pos + width // 2
+        if kind == "region":
+            study, tissue = rng.choice(tracks)
+            urls.append(
+                f"/data/region/{chrom}/{start}-{end}/{study}/{tissue}/?gene_id={gene_id}"
+            )
+        elif kind == "variant":
+            urls.append(f"/data/variant/{chrom}_{pos}/")
+        elif kind == "best":
+            gene = f"?gene_id={gene_id}" if rng.random() < 0.5 else ""
+            urls.append(f"/data/best/region/{chrom}/{start}-{end}/{gene}")
+        elif kind == "gencode":
+            urls.append(f"/views/gencode/genes/{chrom}/{start}-{end}/")
+        elif kind == "view variant":
+            urls.append(f"/views/variant/{chrom}_{pos}/")
+        elif kind == "view region":
+            urls.append(
+                f"/views/region/?chrom={chrom}&start={start}&end={end}"
+            )
+        else:
+            raise SystemExit(f"Unknown request kind in mix: {kind}")
+    popularity = [1 / (rank + 1) ** zipf for rank in range(len(urls))]
+    return rng.choices(urls, popularity, k=count)
+
+
+def parse_pairs(values: ty.Iterable[str]) -> ty.Dict[str, str]:
+    pairs = {}
+    for item in values:
+        name, _, value = item.partition("=")
+        pairs[name.strip()] = value.strip()
+    return pairs
+
+
+class Server:
+    """A gunicorn server for the app (configured like the production service), started on a free local port"""
+
+    def __init__(self, args):
+        with socket.socket() as s:
+            s.bind(("127.0.0.1", 0))
+            self.port = s.getsockname()[1]
+        env = dict(os.environ)
+        env.setdefault("SECRET_KEY", "load-test")
+        if args.data_dir:
+            env["FIVEX_DATA_DIR"] = args.data_dir
+        env.update(parse_pairs(args.env or []))
+        command = [
+            sys.executable,
+            "-m",
+            "gunicorn",
+            "-k",
+            args.worker_class,
+            "--workers",
+            str(args.workers),
+            "--bind",
+            f"127.0.0.1:{self.port}",
+            "--pythonpath",
+            f"{os.path.join(ROOT, 'deploy')},{ROOT}",
+            *(["--threads", str(args.threads)] if args.threads else []),
+            *(args.gunicorn_arg or []),
+            "wsgi:app",
+        ]
+        self.process = subprocess.Popen(command, env=env, cwd=ROOT)
+        self.url = f"http://127.0.0.1:{self.port}"
+
+    def wait_until_ready(self, timeout: float):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise SystemExit(
+                    f"gunicorn exited with status {self.process.returncode}"
+                )
+            try:
+                connection = http.client.HTTPConnection(
+                    "127.0.0.1", self.port, timeout=1
+                )
+                connection.request("GET", "/")
+                connection.getresponse().read()
+                connection.close()
+                return
+            except OSError:
+                time.sleep(0.2)
+        raise SystemExit(f"gunicorn did not start within {timeout}s")
+
+    def stop(self):
+        if self.process.poll() is None:
+            self.process.send_signal(signal.SIGTERM)
+            try:
+                self.process.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+
+
+def _children(pid: int) -> ty.List[int]:
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            return [int(child) for child in f.read().split()]
+    except OSError:
+        return []
+
+
+def _rss_bytes(pid: int) -> ty.Optional[int]:
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+class MemorySampler(threading.Thread):
+    """Sample the resident memory (RSS) of the worker processes (the children of the server process) periodically"""
+
+    def __init__(self, pids: ty.List[int], interval: float):
+        super().__init__(daemon=True)
+        self.pids = pids
+        self.interval = interval
+        self.samples: ty.List[ty.Tuple[float, ty.Dict[int, int]]] = []
+        self._done = threading.Event()
+        self.start_time = time.monotonic()
+
+    def run(self):
+        while not self._done.is_set():
+            workers = [
+                child for pid in self.pids for child in _children(pid)
+            ] or self.pids
+            usage = {}
+            for pid in workers:
+                rss = _rss_bytes(pid)
+                if rss is not None:
+                    usage[pid] = rss
+            self.samples.append((time.monotonic() - self.start_time, usage))
+            self._done.wait(self.interval)
+
+    def stop(self):
+        self._done.set()
+        self.join()
+
+
+class LoadGenerator:
+    """
+    Send requests at a fixed rate (open loop) from a pool of client threads, each with a keep-alive connection
+
+    Requests that can not be sent on time (because every client thread is busy) are sent as soon as possible, and their
+    latency includes the time spent waiting.
+    """
+
+    def __init__(
+        self,
+        url: str,
+        paths: ty.List[str],
+        rate: float,
+        concurrency: int,
+        timeout: float,
+    ):
+        parsed = urllib.parse.urlsplit(url)
+        self.host = parsed.hostname
+        self.port = parsed.port or 80
+        self.prefix = parsed.path.rstrip("/")
+        self.paths = paths
+        self.rate = rate
+        self.concurrency = concurrency
+        self.timeout = timeout
+        # (scheduled time, kind, latency in seconds, status code or None for connection errors, response bytes)
+        self.results: ty.List[
+            ty.Tuple[float, str, float, ty.Optional[int], int]
+        ] = []
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def _claim(self) -> ty.Optional[ty.Tuple[int, float]]:
+        with self._lock:
+            index = self._next
+            if index >= len(self.paths):
+                return None
+            self._next += 1
+        return index, self.start + index / self.rate
+
+    def _client(self):
+        connection = None
+        while True:
+            claimed = self._claim()
+            if claimed is None:
+                break
+            index, scheduled = claimed
+            delay = scheduled - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            path = self.paths[index]
+            status, size = None, 0
+            try:
+                if connection is None:
+                    connection = http.client.HTTPConnection(
+                        self.host, self.port, timeout=self.timeout
+                    )
+                connection.request("GET", self.prefix + path)
+                response = connection.getresponse()
+                size = len(response.read())
+                status = response.status
+                if response.will_close:
+                    connection.close()
+                    connection = None
+            except (OSError, http.client.HTTPException):
+                if connection is not None:
+                    connection.close()
+                connection = None
+            latency = time.monotonic() - scheduled
+            with self._lock:
+                self.results.append(
+                    (
+                        scheduled - self.start,
+                        classify(path),
+                        latency,
+                        status,
+                        size,
+                    )
+                )
+        if connection is not None:
+            connection.close()
+
+    def run(self) -> float:
+        """Send every request, and return the elapsed time"""
+        self.start = time.monotonic()
+        threads = [
+            threading.Thread(target=self._client, daemon=True)
+            for _ in range(self.concurrency)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return time.monotonic() - self.start
+
+
+def percentile(values: ty.List[float], fraction: float) -> float:
+    """Percentile of a list of values (nearest rank)"""
+    ordered = sorted(values)
+    return (
+        ordered[max(0, math.ceil(fraction * len(ordered)) - 1)]
+        if ordered
+        else float("nan")
+    )
+
+
+def summarize(results, elapsed: float) -> dict:
+    def stats(rows):
+        latencies = [row[2] for row in rows]
+        # Not found (eg no data for a gene in a region) is a valid answer, but a server error or timeout is not
+        errors = sum(1 for row in rows if row[3] is None or row[3] >= 500)
+        client_errors = sum(
+            1 for row in rows if row[3] is not None and 400 <= row[3] < 500
+        )
+        return {
+            "requests": len(rows),
+            "throughput_per_s": len(rows) / elapsed if elapsed else None,
+            "error_rate": errors / len(rows) if rows else 0.0,
+            "client_error_rate": client_errors / len(rows) if rows else 0.0,
+            "p50_ms": percentile(latencies, 0.5) * 1000,
+            "p95_ms": percentile(latencies, 0.95) * 1000,
+            "p99_ms": percentile(latencies, 0.99) * 1000,
+            "max_ms": max(latencies) * 1000 if latencies else float("nan"),
+        }
+
+    by_kind = collections.defaultdict(list)
+    for row in results:
+        by_kind[row[1]].append(row)
+    return {
+        "overall": stats(results),
+        "by_kind": {
+            kind: stats(rows) for kind, rows in sorted(by_kind.items())
+        },
+    }
+
+
+def memory_report(samples, interval: float) -> dict:
+    """Peak and final RSS of each worker, and the total RSS over time (in bins of about `interval` seconds)"""
+    workers = {}
+    for _, usage in samples:
+        for pid, rss in usage.items():
+            worker = workers.setdefault(
+                str(pid), {"peak_bytes": 0, "last_bytes": 0}
+            )
+            worker["peak_bytes"] = max(worker["peak_bytes"], rss)
+            worker["last_bytes"] = rss
+    timeline = [
+        {
+            "t": round(t, 1),
+            "workers": len(usage),
+            "total_bytes": sum(usage.values()),
+        }
+        for t, usage in samples
+    ]
+    return {"workers": workers, "timeline": timeline, "interval_s": interval}
+
+
+def print_report(report: dict, baseline: ty.Optional[dict]):
+    header = f"{'requests':<16} {'count':>7} {'req/s':>8} {'errors':>7} {'4xx':>6} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'max ms':>9}"
+    print(header + (f" {'base p95':>9} {'change':>8}" if baseline else ""))
+    rows = [("all", report["summary"]["overall"])] + list(
+        report["summary"]["by_kind"].items()
+    )
+    for name, stats in rows:
+        line = (
+            f"{name:<16} {stats['requests']:>7} {stats['throughput_per_s'] or 0:>8.1f} {stats['error_rate']:>7.1%} {stats['client_error_rate']:>6.1%} "
+            f"{stats['p50_ms']:>9.1f} {stats['p95_ms']:>9.1f} {stats['p99_ms']:>9.1f} {stats['max_ms']:>9.1f}"
+        )
+        if baseline:
+            before = (
+                baseline["summary"]["overall"]
+                if name == "all"
+                else baseline["summary"]["by_kind"].get(name)
+            )
+            if before and before["p95_ms"]:
+                line += f" {before['p95_ms']:>9.1f} {stats['p95_ms'] / before['p95_ms'] - 1:>+8.0%}"
+        print(line)
+
+    memory = report.get("memory")
+    if memory and memory["workers"]:
+        print()
+        print(
+            "Worker RSS (MiB): "
+            + ", ".join(
+                f"pid {pid}: peak {worker['peak_bytes'] / 1024 ** 2:.0f}, end {worker['last_bytes'] / 1024 ** 2:.0f}"
+                for pid, worker in memory["workers"].items()
+            )
+        )
+        timeline = memory["timeline"]
+        step = max(1, len(timeline) // 10)
+        print(
+            "Total worker RSS over time: "
+            + ", ".join(
+                f"{point['t']:.0f}s {point['total_bytes'] / 1024 ** 2:.0f}"
+                for point in timeline[::step]
+            )
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Replay a mix of requests against a FIVEx server at a target rate, and measure how it copes"
+    )
+    source = parser.add_argument_group("requests")
+    source.add_argument(
+        "--access-log",
+        type=str,
+        default=None,
+        help="Replay the GET requests of an access log (or a file of URL paths), instead of a generated mix",
+    )
+    source.add_argument(
+        "-d",
+        "--data-dir",
+        type=str,
+        default=os.environ.get("FIVEX_DATA_DIR", os.path.join(ROOT, "data")),
+        help="FIVEx data directory, used to generate requests and by the server (default: $FIVEX_DATA_DIR or the "
+        "sample data)",
+    )
+    source.add_argument(
+        "--mix",
+        type=str,
+        default=DEFAULT_MIX,
+        help=f"Relative weights of each kind of generated request (default: {DEFAULT_MIX}; also: view variant, "
+        "view region)",
+    )
+    source.add_argument(
+        "--distinct",
+        type=int,
+        default=200,
+        help="Number of different URLs to generate",
+    )
+    source.add_argument(
+        "--zipf",
+        type=float,
+        default=1.0,
+        help="Skew of URL popularity (0: all URLs are equally popular)",
+    )
+    source.add_argument("--seed", type=int, default=1, help="Random seed")
+
+    load = parser.add_argument_group("load")
+    load.add_argument(
+        "-r", "--rate", type=float, default=20.0, help="Requests per second"
+    )
+    load.add_argument(
+        "-t",
+        "--duration",
+        type=float,
+        default=30.0,
+        help="Length of the test, in seconds",
+    )
+    load.add_argument(
+        "-c",
+        "--concurrency",
+        type=int,
+        default=64,
+        help="Maximum number of requests in flight (client threads)",
+    )
+    load.add_argument(
+        "--timeout",
+        type=float,
+        default=60.0,
+        help="Timeout of each request, in seconds",
+    )
+
+    server = parser.add_argument_group("server")
+    server.add_argument(
+        "--url",
+        type=str,
+        default=None,
+        help="Test a server that is already running (eg http://localhost:8877), instead of starting gunicorn",
+    )
+    server.add_argument(
+        "--pid",
+        type=int,
+        action="append",
+        help="With --url: the server process to measure memory for (its children are the workers)",
+    )
+    server.add_argument(
+        "-k",
+        "--worker-class",
+        type=str,
+        default="gevent",
+        help="gunicorn worker class (eg gevent, sync, gthread)",
+    )
+    server.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=4,
+        help="Number of gunicorn workers",
+    )
+    server.add_argument(
+        "--threads",
+        type=int,
+        default=None,
+        help="Threads per worker (gthread workers)",
+    )
+    server.add_argument(
+        "-e",
+        "--env",
+        action="append",
+        metavar="NAME=VALUE",
+        help="Set an environment variable (eg an app setting, like FIVEX_RESPONSE_CACHE_BYTES) for the server",
+    )
+    server.add_argument(
+        "--gunicorn-arg",
+        action="append",
+        help="Extra argument for gunicorn (repeat for several)",
+    )
+    server.add_argument(
+        "--startup-timeout",
+        type=float,
+        default=120.0,
+        help="Time allowed for the server to start, in seconds",
+    )
+
+    output = parser.add_argument_group("output")
+    output.add_argument(
+        "--sample-interval",
+        type=float,
+        default=1.0,
+        help="Seconds between memory samples",
+    )
+    output.add_argument(
+        "--save", type=str, default=None, help="Save the results as JSON"
+    )
+    output.add_argument(
+        "--baseline",
+        type=str,
+        default=None,
+        help="Compare with the saved results of another run",
+    )
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    count = max(1, int(args.rate * args.duration))
+    if args.access_log:
+        logged = read_access_log(args.access_log)
+        if not logged:
+            parser.error(f"No API or view requests found in {args.access_log}")
+        # Replay in order, from the start again if the log is shorter than the test
+        paths = [logged[i % len(logged)] for i in range(count)]
+    else:
+        mix = {
+            kind: float(weight)
+            for kind, weight in parse_pairs(args.mix.split(",")).items()
+        }
+        paths = generate_mix(
+            args.data_dir, mix, args.distinct, count, args.zipf, rng
+        )
+
+    started = None
+    if args.url:
+        url, pids = args.url, args.pid or []
+    else:
+        started = Server(args)
+        url, pids = started.url, [started.process.pid]
+    try:
+        if started is not None:
+            started.wait_until_ready(args.startup_timeout)
+        print(
+            f"Sending {len(paths)} requests to {url} at {args.rate:g}/s ({len(set(paths))} different URLs)"
+        )
+        sampler = MemorySampler(pids, args.sample_interval) if pids else None
+        if sampler is not None:
+            sampler.start()
+        generator = LoadGenerator(
+            url, paths, args.rate, args.concurrency, args.timeout
+        )
+        elapsed = generator.run()
+        if sampler is not None:
+            sampler.stop()
+    finally:
+        if started is not None:
+            started.stop()
+
+    report = {
+        "url": url,
+        "server": None
+        if args.url
+        else {
+            "worker_class": args.worker_class,
+            "workers": args.workers,
+            "threads": args.threads,
+            "env": parse_pairs(args.env or []),
+        },
+        "source": args.access_log
+        or {
+            "data_dir": args.data_dir,
+            "mix": args.mix,
+            "distinct": args.distinct,
+        },
+        "rate": args.rate,
+        "elapsed_s": elapsed,
+        "summary": summarize(generator.results, elapsed),
+        "memory": memory_report(sampler.samples, args.sample_interval)
+        if sampler is not None
+        else None,
+    }
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    print_report(report, baseline)
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
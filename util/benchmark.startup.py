@@ -0,0 +1,134 @@
+"""
+Measure how long a new FIVEx worker takes to start: importing the app, creating it, warming it up, and serving its
+first requests
+
+Each measurement runs in a fresh Python process (as a newly forked or restarted worker would), and is repeated to
+report the median and worst case. Example:
+
+    python util/benchmark.startup.py -n 5
+    python util/benchmark.startup.py -n 5 --no-warm-up
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+# Pages and API calls made by the homepage examples
+DEFAULT_URLS = [
+    "/views/variant/1_109274968/",
+    "/views/region/?chrom=1&start=108774968&end=109774968",
+    "/data/variant/1_109274968/",
+    "/data/region/1/108774968-109774968/GTEx/adipose_subcutaneous/?gene_id=ENSG00000134243",
+]
+
+# Runs in a fresh process, and prints its timings (in seconds) as JSON
+WORKER_SCRIPT = """
+import json
+import sys
+import time
+
+settings, warm, urls = sys.argv[1], sys.argv[2] == "1", sys.argv[3:]
+timings = {}
+start = time.perf_counter()
+import fivex
+timings["import"] = time.perf_counter() - start
+
+start = time.perf_counter()
+app = fivex.create_app(settings)
+timings["create_app"] = time.perf_counter() - start
+
+if warm:
+    start = time.perf_counter()
+    for name, seconds in fivex.warm_up(app).items():
+        timings[f"warm_up:{name}"] = seconds
+    timings["warm_up"] = time.perf_counter() - start
+
+client = app.test_client()
+for url in urls:
+    start = time.perf_counter()
+    response = client.get(url)
+    response.data
+    timings[f"first {url}"] = time.perf_counter() - start
+    if response.status_code != 200:
+        raise RuntimeError(f"{url} returned {response.status_code}")
+    start = time.perf_counter()
+    client.get(url).data
+    timings[f"second {url}"] = time.perf_counter() - start
+print(json.dumps(timings))
+"""
+
+
+def run_worker(settings: str, warm_up: bool, urls: list) -> dict:
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(
+        filter(None, [ROOT, env.get("PYTHONPATH")])
+    )
+    # Measure the real cost of each request, not the server-side response cache
+    env["FIVEX_RESPONSE_CACHE_BYTES"] = "0"
+    output = subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            WORKER_SCRIPT,
+            settings,
+            "1" if warm_up else "0",
+            *urls,
+        ],
+        check=True,
+        capture_output=True,
+        text=True,
+        env=env,
+        cwd=ROOT,
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Measure the startup time and first-request latency of a FIVEx worker"
+    )
+    parser.add_argument(
+        "-n",
+        "--repeat",
+        type=int,
+        default=3,
+        help="Number of fresh processes to measure",
+    )
+    parser.add_argument(
+        "-s",
+        "--settings",
+        type=str,
+        default="fivex.settings.test",
+        help="Settings module (the test settings use the sample data)",
+    )
+    parser.add_argument(
+        "--no-warm-up",
+        action="store_true",
+        help="Do not call fivex.warm_up before the first request",
+    )
+    parser.add_argument(
+        "urls",
+        nargs="*",
+        default=DEFAULT_URLS,
+        help="URLs to request, in order",
+    )
+    args = parser.parse_args()
+
+    runs = [
+        run_worker(args.settings, not args.no_warm_up, args.urls)
+        for _ in range(args.repeat)
+    ]
+    print(f"{'step':<100} {'median ms':>10} {'max ms':>10}")
+    for step in runs[0]:
+        values = [run[step] * 1000 for run in runs]
+        print(
+            f"{step:<100} {statistics.median(values):>10.1f} {max(values):>10.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
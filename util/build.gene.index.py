@@ -0,0 +1,67 @@
+import argparse
+import glob
+import os
+import sys
+
+# Allow this script to be run from anywhere, using the index format defined by the web application
+sys.path.insert(
+    0, os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+)
+
+from fivex.geneindex import build_gene_index  # noqa: E402 isort:skip
+
+parser = argparse.ArgumentParser(
+    description="Build gene indexes for FIVEx's study- and tissue-specific association files"
+)
+parser.add_argument(
+    "-d",
+    "--data-dir",
+    type=str,
+    required=True,
+    help="FIVEx data directory, containing the ebi_original/ subdirectory",
+)
+parser.add_argument(
+    "-o",
+    "--out-dir",
+    type=str,
+    required=False,
+    default=None,
+    help="Directory to hold the indexes (default: the data directory). Set FIVEX_GENE_INDEX_DIR to match.",
+)
+parser.add_argument(
+    "-t",
+    "--datatype",
+    type=str,
+    required=False,
+    default="ge",
+    help="Data type to index (ge or txrev)",
+)
+parser.add_argument(
+    "-f",
+    "--force",
+    action="store_true",
+    help="Build indexes again, even if an index already exists",
+)
+
+args = parser.parse_args()
+outDir = args.out_dir or args.data_dir
+
+# Study- and tissue-specific files: {study}/{study}_{datatype}_{tissue}.all.tsv.gz
+studyTissueFiles = glob.glob(
+    os.path.join(
+        args.data_dir, "ebi_original", args.datatype, "*", "*.all.tsv.gz"
+    )
+)
+
+for filename in sorted(studyTissueFiles):
+    relativePath = os.path.relpath(filename, args.data_dir)
+    destination = os.path.join(outDir, f"{relativePath}.genes")
+    if (
+        os.path.isfile(os.path.join(destination, "meta.json"))
+        and not args.force
+    ):
+        print(f"Skipping {relativePath}: already indexed")
+        continue
+
+    rows = build_gene_index(filename, destination)
+    print(f"Indexed {relativePath}: {rows} rows")
@@ -0,0 +1,80 @@
+import argparse
+import glob
+import os
+import sys
+
+# Allow this script to be run from anywhere, using the storage format defined by the web application
+sys.path.insert(
+    0, os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+)
+
+from fivex.columnar import convert_association_file  # noqa: E402 isort:skip
+
+parser = argparse.ArgumentParser(
+    description="Convert tabix-indexed association files to FIVEx's columnar storage format"
+)
+parser.add_argument(
+    "-d",
+    "--data-dir",
+    type=str,
+    required=True,
+    help="FIVEx data directory, containing the ebi_original/ and ebi_{datatype}/ subdirectories",
+)
+parser.add_argument(
+    "-o",
+    "--out-dir",
+    type=str,
+    required=False,
+    default=None,
+    help="Directory to hold the columnar files (default: the data directory). Set FIVEX_COLUMNAR_DIR to match.",
+)
+parser.add_argument(
+    "-t",
+    "--datatype",
+    type=str,
+    required=False,
+    default="ge",
+    help="Data type to convert (ge or txrev)",
+)
+parser.add_argument(
+    "-f",
+    "--force",
+    action="store_true",
+    help="Convert files again, even if a columnar copy already exists",
+)
+
+args = parser.parse_args()
+outDir = args.out_dir or args.data_dir
+
+# Study- and tissue-specific files: {study}/{study}_{datatype}_{tissue}.all.tsv.gz
+# Study and tissue names may contain underscores, so the study is taken from the directory name
+studyTissueFiles = glob.glob(
+    os.path.join(
+        args.data_dir, "ebi_original", args.datatype, "*", "*.all.tsv.gz"
+    )
+)
+# Merged files (all studies and tissues) in 1Mbp chunks: {chrom}/all.EBI.{datatype}.data.chr{chrom}.{start}-{end}.tsv.gz
+mergedFiles = glob.glob(
+    os.path.join(args.data_dir, f"ebi_{args.datatype}", "*", "*.tsv.gz")
+)
+
+for filename in sorted(studyTissueFiles) + sorted(mergedFiles):
+    relativePath = os.path.relpath(filename, args.data_dir)
+    destination = os.path.join(outDir, f"{relativePath}.columns")
+    if (
+        os.path.isfile(os.path.join(destination, "meta.json"))
+        and not args.force
+    ):
+        print(f"Skipping {relativePath}: already converted")
+        continue
+
+    study = tissue = None
+    if filename in studyTissueFiles:
+        study = os.path.basename(os.path.dirname(filename))
+        prefix = f"{study}_{args.datatype}_"
+        tissue = os.path.basename(filename)[len(prefix) : -len(".all.tsv.gz")]
+
+    rows = convert_association_file(
+        filename, destination, study=study, tissue=tissue
+    )
+    print(f"Converted {relativePath}: {rows} rows")
@@ -0,0 +1,559 @@
+"""
+Generate a synthetic FIVEx data directory, in the same formats as the EBI eQTL Catalogue data, at a configurable scale
+
+The sample data in `data/` covers a single variant and a small region, which is too little to measure performance.
+This script creates every file that the web application reads, for a region of one chromosome:
+    - Study- and tissue-specific association files (ebi_original/), and the merged 1Mbp chunks (ebi_{datatype}/)
+    - Study- and tissue-specific credible sets, and the merged credible sets for the chromosome (credible_sets/)
+    - The best-variant (PIP) database, with its summary tables, and the rsid database
+
+Variants are placed at random positions (at the requested density), and each is tested against the real GENCODE
+genes whose TSS is nearest to it, in every (study, tissue) track. Studies and tissues are taken from the list that the
+application knows about. Annotation files (GENCODE, gene names) are copied from an existing data directory. Example:
+
+    python util/generate.synthetic.data.py -o /tmp/fivex-synthetic --studies 4 --tissues 3 --megabases 5
+    FIVEX_DATA_DIR=/tmp/fivex-synthetic python util/benchmark.endpoints.py
+"""
+import argparse
+import glob
+import gzip
+import json
+import math
+import os
+import random
+import shutil
+import sqlite3
+import subprocess
+import sys
+
+import pysam  # type: ignore
+
+# Allow this script to be run from anywhere, using the formats and study names defined by the web application
+sys.path.insert(
+    0, os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+)
+
+from fivex.annotations import TSSIndex  # noqa: E402 isort:skip
+from fivex.api.format import TISSUES_PER_STUDY  # noqa: E402 isort:skip
+from fivex.pip_summary import build_summary_tables  # noqa: E402 isort:skip
+
+UTIL_DIR = os.path.dirname(os.path.realpath(__file__))
+SAMPLE_DATA_DIR = os.path.join(os.path.dirname(UTIL_DIR), "data")
+
+# Annotation files that are copied (if present) from the source data directory
+ANNOTATION_FILES = [
+    "gene.id.symbol.map.json.gz",
+    "gencode/gencode.v30.annotation.gtf.genes.bed.gz",
+    "gencode/gencode.v30.annotation.gtf.genes.bed.gz.tbi",
+    "gencode/gencode.v30.annotation.gtf.transcripts.bed.gz",
+    "gencode/gencode.v30.annotation.gtf.transcripts.bed.gz.tbi",
+    "gencode/tss.json.gz",
+]
+
+CREDIBLE_SET_HEADER = [
+    "#phenotype_id",
+    "variant_id",
+    "chr",
+    "pos",
+    "ref",
+    "alt",
+    "cs_id",
+    "cs_index",
+    "finemapped_region",
+    "pip",
+    "z",
+    "cs_min_r2",
+    "cs_avg_r2",
+    "cs_size",
+    "posterior_mean",
+    "posterior_sd",
+    "cs_log10bf",
+]
+
+# Each credible set includes the lead variant and (up to) this many of the following variants tested for the same trait
+MAX_CREDIBLE_SET_SIZE = 10
+
+
+def choose_tracks(studies: int, tissues: int):
+    """The first `tissues` tissues of each of the first `studies` studies"""
+    return [
+        (study, tissue)
+        for study in list(TISSUES_PER_STUDY)[:studies]
+        for tissue in TISSUES_PER_STUDY[study][:tissues]
+    ]
+
+
+def make_variants(
+    rng: random.Random, chrom: str, start: int, end: int, per_kb: float
+):
+    """Random, sorted variants: (pos, ref, alt, variant_id, rsid)"""
+    count = min(end - start + 1, int(round((end - start + 1) / 1000 * per_kb)))
+    variants = []
+    for i, pos in enumerate(sorted(rng.sample(range(start, end + 1), count))):
+        ref, alt = rng.sample("ACGT", 2)
+        if rng.random() < 0.05:
+            # Some indels, as in the real data
+            ref += "".join(
+                rng.choice("ACGT") for _ in range(rng.randint(1, 4))
+            )
+        variants.append(
+            (
+                pos,
+                ref,
+                alt,
+                f"chr{chrom}_{pos}_{ref}_{alt}",
+                f"rs{900000000 + i}",
+            )
+        )
+    return variants
+
+
+def traits_for_gene(gene_id: str, datatype: str, transcripts: int):
+    """(molecular_trait_id, molecular_trait_object_id) of each trait measured for a gene"""
+    if datatype == "ge":
+        return [(gene_id, gene_id)]
+    # txrevise events, eg ENSG00000134243.grp_1.contained.ENST00000256637
+    return [
+        (
+            f"{gene_id}.grp_1.contained.ENST{gene_id[4:]}{k}",
+            f"{gene_id}.contained",
+        )
+        for k in range(1, transcripts + 1)
+    ]
+
+
+def make_credible_sets(rng: random.Random, tested: dict, rate: float):
+    """
+    Choose credible sets for one track
+
+    :param tested: trait -> sorted indexes of the variants tested for that trait
+    :return: (trait, variant index) -> (cs_index, pip, cs_size)
+    """
+    members = {}
+    for trait, indexes in tested.items():
+        if rng.random() >= rate:
+            continue
+        lead = rng.randrange(len(indexes))
+        chosen = indexes[lead : lead + rng.randint(1, MAX_CREDIBLE_SET_SIZE)]
+        weights = [rng.random() for _ in chosen]
+        total = sum(weights) / rng.uniform(0.95, 1.0)
+        for index, weight in zip(chosen, weights):
+            members[(trait, index)] = ("L1", weight / total, len(chosen))
+    return members
+
+
+def write_tabix(path: str, lines, seq_col: int, pos_col: int):
+    """Write sorted lines to a bgzipped, tabix-indexed file (at `path`, which ends with .gz)"""
+    plain = path[: -len(".gz")]
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(plain, "w") as f:
+        for line in lines:
+            f.write(line)
+            f.write("\n")
+    pysam.tabix_index(
+        plain, seq_col=seq_col, start_col=pos_col, end_col=pos_col, force=True
+    )
+
+
+def write_best_variants(path: str, rows):
+    """Create the best-variant database from the rows of the merged credible sets file (as written by this script)"""
+    if os.path.exists(path):
+        os.remove(path)
+    conn = sqlite3.connect(path)
+    with conn:
+        conn.execute(
+            "CREATE TABLE sig (pip REAL, study TEXT, tissue TEXT, gene_id TEXT, chrom TEXT, pos INTEGER, ref TEXT, "
+            "alt TEXT, cs_index TEXT, cs_size INTEGER, pvalue REAL)"
+        )
+        # As in util/summarize.highest.pip.for.each.variant.sql.py: the highest PIP for each variant (ties are broken
+        #   by the smallest p-value), in file order
+        best = {}
+        for row in rows:
+            key = (row[4], row[5], row[6], row[7])
+            current = best.get(key)
+            if current is None or (row[11], -row[21]) > (
+                current[0],
+                -current[10],
+            ):
+                best[key] = [
+                    row[11],
+                    row[0],
+                    row[1],
+                    row[2],
+                    row[4],
+                    row[5],
+                    row[6],
+                    row[7],
+                    row[9],
+                    row[15],
+                    row[21],
+                ]
+        conn.executemany(
+            "INSERT INTO sig VALUES (?,?,?,?,?,?,?,?,?,?,?)", best.values()
+        )
+        conn.execute("CREATE INDEX idx_chrom_pos ON sig (chrom, pos)")
+        conn.execute("CREATE INDEX idx_study_tissue ON sig(study, tissue)")
+        conn.execute("CREATE INDEX idx_gene on sig(gene_id)")
+        build_summary_tables(conn)
+    conn.close()
+
+
+def write_rsids(path: str, chrom: str, variants):
+    if os.path.exists(path):
+        os.remove(path)
+    conn = sqlite3.connect(path)
+    with conn:
+        conn.execute(
+            "CREATE TABLE rsidTable (chrom TEXT, pos INTEGER, ref TEXT, alt TEXT, rsid TEXT)"
+        )
+        conn.executemany(
+            "INSERT INTO rsidTable VALUES (?,?,?,?,?)",
+            (
+                (chrom, pos, ref, alt, rsid)
+                for pos, ref, alt, _, rsid in variants
+            ),
+        )
+        conn.execute("CREATE INDEX idx_chrom_pos ON rsidTable (chrom, pos)")
+        conn.execute("CREATE INDEX idx_rsid ON rsidTable (rsid)")
+    conn.close()
+
+
+def generate_datatype(
+    args, rng, datatype, chrom, variants, genes, gene_names, tracks
+):
+    """Write the association and credible set files (and best-variant database) of one datatype"""
+    out = args.out_dir
+    # trait -> indexes of the variants tested for it, and the traits tested for each variant
+    tested = {}
+    variant_traits = []
+    for index, variant_genes in enumerate(genes):
+        traits = [
+            trait
+            for gene_id in variant_genes
+            for trait in traits_for_gene(
+                gene_id, datatype, args.transcripts_per_gene
+            )
+        ]
+        for trait, _ in traits:
+            tested.setdefault(trait, []).append(index)
+        variant_traits.append(traits)
+
+    # Each track has its own sample size, and its own credible sets
+    sample_sizes = {track: rng.randint(100, 700) for track in tracks}
+    credible_sets = {
+        track: make_credible_sets(rng, tested, args.credible_set_rate)
+        for track in tracks
+    }
+
+    track_files = {}
+    for study, tissue in tracks:
+        path = os.path.join(
+            out,
+            "ebi_original",
+            datatype,
+            study,
+            f"{study}_{datatype}_{tissue}.all.tsv",
+        )
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        track_files[(study, tissue)] = open(path, "w")
+
+    track_credible_sets = {track: [] for track in tracks}
+    merged_credible_sets = []
+    # Merged files (all tracks) are written one 1Mbp chunk at a time, as variants are sorted
+    chunk_path = chunk_file = None
+    rows = 0
+    for index, ((pos, ref, alt, variant_id, rsid), traits) in enumerate(
+        zip(variants, variant_traits)
+    ):
+        chunk_start = (pos - 1) // 1000000 * 1000000 + 1
+        path = os.path.join(
+            out,
+            f"ebi_{datatype}",
+            chrom,
+            f"all.EBI.{datatype}.data.chr{chrom}.{chunk_start}-{chunk_start + 999999}.tsv",
+        )
+        if path != chunk_path:
+            if chunk_file is not None:
+                chunk_file.close()
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            chunk_path, chunk_file = path, open(path, "w")
+        vtype = "SNP" if len(ref) == len(alt) else "INDEL"
+        maf = rng.uniform(0.01, 0.5)
+        for track in tracks:
+            study, tissue = track
+            an = 2 * sample_sizes[track]
+            ac = max(1, int(round(maf * an)))
+            ma_samples = max(1, int(ac * 0.9))
+            members = credible_sets[track]
+            for trait, trait_object in traits:
+                gene_id = trait.split(".")[0]
+                member = members.get((trait, index))
+                # Variants in credible sets are strongly associated
+                log_pvalue = (
+                    rng.uniform(8, 30) if member else rng.expovariate(1.0)
+                )
+                # Rounded as written, so that the joined credible sets hold the same value
+                pvalue = float(f"{10 ** -log_pvalue:.6g}")
+                beta = rng.gauss(0, 0.3)
+                se = max(
+                    abs(beta) / max(math.sqrt(log_pvalue * 4.6), 0.1), 0.001
+                )
+                median_tpm = round(rng.uniform(0, 200), 3)
+                fields = [
+                    trait,
+                    chrom,
+                    str(pos),
+                    ref,
+                    alt,
+                    variant_id,
+                    str(ma_samples),
+                    f"{maf:.6g}",
+                    f"{pvalue:.6g}",
+                    f"{beta:.6g}",
+                    f"{se:.6g}",
+                    vtype,
+                    str(ac),
+                    str(an),
+                    "NA",
+                    trait_object,
+                    gene_id,
+                    f"{median_tpm}",
+                    rsid,
+                ]
+                line = "\t".join(fields)
+                track_files[track].write(line)
+                track_files[track].write("\n")
+                chunk_file.write(f"{study}\t{tissue}\t{line}\n")
+                rows += 1
+
+                if member:
+                    cs_index, pip, cs_size = member
+                    z = beta / se
+                    credible_set = [
+                        trait,
+                        variant_id,
+                        chrom,
+                        str(pos),
+                        ref,
+                        alt,
+                        f"{trait}_{cs_index}",
+                        cs_index,
+                        f"chr{chrom}:{max(1, pos - 1000000)}-{pos + 1000000}",
+                        repr(pip),
+                        repr(z),
+                        "0.9",
+                        "0.95",
+                        str(cs_size),
+                        repr(beta * pip),
+                        repr(se),
+                        repr(log_pvalue / 2),
+                    ]
+                    track_credible_sets[track].append("\t".join(credible_set))
+                    merged_credible_sets.append(
+                        [study, tissue]
+                        + credible_set[:3]
+                        + [pos]
+                        + credible_set[4:9]
+                        + [pip]
+                        + credible_set[10:13]
+                        + [cs_size]
+                        + credible_set[14:]
+                        + fields[6:8]
+                        + [pvalue]
+                        + fields[9:]
+                        + [gene_names.get(gene_id, gene_id)]
+                    )
+    for f in track_files.values():
+        f.close()
+        pysam.tabix_index(
+            f.name, seq_col=1, start_col=2, end_col=2, force=True
+        )
+    if chunk_file is not None:
+        chunk_file.close()
+    for path in glob.glob(
+        os.path.join(out, f"ebi_{datatype}", chrom, "*.tsv")
+    ):
+        pysam.tabix_index(path, seq_col=3, start_col=4, end_col=4, force=True)
+    for (study, tissue), lines in track_credible_sets.items():
+        write_tabix(
+            os.path.join(
+                out,
+                "credible_sets",
+                datatype,
+                study,
+                f"{study}.{tissue}_{datatype}.purity_filtered.sorted.txt.gz",
+            ),
+            ["\t".join(CREDIBLE_SET_HEADER)] + lines,
+            seq_col=2,
+            pos_col=3,
+        )
+    merged_credible_sets.sort(key=lambda row: (row[5], row[0], row[1], row[2]))
+    write_tabix(
+        os.path.join(
+            out,
+            "credible_sets",
+            datatype,
+            f"chr{chrom}.{datatype}.credible_set.tsv.gz",
+        ),
+        (
+            "\t".join(str(value) for value in row)
+            for row in merged_credible_sets
+        ),
+        seq_col=4,
+        pos_col=5,
+    )
+    write_best_variants(
+        os.path.join(
+            out,
+            "credible_sets",
+            datatype,
+            "pip.best.variant.summary.sorted.indexed.sqlite3.db",
+        ),
+        merged_credible_sets,
+    )
+    return rows, len(merged_credible_sets)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Generate a synthetic FIVEx data directory, at a configurable scale"
+    )
+    parser.add_argument(
+        "-o", "--out-dir", type=str, required=True, help="Directory to create"
+    )
+    parser.add_argument(
+        "-s",
+        "--source-dir",
+        type=str,
+        default=SAMPLE_DATA_DIR,
+        help="Data directory to copy the GENCODE and gene name files from (default: the sample data)",
+    )
+    parser.add_argument("--chrom", type=str, default="1", help="Chromosome")
+    parser.add_argument(
+        "--start",
+        type=int,
+        default=108000001,
+        help="Start of the region (the first position of a 1Mbp chunk, eg 108000001)",
+    )
+    parser.add_argument(
+        "--megabases", type=int, default=3, help="Length of the region, in Mbp"
+    )
+    parser.add_argument(
+        "--variants-per-kb", type=float, default=1.0, help="Variant density"
+    )
+    parser.add_argument(
+        "--studies", type=int, default=3, help="Number of studies"
+    )
+    parser.add_argument(
+        "--tissues",
+        type=int,
+        default=2,
+        help="Number of tissues per study (at most the number known for each study)",
+    )
+    parser.add_argument(
+        "--genes-per-variant",
+        type=int,
+        default=10,
+        help="Each variant is tested against the genes with the nearest TSS (within 1Mbp)",
+    )
+    parser.add_argument(
+        "--transcripts-per-gene",
+        type=int,
+        default=2,
+        help="Number of txrevise events per gene (for txrev data)",
+    )
+    parser.add_argument(
+        "--credible-set-rate",
+        type=float,
+        default=0.2,
+        help="Fraction of traits (in each track) that have a credible set",
+    )
+    parser.add_argument(
+        "-t",
+        "--datatype",
+        dest="datatypes",
+        action="append",
+        choices=["ge", "txrev"],
+        help="Data types to generate (repeat for both; default: ge and txrev)",
+    )
+    parser.add_argument(
+        "--columnar",
+        action="store_true",
+        help="Also create columnar copies of the association files (util/convert.tabix.to.columnar.py)",
+    )
+    parser.add_argument(
+        "--gene-index",
+        action="store_true",
+        help="Also create gene indexes of the association files (util/build.gene.index.py)",
+    )
+    parser.add_argument("--seed", type=int, default=1, help="Random seed")
+    args = parser.parse_args()
+    datatypes = args.datatypes or ["ge", "txrev"]
+    rng = random.Random(args.seed)
+
+    if args.start % 1000000 != 1:
+        parser.error("--start must be the first position of a 1Mbp chunk")
+    os.makedirs(args.out_dir, exist_ok=True)
+    for name in ANNOTATION_FILES:
+        source = os.path.join(args.source_dir, name)
+        if os.path.isfile(source):
+            os.makedirs(
+                os.path.dirname(os.path.join(args.out_dir, name)),
+                exist_ok=True,
+            )
+            shutil.copyfile(source, os.path.join(args.out_dir, name))
+
+    with gzip.open(
+        os.path.join(args.out_dir, "gene.id.symbol.map.json.gz"), "rt"
+    ) as f:
+        gene_names = json.load(f)
+    tss_index = TSSIndex.from_gencode(
+        os.path.join(args.out_dir, ANNOTATION_FILES[1])
+    )
+
+    chrom = args.chrom.replace("chr", "")
+    end = args.start + args.megabases * 1000000 - 1
+    tracks = choose_tracks(args.studies, args.tissues)
+    variants = make_variants(rng, chrom, args.start, end, args.variants_per_kb)
+    genes = []
+    for pos, *_ in variants:
+        nearby = tss_index.genes_near(chrom, pos, 1000000)
+        nearby.sort(key=lambda gene: abs(pos - abs(gene[1])))
+        genes.append(
+            sorted(gene_id for gene_id, _ in nearby[: args.genes_per_variant])
+        )
+
+    print(
+        f"{len(variants)} variants in chr{chrom}:{args.start}-{end}, {len(tracks)} tracks "
+        f"(up to {args.tissues} tissues in each of {args.studies} studies)"
+    )
+    write_rsids(os.path.join(args.out_dir, "rsid.sqlite3.db"), chrom, variants)
+    for datatype in datatypes:
+        rows, credible_set_rows = generate_datatype(
+            args, rng, datatype, chrom, variants, genes, gene_names, tracks
+        )
+        print(
+            f"{datatype}: {rows} association rows, {credible_set_rows} credible set rows"
+        )
+        for enabled, script in (
+            (args.columnar, "convert.tabix.to.columnar.py"),
+            (args.gene_index, "build.gene.index.py"),
+        ):
+            if enabled:
+                subprocess.run(
+                    [
+                        sys.executable,
+                        os.path.join(UTIL_DIR, script),
+                        "-d",
+                        args.out_dir,
+                        "-t",
+                        datatype,
+                        "-f",
+                    ],
+                    check=True,
+                    stdout=subprocess.DEVNULL,
+                )
+
+
+if __name__ == "__main__":
+    main()
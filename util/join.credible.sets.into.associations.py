@@ -0,0 +1,94 @@
+import argparse
+import glob
+import gzip
+import os
+import sys
+
+# Allow this script to be run from anywhere, using the file format defined by the web application
+sys.path.insert(
+    0, os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+)
+
+from fivex.columnar import JOINED_ASSOCIATION_COLUMNS  # noqa: E402 isort:skip
+from fivex.credible_sets import (  # noqa: E402 isort:skip
+    CREDIBLE_SET_DATATYPE,
+    join_credible_sets,
+)
+
+parser = argparse.ArgumentParser(
+    description="Add credible set columns (cs_index, cs_size, pip) to FIVEx's association files, in place"
+)
+parser.add_argument(
+    "-d",
+    "--data-dir",
+    type=str,
+    required=True,
+    help="FIVEx data directory, containing the ebi_original/, ebi_{datatype}/, and credible_sets/ subdirectories",
+)
+parser.add_argument(
+    "-t",
+    "--datatype",
+    type=str,
+    required=False,
+    default="ge",
+    help="Data type to join (ge or txrev)",
+)
+
+args = parser.parse_args()
+# Every datatype is joined with the gene expression credible sets, by gene, as at query time (see fivex.credible_sets)
+credibleSetDir = os.path.join(
+    args.data_dir, "credible_sets", CREDIBLE_SET_DATATYPE
+)
+
+# Study- and tissue-specific files: {study}/{study}_{datatype}_{tissue}.all.tsv.gz
+# Study and tissue names may contain underscores, so the study is taken from the directory name
+studyTissueFiles = glob.glob(
+    os.path.join(
+        args.data_dir, "ebi_original", args.datatype, "*", "*.all.tsv.gz"
+    )
+)
+# Merged files (all studies and tissues) in 1Mbp chunks: {chrom}/all.EBI.{datatype}.data.chr{chrom}.{start}-{end}.tsv.gz
+mergedFiles = glob.glob(
+    os.path.join(args.data_dir, f"ebi_{args.datatype}", "*", "*.tsv.gz")
+)
+
+for filename in sorted(studyTissueFiles) + sorted(mergedFiles):
+    relativePath = os.path.relpath(filename, args.data_dir)
+    study = tissue = None
+    if filename in studyTissueFiles:
+        study = os.path.basename(os.path.dirname(filename))
+        prefix = f"{study}_{args.datatype}_"
+        tissue = os.path.basename(filename)[len(prefix) : -len(".all.tsv.gz")]
+        credibleSetFile = os.path.join(
+            credibleSetDir,
+            study,
+            f"{study}.{tissue}_{CREDIBLE_SET_DATATYPE}.purity_filtered.sorted.txt.gz",
+        )
+        prefixColumns = 2
+    else:
+        chrom = os.path.basename(os.path.dirname(filename))
+        credibleSetFile = os.path.join(
+            credibleSetDir,
+            f"chr{chrom}.{CREDIBLE_SET_DATATYPE}.credible_set.tsv.gz",
+        )
+        prefixColumns = 0
+
+    with gzip.open(filename, "rt") as f:
+        columnCount = len(f.readline().rstrip("\n").split("\t"))
+    if columnCount + prefixColumns == len(JOINED_ASSOCIATION_COLUMNS):
+        print(f"Skipping {relativePath}: already joined")
+        continue
+    if not os.path.isfile(credibleSetFile):
+        print(
+            f"WARNING: No credible sets for {relativePath} (expected {credibleSetFile})",
+            file=sys.stderr,
+        )
+
+    # Write a joined copy, then replace the original file (and index) with it
+    temporaryFile = f"{filename}.joining"
+    rows, members = join_credible_sets(
+        filename, credibleSetFile, temporaryFile, study=study, tissue=tissue
+    )
+    os.replace(temporaryFile, filename)
+    os.replace(f"{temporaryFile}.tbi", f"{filename}.tbi")
+    print(f"Joined {relativePath}: {members} of {rows} rows in a credible set")
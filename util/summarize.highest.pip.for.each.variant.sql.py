@@ -4,6 +4,13 @@ import os
 import sqlite3
 import sys
 
+# Allow this script to be run from anywhere, using the summary format defined by the web application
+sys.path.insert(
+    0, os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+)
+
+from fivex.pip_summary import build_summary_tables  # noqa: E402 isort:skip
+
 # Input arguments:
 # csdir: directory containing merged confidence interval data
 #  Note: we will now use confidence interval data which has been joined with the raw QTL points data to add p-values
@@ -142,4 +149,6 @@ with conn:
     cursor.execute("CREATE INDEX idx_chrom_pos ON sig (chrom, pos)")
     cursor.execute("CREATE INDEX idx_study_tissue ON sig(study, tissue)")
     cursor.execute("CREATE INDEX idx_gene on sig(gene_id)")
+    # Best row per bin (overall, per gene, and per study and tissue), and covering indexes, for fast region lookups
+    build_summary_tables(conn)
     conn.commit()